@@ -1 +1 @@
-from psynudge.src import core, controllers, db, mydt
+from psynudge.src import core, controllers, db, mydt, jsonstream, config, clients, dispatch, daemon
@@ -0,0 +1,60 @@
+"""
+:Author: Balazs Szigeti <b.islander@protonmail.com>
+:Copyright: 2021, DrugNerdsLab
+:License: MIT
+
+Import time of the modules behind each entry point, measured with python -X importtime in fresh interpreters
+Reports the median cumulative import time and the slowest imports (self time) of the last run
+
+python benchmarks/bench_importtime.py [n_runs]
+"""
+
+import statistics
+import subprocess
+import collections
+import sys
+import os
+
+root_dir = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+entry_points = collections.OrderedDict([
+    ('run_send_nudges.py / run_update_ps.py / run_rebuild_database.py', 'src.controllers'),
+    ('run_daemon.py', 'src.daemon'),
+    ('dispatch only', 'src.dispatch'),
+])
+
+heavy_modules = ['requests', 'urllib3', 'surveygizmo', 'src.tokens']
+
+
+def measure(module):
+    """ Returns ({module: (self us, cumulative us)}, heavy modules loaded) of importing module in a fresh interpreter """
+
+    code = 'import sys, {0}; print(",".join(m for m in {1!r} if m in sys.modules))'.format(module, heavy_modules)
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=root_dir, check=True,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+    times = {}
+    for line in out.stderr.splitlines():
+        if not line.startswith('import time:') or ('self [us]' in line):
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+
+    return times, [name for name in out.stdout.strip().split(',') if name]
+
+def run_benchmark(n_runs=10):
+
+    for entry_point, module in entry_points.items():
+
+        runs = [measure(module) for idx in range(n_runs)]
+        cumulative = [times[module][1] for times, loaded in runs]
+        times, loaded = runs[-1]
+
+        print('{} ({})'.format(entry_point, module))
+        print('    median {:7.1f} ms   min {:7.1f} ms   heavy modules loaded: {}'.format(
+            statistics.median(cumulative)/1000, min(cumulative)/1000, ', '.join(loaded) or '-'))
+        for name, (self_us, cumulative_us) in sorted(times.items(), key=lambda item: -item[1][0])[:5]:
+            print('    {:7.1f} ms  {}'.format(self_us/1000, name))
+
+if __name__ == '__main__':
+    run_benchmark(*[int(arg) for arg in sys.argv[1:]])
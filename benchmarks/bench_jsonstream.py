@@ -0,0 +1,79 @@
+"""
+:Author: Balazs Szigeti <b.islander@protonmail.com>
+:Copyright: 2021, DrugNerdsLab
+:License: MIT
+
+Peak RSS of reading an Alchemer export with json.loads (previous path) vs jsonstream.iterJsonArray
+Each variant runs in a fresh interpreter, so ru_maxrss is not polluted by the other
+
+python benchmarks/bench_jsonstream.py [n_responses]
+"""
+
+import subprocess
+import tempfile
+import json
+import sys
+import os
+
+root_dir = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+child_code = {
+'json.loads': """
+import json
+with open(filepath, 'r') as j:
+    data = json.loads(j.read())
+n = sum(1 for response in data['data'])
+""",
+'jsonstream': """
+from src.jsonstream import iterJsonArray
+with open(filepath, 'r') as j:
+    n = sum(1 for response in iterJsonArray(j, key='data'))
+""",
+}
+
+child_template = """
+import resource, time, sys
+sys.path.insert(0, {root_dir!r})
+filepath = {filepath!r}
+start = time.perf_counter()
+{code}
+print(n, time.perf_counter()-start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+def get_response(idx, n_questions=150):
+    """ Mock response, roughly the size of a real one """
+
+    survey_data = {str(qid): {'id': qid, 'type': 'RADIO', 'question': 'Question {}'.format(qid), 'section_id': 1,
+                              'answer': 'Answer {}'.format(idx), 'shown': True} for qid in range(n_questions)}
+    return {'id': str(idx), 'status': 'Complete', 'date_submitted': '2021-01-01 10:00:00 GMT',
+            'url_variables': {'sguid': {'key': 'sguid', 'value': 'sguid{}'.format(idx), 'type': 'url'}},
+            'survey_data': survey_data}
+
+def write_export(filepath, n_responses):
+
+    with open(filepath, 'w') as file:
+        file.write('{{"result_ok": true, "total_count": {0}, "page": 1, "total_pages": 1, "results_per_page": {0}, "data": ['.format(n_responses))
+        for idx in range(n_responses):
+            if idx>0:
+                file.write(',')
+            json.dump(get_response(idx), file)
+        file.write(']}')
+
+def run_benchmark(n_responses=20000):
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filepath = os.path.join(tmp_dir, 'export.json')
+        write_export(filepath, n_responses)
+        print('{} responses, {:.1f} MB export'.format(n_responses, os.path.getsize(filepath)/2**20))
+
+        for name, code in child_code.items():
+            out = subprocess.run(
+                [sys.executable, '-c', child_template.format(root_dir=root_dir, filepath=filepath, code=code)],
+                check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout.split()
+
+            n, seconds, maxrss = int(out[0]), float(out[1]), int(out[2])
+            assert n==n_responses
+            print('{:<12} {:8.2f} s   peak RSS {:8.1f} MB'.format(name, seconds, maxrss/2**10)) # ru_maxrss is in KB on Linux
+
+if __name__ == '__main__':
+    run_benchmark(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,115 @@
+"""
+:Author: Balazs Szigeti <b.islander@protonmail.com>
+:Copyright: 2021, DrugNerdsLab
+:License: MIT
+
+End-to-end load test against the local PS / Alchemer stand-in (tests/stubserver.py): builds a database of the
+skeleton studies with n participants, then runs a delta PS sync, an incremental SG sync and a nudge run on top
+of some churn. Reports wall time, HTTP requests and injected errors of every step
+
+python benchmarks/bench_load.py [n_participants ...]
+"""
+
+from unittest import mock
+import collections
+import contextlib
+import tempfile
+import datetime
+import logging
+import time
+import pytz
+import sys
+import os
+
+root_dir = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, root_dir)
+sys.path.insert(0, os.path.join(root_dir, 'tests'))
+from src import controllers, config, db as psydb
+from src.mylogger import psylog
+import stubserver
+
+LATENCY = 0.02      # seconds added to every stub request
+ERROR_RATE = 0.01   # fraction of stub requests answered with 503, absorbed by the retry policy
+CHURN = 0.01        # fraction of participants changed / added and of responses added between the syncs
+
+
+def makeData(n, now):
+    """ PS participants and SG responses of the skeleton studies, n participants split evenly """
+
+    ps_participants, sg_responses = {}, collections.defaultdict(list)
+    submitted = now - datetime.timedelta(hours=1)
+
+    for idx, study in enumerate(psydb.get_skeleton(mock_db=False)):
+        entries = stubserver.makePsParticipants(n//2, start=now, days=8, prefix='{}_'.format(idx), seed=idx)
+        ps_participants[study['id']] = entries
+        ids = [entry['id'] for entry in entries]
+
+        if study['type']=='stack':
+            qids = [(tp['firstQID'], tp['lastQID']) for tp in study['timepoints']]
+            sg_responses[study['timepoints'][0]['surveyId']] += stubserver.makeSgResponses(ids, qids, submitted, seed=idx)
+        else:
+            for tp in study['timepoints']:
+                sg_responses[tp['surveyId']] += stubserver.makeSgResponses(ids, [(tp['firstQID'], tp['lastQID'])], submitted, seed=idx)
+
+    return ps_participants, dict(sg_responses)
+
+def addChurn(server, now):
+    """ Changes / adds CHURN of the participants and adds CHURN new responses, all stamped now """
+
+    for studyId, entries in server.ps_participants.items():
+        n_churn = max(1, int(len(entries)*CHURN))
+        for entry in entries[:n_churn]:
+            entry['date'] = entry['updatedAt'] = (now - datetime.timedelta(days=1)).isoformat()
+        new = stubserver.makePsParticipants(n_churn, start=now, days=8, prefix='new_{}_'.format(studyId[:4]), seed=1)
+        entries.extend(new)
+
+    for surveyId, responses in server.sg_responses.items():
+        ids = [response['url_variables']['sguid']['value'] for response in responses[:max(1, int(len(responses)*CHURN))]]
+        responses.extend(stubserver.makeSgResponses(ids, [(2, 18), (7, 19)], now, complete_rate=1, seed=2))
+
+@contextlib.contextmanager
+def step(name, server, report):
+
+    n_requests, n_errors = len(server.requests), server.n_errors
+    start = time.perf_counter()
+    yield
+    report.append((name, time.perf_counter()-start, len(server.requests)-n_requests, server.n_errors-n_errors))
+
+def run_load(n):
+
+    now = datetime.datetime.now(pytz.UTC).replace(microsecond=0)
+    ps_participants, sg_responses = makeData(n, now)
+    report = []
+
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+         stubserver.StubServer(sg_responses=sg_responses, ps_participants=ps_participants,
+                               latency=LATENCY, error_rate=ERROR_RATE, seed=0) as server, \
+         mock.patch.object(config, 'PS_BASE_URL', server.url+'v2/'), \
+         mock.patch.object(config, 'SG_BASE_URL', server.url), \
+         mock.patch.object(config, 'NUDGE_RATE_PER_STUDY', 0), \
+         mock.patch.multiple('src.tokens', sg_key='stub', sg_secret='stub', ps_key='stub', ps_secret='stub'):
+
+        with step('build_database', server, report):
+            db = controllers.build_database(filepath=os.path.join(tmp_dir, 'load.sqlite'), reconcile=False)
+
+        time.sleep(1) # churn is stamped after the last checks
+        addChurn(server, datetime.datetime.now(pytz.UTC).replace(microsecond=0))
+
+        with step('updatePsData2Db', server, report):
+            controllers.updatePsData2Db(db, save=False, delete_past=False)
+        with step('updateSgData2Db', server, report):
+            controllers.updateSgData2Db(db, save=False, getAll=False)
+        with step('sendNudges', server, report):
+            controllers.sendNudges(db)
+
+        sent = sum(len(body['participants']) for studyId, tpId, body in server.sent)
+        db.disconnect()
+
+    print('{} participants, {} nudges sent'.format(n, sent))
+    for name, seconds, n_requests, n_errors in report:
+        print('    {:<16} {:8.2f} s   requests {:6d}   injected errors {:4d}'.format(name, seconds, n_requests, n_errors))
+
+if __name__ == '__main__':
+    psylog.setLevel(logging.WARNING) # per participant info lines would flood psynudge.log
+    for n in [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000]:
+        run_load(n)
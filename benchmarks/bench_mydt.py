@@ -0,0 +1,58 @@
+"""
+:Author: Balazs Szigeti <b.islander@protonmail.com>
+:Copyright: 2021, DrugNerdsLab
+:License: MIT
+
+Micro-benchmark of mydt.iso2utcdt against the previous dateutil based implementation
+
+python benchmarks/bench_mydt.py
+"""
+
+import dateutil.parser
+import datetime
+import timeit
+import pytz
+import sys
+import os
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)))
+from src import mydt
+
+
+def legacy_iso2utcdt(dstr):
+    """ iso2utcdt before the fast path / memoization """
+
+    assert isinstance(dstr, str)
+    dt_loc = dateutil.parser.parse(dstr)
+    dt_utc = dt_loc.astimezone(pytz.timezone('UTC'))
+
+    return dt_utc
+
+def get_inputs(n_participants=2000, n_repeats=5):
+    """ Mimics a nudge run: every whenStart is parsed several times, Alchemer dates are mostly unique """
+
+    start = datetime.datetime(2021, 1, 1, tzinfo=pytz.UTC)
+    whenStarts = [(start + datetime.timedelta(minutes=17*idx)).isoformat() for idx in range(n_participants)]
+    sgDates = [(start + datetime.timedelta(seconds=97*idx)).strftime('%Y-%m-%d %H:%M:%S GMT') for idx in range(n_participants)]
+    return whenStarts*n_repeats + sgDates
+
+def run_benchmark(number=3):
+
+    inputs = get_inputs()
+    candidates = [
+        ('dateutil (legacy)', legacy_iso2utcdt),
+        ('fast path, cold cache', lambda dstr: mydt.iso2utcdt.__wrapped__(dstr)),
+        ('fast path, warm cache', mydt.iso2utcdt),
+    ]
+
+    for dstr in inputs[:50]:
+        assert legacy_iso2utcdt(dstr)==mydt.iso2utcdt(dstr)
+
+    print('{} date strings per run, best of {} runs'.format(len(inputs), number))
+    for name, func in candidates:
+        mydt.iso2utcdt.cache_clear()
+        timings = timeit.repeat(lambda: [func(dstr) for dstr in inputs], number=1, repeat=number)
+        print('{:<24} {:8.2f} ms   {:6.2f} us/call'.format(name, min(timings)*1e3, min(timings)/len(inputs)*1e6))
+
+if __name__ == '__main__':
+    run_benchmark()
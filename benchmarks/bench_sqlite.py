@@ -0,0 +1,84 @@
+"""
+:Author: Balazs Szigeti <b.islander@protonmail.com>
+:Copyright: 2021, DrugNerdsLab
+:License: MIT
+
+Ingest and nudge selection throughput of the SQLite profiles in config.SQLITE_PROFILES, each on a fresh DB file
+
+python benchmarks/bench_sqlite.py [n_participants] [n_chunks]
+"""
+
+from pony.orm import db_session
+import tempfile
+import datetime
+import logging
+import time
+import pytz
+import sys
+import os
+
+root_dir = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, root_dir)
+sys.path.insert(0, os.path.join(root_dir, 'tests'))
+from src import core, config, db as psydb
+from src.mylogger import psylog
+import stubserver
+
+
+def run_profile(profile, filepath, n_participants, n_chunks):
+    """ Returns (participants/s, responses/s, getNudgeIds calls/s, queueNudges s); ingest is split into n_chunks
+        transactions, as successive syncs would write it """
+
+    now = datetime.datetime.now(pytz.UTC)
+    entries = stubserver.makePsParticipants(n_participants, start=now, days=8, seed=0)
+    db = psydb.build_skeleton_database(filepath=filepath, mock_db=True, profile=profile)
+
+    with db_session:
+        study = db.Study.select(lambda s: s.name=='indep_study').first()
+        studyId = study.id
+        tps = [(tp.id, tp.firstQID, tp.lastQID) for tp in study.timepoints.select()]
+
+    chunk_size = -(-n_participants//n_chunks)
+    start = time.perf_counter()
+    for idx in range(0, n_participants, chunk_size):
+        with db_session:
+            core.updateParticipant(db=db, study=db.Study[studyId], ps_data=entries[idx:idx+chunk_size])
+    participants_rate = n_participants/(time.perf_counter()-start)
+
+    ids = [entry['id'] for entry in entries]
+    responses = {tpId: stubserver.makeSgResponses(ids, [(firstQID, lastQID)], now, seed=0) for tpId, firstQID, lastQID in tps}
+    start = time.perf_counter()
+    for tpId, firstQID, lastQID in tps:
+        for idx in range(0, n_participants, chunk_size):
+            with db_session:
+                core.updateIsCompleteIndep(db=db, tp=db.Timepoint[tpId], alchemy_data=responses[tpId][idx:idx+chunk_size])
+    responses_rate = len(tps)*n_participants/(time.perf_counter()-start)
+
+    n_calls = 20
+    start = time.perf_counter()
+    for idx in range(n_calls):
+        for tpId, firstQID, lastQID in tps:
+            with db_session:
+                core.getNudgeIds(db=db, tp=db.Timepoint[tpId])
+    selection_rate = n_calls*len(tps)/(time.perf_counter()-start)
+
+    start = time.perf_counter()
+    core.queueNudges(db)
+    queue_seconds = time.perf_counter()-start
+
+    db.disconnect()
+    return participants_rate, responses_rate, selection_rate, queue_seconds
+
+def run_benchmark(n_participants=20000, n_chunks=20):
+
+    psylog.setLevel(logging.WARNING) # per completion info lines would dominate the timings
+    print('{} participants in {} transactions'.format(n_participants, n_chunks))
+    print('{:<10} {:>16} {:>14} {:>18} {:>12}'.format('profile', 'participants/s', 'responses/s', 'getNudgeIds/s', 'queue s'))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for profile in config.SQLITE_PROFILES:
+            rates = run_profile(profile, os.path.join(tmp_dir, '{}.sqlite'.format(profile)), n_participants, n_chunks)
+            print('{:<10} {:16.0f} {:14.0f} {:18.1f} {:12.3f}'.format(profile, *rates))
+
+if __name__ == '__main__':
+    run_benchmark(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,10 @@
+"""
+:Author: Balazs Szigeti <b.islander@protonmail.com>
+:Copyright: 2021, DrugNerdsLab
+:License: MIT
+
+Long running alternative of the cron jobs, e.g.: nohup python run_daemon.py &
+"""
+
+from src import daemon
+daemon.run()
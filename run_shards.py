@@ -0,0 +1,12 @@
+"""
+:Author: Balazs Szigeti <b.islander@protonmail.com>
+:Copyright: 2021, DrugNerdsLab
+:License: MIT
+
+Sharded layout: PS sync, SG sync and nudges of every study in its own process and database file
+"""
+
+from src import controllers
+
+if __name__ == '__main__': # worker processes must not rerun the jobs on import
+    controllers.runShards()
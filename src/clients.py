@@ -0,0 +1,125 @@
+"""
+:Author: Balazs Szigeti <b.islander@protonmail.com>
+:Copyright: 2021, DrugNerdsLab
+:License: MIT
+
+Shared HTTP layer of the PS dashboard and Alchemer (SurveyGizmo) calls: one keep-alive connection pool per process,
+explicit connect / read timeouts and retry with exponential backoff on 429 and 5xx
+
+requests, urllib3, surveygizmo and the tokens are imported on first use, so runs that make no HTTP call (e.g.
+sendNudges with an empty outbox) do not pay for loading them; see benchmarks/bench_importtime.py
+"""
+
+from . import config
+import functools
+import threading
+
+_session = None
+_session_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=1)
+def getRetryClass():
+    """ urllib3 Retry where GETs are retried on RETRY_STATUSES and read errors, POSTs (nudge sends) only on 429 and
+        connect errors, where PS did not process the request """
+
+    from urllib3.util.retry import Retry
+
+    class NudgeRetry(Retry):
+
+        def is_retry(self, method, status_code, has_retry_after=False):
+            if method.upper()=='POST': # not in the allowed methods, so read errors / timeouts are raised
+                return (status_code==429) and (status_code in (self.status_forcelist or ()))
+            return super().is_retry(method, status_code, has_retry_after)
+
+    return NudgeRetry
+
+def getRetry(): #Imp tested
+    """ Retry policy of the shared session, see config.HTTP_RETRIES / HTTP_BACKOFF """
+
+    Retry = getRetryClass()
+    methods = frozenset(['GET']) # POSTs on 429 only, see getRetryClass
+    methods_kwarg = 'allowed_methods' if hasattr(Retry, 'DEFAULT_ALLOWED_METHODS') else 'method_whitelist' # urllib3<1.26
+
+    return Retry(
+        total = config.HTTP_RETRIES,
+        backoff_factor = config.HTTP_BACKOFF,
+        status_forcelist = config.HTTP_RETRY_STATUSES,
+        raise_on_status = False,
+        **{methods_kwarg: methods})
+
+def getSession(): #Tested
+    """ Returns the process-wide requests.Session, created on first use """
+
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections = config.HTTP_POOL_CONNECTIONS,
+                pool_maxsize = config.HTTP_POOL_MAXSIZE,
+                max_retries = getRetry())
+
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+
+    return _session
+
+def closeSession():
+    """ Closes pooled connections; the next call opens a new session """
+
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+def request(method, url, **kwargs): #Tested
+    """ requests.request through the shared session with the configured (connect, read) timeout """
+
+    kwargs.setdefault('timeout', (config.HTTP_CONNECT_TIMEOUT, config.HTTP_READ_TIMEOUT))
+    return getSession().request(method, url, **kwargs)
+
+def psRequest(method, path, **kwargs): #Imp tested
+    """ Calls PS dashboard API endpoint at path (relative to config.PS_BASE_URL) """
+
+    from . import tokens
+
+    headers = kwargs.pop('headers', {})
+    headers.update({
+        'ClientSecret': tokens.ps_secret,
+        'ClientID': tokens.ps_key,
+        })
+
+    return request(method, config.PS_BASE_URL+path, headers=headers, **kwargs)
+
+def sgList(resource, *args): #Imp tested
+    """ Executes a SurveyGizmo list call (e.g. sgList(client.api.surveyresponse.page(2), surveyId)) through the
+        shared session; returns parsed JSON """
+
+    url, params = resource.list(*args) # client is built with prepare_url, so the lib only assembles the request
+    response = request('GET', url, params=params)
+    response.raise_for_status()
+    return response.json()
+
+def getSgClient(): #Imp tested
+    """ Returns SurveyGizmo v5 client, cached per base url and credentials """
+    from . import tokens
+    return _getSgClient(config.SG_BASE_URL, tokens.sg_key, tokens.sg_secret)
+
+@functools.lru_cache(maxsize=4)
+def _getSgClient(base_url, api_token, api_token_secret):
+
+    from surveygizmo import SurveyGizmo
+
+    client = SurveyGizmo(api_version='v5',
+                         response_type='json',
+                         api_token = api_token,
+                         api_token_secret = api_token_secret,
+                         prepare_url = True)
+
+    client.config.base_url = base_url
+    return client
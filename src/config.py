@@ -0,0 +1,72 @@
+"""
+:Author: Balazs Szigeti <b.islander@protonmail.com>
+:Copyright: 2021, DrugNerdsLab
+:License: MIT
+
+Tunables of the PS / Alchemer clients. Values are read at call time, so they can be changed at runtime or patched in tests
+"""
+
+# PS dashboard API
+PS_BASE_URL = 'https://dashboard-api.psychedelicsurvey.com/v2/'
+PS_DELTA_PARAM = 'updatedSince'     # participants query parameter of delta downloads, None to always download all
+PS_DELTA_OVERLAP = 300              # seconds, deltas start this much before the last check to absorb clock skew
+PS_FULL_SYNC_INTERVAL = 24*3600     # seconds between full downloads, which catch anything deltas missed
+
+# Alchemer (SurveyGizmo) v5 API
+SG_BASE_URL = 'https://restapi.surveygizmo.eu/'
+SG_PAGE_SIZE = 500          # responses per surveyresponse page
+SG_MAX_CONCURRENT_PAGES = 4 # pages downloaded in parallel per survey
+
+# Controllers
+SYNC_MAX_WORKERS = 4        # studies / timepoints downloaded in parallel by updatePsData2Db and updateSgData2Db
+SYNC_STREAM_BUFFER = 500    # SG responses per survey downloaded ahead of the DB updates of updateSgData2Db
+
+# HTTP client (see clients.py)
+HTTP_CONNECT_TIMEOUT = 5    # seconds
+HTTP_READ_TIMEOUT = 120     # seconds, large SG pages are slow to render
+HTTP_RETRIES = 5
+HTTP_BACKOFF = 0.5          # sleeps 0.5, 1, 2, 4 ... seconds between retries
+HTTP_RETRY_STATUSES = [429, 500, 502, 503, 504] + list(range(520, 530))
+HTTP_POOL_CONNECTIONS = 4   # hosts kept alive
+HTTP_POOL_MAXSIZE = 16      # connections per host, >= SYNC_MAX_WORKERS*SG_MAX_CONCURRENT_PAGES
+
+# Nudge dispatch (see dispatch.py)
+NUDGE_BATCH_SIZE = 100      # participants per PS send call
+NUDGE_MAX_WORKERS = 4       # send calls in flight
+NUDGE_RATE_PER_STUDY = 2    # send calls started per second per study, None for no limit
+NUDGE_DRAIN_LIMIT = 10000   # outbox rows claimed per drainOutbox call
+NUDGE_CLAIM_LEASE = 3600    # seconds until a claimed but unconfirmed row is sent again
+NUDGE_MAX_ATTEMPTS = 5      # failed sends before a row is left in the outbox for inspection
+
+# Sharded layout (see db.open_database / controllers.runShards)
+SHARD_MAX_WORKERS = 4       # shards processed in parallel worker processes
+SQLITE_MAX_ATTACHED = 10    # shards attached at once by db.query_shards, SQLite's default limit
+
+# Daemon (see daemon.py), seconds
+DAEMON_PS_INTERVAL = 300
+DAEMON_SG_INTERVAL = 300
+DAEMON_NUDGE_INTERVAL = 300
+DAEMON_NUDGE_DELAY = 60     # first nudge run waits for the first syncs
+DAEMON_RECONCILE_INTERVAL = 3600 # skeleton changes, pruning and full PS download, as run_rebuild_database.py
+
+# SQLite (see db.open_database), PRAGMAs applied in order on every connection
+SQLITE_PROFILE = 'wal'
+SQLITE_PROFILES = {
+    'default': {},                  # SQLite defaults: rollback journal, synchronous=FULL, 2MB page cache, no mmap
+    'wal': {
+        'journal_mode': 'WAL',      # readers do not block the writer, overlapping jobs only serialize on writes
+        'synchronous': 'NORMAL',    # fsync at checkpoints only; a power loss may drop the last commits, never corrupts
+        'cache_size': -64000,       # KB (negative) of page cache per connection
+        'mmap_size': 268435456,     # bytes of the file read through mmap
+        'temp_store': 'MEMORY',     # temp b-trees of sorts / GROUP BYs in memory
+        'busy_timeout': 30000,      # ms to wait for the write lock before 'database is locked'
+        },
+    'wal_safe': {                   # as wal, with an fsync on every commit
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+        'cache_size': -64000,
+        'mmap_size': 268435456,
+        'temp_store': 'MEMORY',
+        'busy_timeout': 30000,
+        },
+}
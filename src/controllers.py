@@ -4,19 +4,35 @@
 :License: MIT
 """
 
-from .db import build_skeleton_database
-from .tokens import ps_key, ps_secret
-from .mydt import getUtcNow
+from pony.orm import db_session
+from .db import build_skeleton_database, open_database, reconcile_skeleton, refresh_schedules, CATALOG
+from .mydt import getUtcNow, dt2ts
 from .mylogger import psylog, log_path
-from .core import *
-import requests
+from .core import (updateParticipant, pruneParticipants, deletePastParticipant, updateIsCompleteIndep,
+    updateIsCompleteStack, getNudgeIds, queueNudges, getPsQuery, fetchPsData, isPsReconcileDue, setLastPsCheck,
+    getSgQuery, iterSgResponses, setLastSgCheck, diffPayload, getDataFilePath, saveData, iterSaveData)
+from . import config, clients, dispatch
+import concurrent.futures
+import contextlib
+import threading
+import queue
 import os
 
 
 src_folder = os.path.dirname(os.path.abspath(__file__))
 base_dir   = os.path.abspath(os.path.join(src_folder, os.pardir))
 
-def build_database(filepath=os.path.join(base_dir, 'psynudge_db.sqlite'), delete_past=True):
+SHARD_JOBS = [('updatePsData2Db', {'save': False}), ('updateSgData2Db', {'save': False}), ('sendNudges', {})] # (controller, kwargs) run by runShard
+
+def build_database(filepath=os.path.join(base_dir, 'psynudge_db.sqlite'), delete_past=True, reconcile=True):
+    """ Builds the database from the skeleton (see db.get_skeleton) and PS / SG data. If reconcile and the database
+        exists, it is diffed against the skeleton and a full PS download instead of being rebuilt: only inserts,
+        updates and deletes are applied, nudge history is kept and SG data is downloaded since the last check """
+
+    if (reconcile is True) and os.path.isfile(filepath):
+        db = open_database(filepath=filepath, create_db=False)
+        reconcileDatabase(db, delete_past=delete_past)
+        return db
 
     psylog.info('Rebuild database')
     db = build_skeleton_database(filepath=filepath, create_db=True, mock_db=False)
@@ -25,100 +41,231 @@ def build_database(filepath=os.path.join(base_dir, 'psynudge_db.sqlite'), delete
     #assert False
     return db
 
+def reconcileDatabase(db, delete_past=True, mock_db=False): #Imp tested
+    """ Diffs an open database against the skeleton and a full PS download, then downloads SG data since the last check """
+
+    psylog.info('Reconcile database')
+    psylog.info('Skeleton reconciled: {}'.format(reconcile_skeleton(db, mock_db=mock_db)))
+    updatePsData2Db(db, save=False, delete_past=delete_past, full=True, prune=True)
+    updateSgData2Db(db, save=False, getAll=False)
+
 @db_session
-def updatePsData2Db(db, save=True, delete_past=True):
-    """ Downloads PS data and updates DB """
+def updatePsData2Db(db, save=True, delete_past=True, full=None, prune=False):
+    """ Downloads PS data and updates DB; downloads run concurrently (see mapConcurrently), DB updates serially.
+        Downloads are deltas since the last check, with a periodic full download (see core.getPsQuery).
+        prune: participants missing from a full download are deleted """
 
     psylog.info('updatePsData2Db initalised')
 
     assert isinstance(save, bool)
 
-    for study in db.Study.select(lambda s: s.isActive is True).fetch():
+    refresh_schedules(db) # timepoints may have been reconciled by another process
+    checkTs = dt2ts(getUtcNow()) # taken before downloading, so the next delta overlaps this one
+    studies = db.Study.select(lambda s: s.isActive is True).fetch()
+    queries = [getPsQuery(study=study, checkTs=checkTs, full=full) for study in studies]
+    downloads = mapConcurrently(fetchPsData, queries)
+
+    for study, query, ps_data in zip(studies, queries, downloads):
+
+        # Unchanged entries are skipped, except on full reconciliation (see core.diffPayload)
+        reconcile = (full is True) or isPsReconcileDue(study=study, checkTs=checkTs)
+        entries = diffPayload(db=db, study=study, entries=ps_data, force=reconcile, merge=query['since'] is not None) # delta payloads are merged
+        if len(entries)>0:
+            updateParticipant(db=db, study=study, ps_data=entries)
 
-        ps_data = getPsData(study)
-        updateParticipant(db=db, study=study, ps_data=ps_data)
+        if prune and (query['since'] is None):
+            pruneParticipants(db=db, study=study, ids=[entry['id'] for entry in ps_data])
+
+        psylog.info('PS data processed; study:{}, mode:{}, entries:{}, changed:{}'.format(
+            study.name, 'full' if query['since'] is None else 'delta', len(ps_data), len(entries)))
 
         if save:
             filepath = getDataFilePath(study, source='ps', base_dir=base_dir)
             saveData(ps_data, filepath)
 
-        study.lastPsCheck=getUtcNow().isoformat()
+        setLastPsCheck(study=study, checkTs=checkTs, isFull=query['since'] is None)
 
         if delete_past is True:
             deletePastParticipant(db)
 
     psylog.info('updatePsData2Db finished OK')
 
-@db_session
 def updateSgData2Db(db, save=True, getAll=False):
-    """ Downloads SG data and updates DB """
+    """ Downloads SG data and updates DB; downloads run concurrently and are handed over to the serial DB updates as
+        pages arrive, at most config.SYNC_STREAM_BUFFER responses ahead per survey (see streamConcurrently).
+        Each SGUID batch is committed in its own db_session unless the caller holds one, so the ORM cache stays bounded """
 
     psylog.info('updateSgData2Db initalised')
 
     assert isinstance(save, bool)
     assert isinstance(getAll, bool)
 
-    for study in db.Study.select(lambda s: s.isActive is True).fetch():
+    with db_session:
+        refresh_schedules(db) # timepoints may have been reconciled by another process
 
-        if study.type.type=='stack':
-            alchemy_data = getSgData(study=study, getAll=getAll)
-            updateIsCompleteStack(db=db, study=study, alchemy_data=alchemy_data)
+        jobs = [] # (study, tp), tp is None for stack studies; only read after the session, sessions re-fetch them by id
+        for study in db.Study.select(lambda s: s.isActive is True).fetch():
 
-            if save:
-                filepath = getDataFilePath(study=study, source='sg')
-                saveData(ps_data, filepath)
+            if study.type.type=='stack':
+                jobs.append((study, None))
 
-        if study.type.type=='indep':
-            for tp in study.timepoints:
-                alchemy_data = getSgData(study=study, tp=tp, getAll=getAll)
-                updateIsCompleteIndep(db=db, tp=tp, alchemy_data=alchemy_data)
+            if study.type.type=='indep':
+                for tp in study.timepoints:
+                    jobs.append((study, tp))
 
-                if save:
-                    filepath = getDataFilePath(study=study, tp=tp, source='sg')
-                    saveData(ps_data, filepath)
+        checkTs = dt2ts(getUtcNow()) # taken before downloading, responses submitted during the sync are in the next delta
+        queries = [getSgQuery(study=study, tp=tp, getAll=getAll) for study, tp in jobs]
+        filepaths = [getDataFilePath(study=study, tp=tp, source='sg') if save else None for study, tp in jobs]
 
-    psylog.info('updateSgData2Db finished OK')
+    metas = [{} for query in queries] # page metadata, filled in by iterSgResponses
+    downloads = streamConcurrently(iterSgResponses, [dict(query, meta=meta) for query, meta in zip(queries, metas)])
 
-@db_session
-def sendNudges(db, isTest=False):
-    """ For all tps, collects Completion with .isNudge=True and then calls PS to send reminder email """
+    # Incremental downloads only hold responses submitted since the last check, idle runs have nothing to process
+    with contextlib.closing(downloads): # stops the downloads in flight if an update fails
+        for (study, tp), filepath, meta, responses in zip(jobs, filepaths, metas, downloads):
 
-    psylog.info('sendNudges initalised')
+            if save:
+                responses = iterSaveData(responses, filepath, meta=meta)
 
-    nudges=[]
-    for tp in db.Timepoint.select().fetch():
+            if study.type.type=='stack':
+                updateIsCompleteStack(db=db, study=study, alchemy_data=responses)
 
-        if tp.study.isActive is False:
-            continue
+            if study.type.type=='indep':
+                updateIsCompleteIndep(db=db, tp=tp, alchemy_data=responses)
 
-        comps    = db.Completion.select(lambda c: c.timepoint==tp).fetch()
-        user_ids = [comp.participant.id for comp in comps if comp.isNudge() is True]
+            with db_session: # after the updates, a survey which failed half way is downloaded again on the next run
+                setLastSgCheck(study=db.Study[study.id], tp=None if tp is None else db.Timepoint[tp.id], ts=checkTs)
 
-        if isTest:
-            nudges.append((tp.study, tp.psId, user_ids))
-            continue
+    psylog.info('updateSgData2Db finished OK')
 
-        for id in user_ids:
-            psylog.info('Nudge is called; study:{}, tp:{}, Id:{}'.format(tp.study.id, tp.psId, id))
+def mapConcurrently(func, kwargs_list, max_workers=None):
+    """ Calls func(**kwargs) for each kwargs on a thread pool of at most max_workers (default: config.SYNC_MAX_WORKERS).
+        Yields results in input order, so callers can apply them to the DB serially while later calls are in flight.
+        func must only take / return plain values, DB entities are bound to the calling thread """
+
+    max_workers = config.SYNC_MAX_WORKERS if max_workers is None else max_workers
+    assert isinstance(max_workers, int) and (max_workers>0)
+
+    if len(kwargs_list)==0:
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(kwargs_list))) as executor:
+        yield from executor.map(lambda kwargs: func(**kwargs), kwargs_list)
+
+def streamConcurrently(func, kwargs_list, max_workers=None, buffer=None): #Tested
+    """ As mapConcurrently for funcs returning iterables; yields an iterator per call, fed through a queue of at most buffer items """
+
+    max_workers = config.SYNC_MAX_WORKERS if max_workers is None else max_workers
+    buffer = config.SYNC_STREAM_BUFFER if buffer is None else buffer
+    assert isinstance(max_workers, int) and (max_workers>0)
+    assert isinstance(buffer, int) and (buffer>0)
+
+    if len(kwargs_list)==0:
+        return
+
+    end = object()
+    stopped = threading.Event() # set if the consumer stops early, producers blocked on a full queue give up
+    queues = [queue.Queue(maxsize=buffer) for kwargs in kwargs_list]
+
+    def put(items, item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce(items, kwargs):
+        try:
+            for item in func(**kwargs):
+                if not put(items, (item, None)):
+                    return
+        except Exception as exc:
+            put(items, (end, exc))
+        else:
+            put(items, (end, None))
+
+    def consume(items):
+        while True:
+            item, exc = items.get()
+            if item is end:
+                if exc is not None:
+                    raise exc
+                return
+            yield item
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(kwargs_list))) as executor:
+        try:
+            for items, kwargs in zip(queues, kwargs_list): # the pool starts calls in input order
+                executor.submit(produce, items, kwargs)
+            for items in queues: # callers consume each iterator before taking the next one
+                yield consume(items)
+        finally:
+            stopped.set()
 
-        ps_call = requests.post(
-            'https://dashboard-api.psychedelicsurvey.com/v2/studies/{}/timepoints/{}/send'.format(
-                tp.study.id,
-                tp.psId,
-                ),
-            json={
-                "subject" : "Reminder to complete missed survey",
-                "participants" : user_ids,
-                },
-            headers={
-                'ClientSecret' : ps_secret,
-                'ClientID' : ps_key,
-                },
-            )
+@db_session
+def sendNudges(db, isTest=False):
+    """ Queues the nudges due now into the Nudge outbox (see core.queueNudges) and delivers the outbox through the PS
+        API (see dispatch.drainOutbox). Returns the per-batch results of the delivery.
+        isTest: returns the (study, tp.psId, participant ids) to be nudged without queueing or sending anything """
 
-        assert ps_call.response_code==200
+    psylog.info('sendNudges initalised')
 
     if isTest:
+        nudges=[]
+        for tp in db.Timepoint.select().fetch():
+
+            if tp.study.isActive is False:
+                continue
+
+            nudges.append((tp.study, tp.psId, getNudgeIds(db=db, tp=tp)))
+
         return nudges
 
+    queueNudges(db)
+    results = dispatch.drainOutbox(db)
+
     psylog.info('sendNudges finished OK')
+    return results
+
+def runShards(filepath=os.path.join(base_dir, 'psynudge_db.sqlite'), jobs=SHARD_JOBS, max_workers=None, mock_db=False):
+    """ Sharded alternative of running the controllers on filepath (see db.get_shard_path): the catalog is reconciled
+        with the skeleton, then each active study's shard runs jobs in its own worker process (at most max_workers,
+        default config.SHARD_MAX_WORKERS), so a big study does not hold the write lock of the others.
+        A failing shard does not stop the others; returns {Study.id: None or the error} """
+
+    max_workers = config.SHARD_MAX_WORKERS if max_workers is None else max_workers
+    assert isinstance(max_workers, int) and (max_workers>0)
+
+    catalog = open_database(filepath=filepath, create_db=True, shard=CATALOG)
+    reconcile_skeleton(catalog, mock_db=mock_db)
+    with db_session:
+        studyIds = [study.id for study in catalog.Study.select(lambda s: s.isActive is True).order_by(lambda s: s.id)]
+    catalog.disconnect()
+
+    errors = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(runShard, filepath, studyId, jobs, mock_db): studyId for studyId in studyIds}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+                errors[futures[future]] = None
+            except Exception as exc:
+                psylog.exception('Shard failed; study:{}'.format(futures[future]))
+                errors[futures[future]] = exc
+
+    return errors
+
+def runShard(filepath, studyId, jobs=SHARD_JOBS, mock_db=False): #Imp tested
+    """ Runs jobs on the shard of studyId; entry point of the worker processes of runShards """
+
+    clients.closeSession() # HTTP connections inherited from the parent process are not shared
+
+    db = open_database(filepath=filepath, create_db=True, shard=studyId)
+    try:
+        reconcile_skeleton(db, mock_db=mock_db, studyIds=[studyId])
+        for name, kwargs in jobs:
+            globals()[name](db=db, **kwargs)
+    finally:
+        db.disconnect()
@@ -7,13 +7,15 @@ conda env export > environment.yml
 conda env create -f environment.yml
 """
 
-from surveygizmo import SurveyGizmo
-from .tokens import sg_key, sg_secret, ps_key, ps_secret
-from pony.orm import db_session, commit
+from pony.orm import db_session, commit, select
 from .mylogger import psylog
-from .mydt import *
+from .db import bulk_insert, TpSchedule, MAX_SQL_VARS
+from .jsonstream import iterJsonArray
+from . import config, clients
+from .mydt import getUtcNow, iso2utcdt, dt2ts, ts2iso
+import concurrent.futures
 import datetime
-import requests
+import hashlib
 import json
 import os
 
@@ -27,7 +29,12 @@ base_dir   = os.path.abspath(os.path.join(src_folder, os.pardir))
 """ Database functions """
 @db_session
 def updateParticipant(db, study, ps_file_path=None, ps_data=None): #Tested
-    """ Updates the database with new entries from PS JSON """
+    """ Updates the database with new entries from PS JSON
+
+        Existing participants in ps_data are prefetched with one query per MAX_SQL_VARS ids and new
+        Participant / Completion rows are inserted in batches, so the number of queries does not
+        grow with each entry and memory does not grow with the number of participants in the DB
+    """
 
     # Get data either from file or directly as a json
     if ps_data is None:
@@ -38,108 +45,167 @@ def updateParticipant(db, study, ps_file_path=None, ps_data=None): #Tested
     if ps_file_path is None:
         assert isinstance(ps_data, list)
 
+    # Study schedule, existing and archived participants are looked up once for the whole payload
+    schedule = study.getSchedule()
+    tpOffsets = [(tp.id, (tp.toStart, tp.toEnd, tp.toNudge)) for tp in schedule.tps]
+    maxTd = schedule.furthestTd
+    ids = list(set(entry['id'] for entry in ps_data))
+    known = {}
+    for idx in range(0, len(ids), MAX_SQL_VARS):
+        chunk = ids[idx:idx+MAX_SQL_VARS]
+        known.update((p.id, p) for p in db.Participant.select(lambda p: p.id in chunk)) # ids are unique across studies
+    seen = set(archivedIds(db, ids)) # finished participants PS keeps listing are not brought back
+
+    new_participants = []
+    new_completions = []
     for entry in ps_data:
 
-        # Check if participant already exists.
-        # If it does and has same start date, then continue, update Participant otherwise
-        id_match_ps = db.Participant.select(lambda p: p.id==entry['id']).fetch()
-        assert len(id_match_ps) in [0,1]
+        if entry['id'] in seen: # archived or duplicates of the same id within the payload
+            continue
+        seen.add(entry['id'])
 
         if ':' in str(entry['date']): # If ":" in string, then str is isoformat, if not, then unix seconds
             start_utc = iso2utcdt(entry['date'])
         else:
             start_utc = iso2utcdt(datetime.datetime.fromtimestamp(entry['date']).isoformat())
 
-        if len(id_match_ps)==1:
-            p = id_match_ps[0]
+        startTs = dt2ts(start_utc)
+        finishTs = dt2ts(start_utc + maxTd)
 
-            if p.whenStart == start_utc:
+        # If participant already exists and has same start date, then continue
+        # If start date changed, then move Participant and reset its Completions
+        # If listed under another study, then recreate it in this one
+        p = known.get(entry['id'])
+        if (p is not None) and (p.study!=study):
+            psylog.info('Moved participant: {}, from study:{}'.format(entry['id'], p.study.name))
+            p.delete() # Completions and Nudges go with it, flushed before the bulk inserts
+            p = None
+
+        if p is not None:
+            if p.whenStartTs == startTs:
                 continue
-            else:
-                p.delete()
 
-        # Get trial end date
-        maxTd = study.getFurthestTd()
-        participant = db.Participant(
-            id = entry['id'],
-            study = study,
-            whenStart  = start_utc.isoformat(),
-            whenFinish = (start_utc + maxTd).isoformat(),)
+            p.whenStartTs = startTs
+            p.whenFinishTs = finishTs
+            for completion in p.completions:
+                completion.isComplete = db.Completion.isComplete.default
+                completion.lastNudgeSendTs = db.Completion.lastNudgeSendTs.default
+                completion.refreshWindow()
+            psylog.info('Updated participant: {}'.format(entry['id']))
+            continue
+
+        new_participants.append((entry['id'], study.id, startTs, finishTs))
 
         # Create completion entries for participant
-        createCompletion(participant=participant, db=db)
-        psylog.info('Added/updated participant: {}'.format(entry['id']))
+        new_completions.extend([(
+            entry['id'],
+            tpId,
+            db.Completion.isComplete.default,
+            db.Completion.lastNudgeSendTs.default,
+            startTs + toStart,
+            startTs + toEnd,
+            startTs + toNudge) for tpId, (toStart, toEnd, toNudge) in tpOffsets])
+        psylog.info('Added participant: {}'.format(entry['id']))
+
+    bulk_insert(db, 'Participant', ['id', 'study', 'whenStartTs', 'whenFinishTs'], new_participants)
+    bulk_insert(db, 'Completion',
+        ['participant', 'timepoint', 'isComplete', 'lastNudgeSendTs', 'whenStartTpTs', 'whenEndTpTs', 'whenEndNudgeTs'],
+        new_completions)
 
-@db_session
 def updateIsCompleteIndep(db, tp, alchemy_file_path=None, alchemy_data=None): #Tested
-    """ Updates the database with the new completions from Alchemer JSON for independent studies """
+    """ Updates the database with the new completions from Alchemer JSON for independent studies;
+        each SGUID batch runs in its own db_session unless the caller holds one, see updateIsCompleteBatch """
 
-    assert tp.study.type.type=='indep'
+    with db_session:
+        tp = db.Timepoint[tp.id] # tp may belong to a session which is over
+        assert tp.study.type.type=='indep'
+        studyName, tps = tp.study.name, [TpSchedule(tp)]
 
-    # Get data either from file or directly as a json
-    if alchemy_data is None:
-        assert isinstance(alchemy_file_path, str)
-        with open(alchemy_file_path, 'r') as j:
-            alchemy_data = json.loads(j.read())
+    # Get data either from file (streamed) or directly as a json / iterable of responses
+    responses = iterResponses(alchemy_file_path=alchemy_file_path, alchemy_data=alchemy_data)
 
-    if alchemy_file_path is None:
-        assert isinstance(alchemy_data, dict)
+    evaluator = getCompletionEvaluator(tps=tps)
+    for batch in iterSguidBatches(responses, surveyId=tps[0].surveyId):
+        updateIsCompleteBatch(db, batch=batch, tps=tps, evaluator=evaluator, studyName=studyName)
 
-    for response in alchemy_data['data']:
+def updateIsCompleteStack(db, study, alchemy_file_path=None, alchemy_data=None): #Tested
+    """ Updates the database with the new completions from Alchemer JSON for stacked studies;
+        each SGUID batch runs in its own db_session unless the caller holds one, see updateIsCompleteBatch """
 
-        id = getResponseSguid(response)
-        if id is None:
-            continue
+    with db_session:
+        study = db.Study[study.id] # study may belong to a session which is over
+        assert study.type.type=='stack'
+        studyName, tps = study.name, study.getSchedule().tps
 
-        isComplete = assessIsComplete(response=response, tp=tp)
+    # Get data either from file (streamed) or directly as a json / iterable of responses
+    responses = iterResponses(alchemy_file_path=alchemy_file_path, alchemy_data=alchemy_data)
 
-        completion = db.Completion.select(lambda c:
-            c.participant.id==id and
-            c.timepoint==tp).fetch()
+    evaluator = getCompletionEvaluator(tps=tps)
+    surveyId = tps[0].surveyId if len(tps)>0 else None # all tps of a stack study share the survey
+    for batch in iterSguidBatches(responses, surveyId=surveyId):
+        updateIsCompleteBatch(db, batch=batch, tps=tps, evaluator=evaluator, studyName=studyName)
 
-        #if len(completion)!=1: # TODO: why not assert?!?!?!?!
-        #    continue
+@db_session
+def updateIsCompleteBatch(db, batch, tps, evaluator, studyName): #Imp tested
+    """ Writes the isComplete of tps (TpSchedules) for a batch of (SGUID, response) tuples; called outside of a
+        db_session, the batch is committed and its entities leave the cache, so memory does not grow with the survey """
 
-        assert len(completion) in [0,1]
-        completion[0].isComplete = isComplete
-        psylog.info('Added completion; study:{}, tp:{}, id:{}'.format(tp.study.name, tp.name, id))
+    completions = getCompletionMap(db, sguids=[id for id, response in batch], tps=tps)
+    for id, response in batch:
+        for tp, isComplete in zip(tps, evaluator(response)):
 
-@db_session
-def updateIsCompleteStack(db, study, alchemy_file_path=None, alchemy_data=None): #Tested
-    """ Updates the database with the new completions from Alchemer JSON for stacked studies """
+            completion = completions.get((id, tp.id))
+            if (completion is None) or (completion.isComplete==isComplete): # only changed rows are written
+                continue
 
-    assert study.type.type=='stack'
+            completion.isComplete = isComplete
+            psylog.info('Added completion; study:{}, tp:{}, id:{}'.format(studyName, tp.name, id))
+
+def iterResponses(alchemy_file_path=None, alchemy_data=None): #Imp tested
+    """ Yields Alchemer responses one at a time; files are parsed incrementally, alchemy_data is either the parsed
+        export (dict) or an iterable of responses (e.g. jsonstream.iterJsonArray over an HTTP body) """
 
-    # Get data either from file or directly as a json
     if alchemy_data is None:
         assert isinstance(alchemy_file_path, str)
         with open(alchemy_file_path, 'r') as j:
-            alchemy_data = json.loads(j.read())
+            yield from iterJsonArray(j, key='data')
+        return
+
+    if isinstance(alchemy_data, dict):
+        yield from alchemy_data['data']
+    else:
+        yield from alchemy_data
 
-    if alchemy_file_path is None:
-        assert isinstance(alchemy_data, dict)
+def iterSguidBatches(responses, surveyId=None, batch_size=MAX_SQL_VARS): #Imp tested
+    """ Yields lists of (SGUID, response) tuples from responses, responses without SGUID are skipped """
 
-    # Update data file
-    for response in alchemy_data['data']:
+    batch = []
+    for response in responses:
 
-        id = getResponseSguid(response)
+        id = getResponseSguid(response, surveyId=surveyId)
         if id is None:
             continue
 
-        for tp in study.timepoints:
+        batch.append((id, response))
+        if len(batch)==batch_size:
+            yield batch
+            batch = []
 
-            isComplete = assessIsComplete(response=response, tp=tp)
+    if len(batch)>0:
+        yield batch
 
-            completion = db.Completion.select(lambda c:
-                c.participant.id==id and
-                c.timepoint==tp).fetch()
+def getCompletionMap(db, sguids, tps): #Imp tested
+    """ Returns {(participant id, timepoint id): Completion} for all sguids and tps with one query per MAX_SQL_VARS sguids """
 
-            if len(completion)!=1:
-                continue
-            #assert len(completion) in [0,1]
+    tpIds = [tp.id for tp in tps]
+    completions = {}
+
+    for idx in range(0, len(sguids), MAX_SQL_VARS):
+        chunk = sguids[idx:idx+MAX_SQL_VARS]
+        for completion in db.Completion.select(lambda c: c.participant.id in chunk and c.timepoint.id in tpIds):
+            completions[(completion.participant.id, completion.timepoint.id)] = completion
 
-            completion[0].isComplete = isComplete
-            psylog.info('Added completion; study:{}, tp:{}, id:{}'.format(study.name, tp.name, id))
+    return completions
 
 def assessIsComplete(response, tp): #Imp tested
     """ Decides whether timepoint is completed """
@@ -160,47 +226,190 @@ def assessIsComplete(response, tp): #Imp tested
     assert isinstance(isComplete, bool)
     return isComplete
 
+def getCompletionEvaluator(tps): #Tested
+    """ Returns function mapping a response to the isComplete vector of tps;
+        QIDs are resolved once per study, answered QIDs once per response """
+
+    qids = [(str(tp.firstQID), str(tp.lastQID)) for tp in tps]
+
+    def evaluator(response):
+        answered = {qid for qid, question in response['survey_data'].items() if 'answer' in question} # answer key exists iff answer was given
+        return [(firstQID in answered) and (lastQID in answered) for firstQID, lastQID in qids]
+
+    return evaluator
+
 def createCompletion(db, participant): #Imp tested
     """ Creates all Completion entries in db from participant """
 
     for tp in participant.study.timepoints:
-        db.Completion(
+        completion = db.Completion(
             participant = participant,
             timepoint = tp)
+        completion.refreshWindow()
+
+@db_session
+def getNudgeIds(db, tp): #Tested
+    """ Returns ids of participants to be nudged for tp; same conditions as Completion.isNudge(), but evaluated in SQLite """
+
+    tpId = tp.id
+    now  = dt2ts(getUtcNow())
+    lastNudgeLimit = getLastNudgeLimit(now)
+
+    return db.select("""SELECT c.participant
+        FROM Completion c
+        WHERE c.timepoint = $tpId
+            AND {}
+        ORDER BY c.participant""".format(nudgeConditions))
 
 @db_session
-def deletePastParticipant(db): #Tested
-    """ delete participants (and belonging Completion entities) where isActive=False """
+def queueNudges(db): #Tested
+    """ Writes all nudges due now (see getNudgeIds) of active studies into the Nudge outbox with one statement;
+        completions that already have a pending nudge are skipped. Returns the number of queued nudges """
+
+    now  = dt2ts(getUtcNow())
+    lastNudgeLimit = getLastNudgeLimit(now)
+
+    cursor = db.execute("""INSERT INTO Nudge (completion, queuedTs, attempts, lastError)
+        SELECT c.id, $now, 0, ''
+        FROM Completion c
+            JOIN Timepoint tp ON tp.id = c.timepoint
+            JOIN Study s ON s.id = tp.study
+        WHERE s.isActive = 1
+            AND {}
+            AND NOT EXISTS (SELECT 1 FROM Nudge n WHERE n.completion = c.id AND n.sentTs IS NULL)""".format(nudgeConditions))
+
+    queued = cursor.rowcount
+    commit()
+    db._get_cache().query_results.clear()
+
+    psylog.info('Nudges queued: {}'.format(queued))
+    return queued
+
+def getLastNudgeLimit(now):
+    """ Nudges sent before the returned epoch are old enough for a new nudge """
+    return now - int(0.985*86400) # same error tolerance as in Completion.isNudgeTimely
+
+nudgeConditions = """c.whenEndNudgeTs >= $now
+            AND c.whenEndTpTs <= $now
+            AND c.isComplete = 0
+            AND c.lastNudgeSendTs < $lastNudgeLimit"""
+
+def archivedIds(db, ids): #Imp tested
+    """ Returns the ids in ids that are in ParticipantArchive, with one query per MAX_SQL_VARS ids """
 
-    now = getUtcNow()
-    for participant in db.Participant.select().fetch():
-        if iso2utcdt(participant.whenFinish) < now:
-            participant.delete()
+    archived = []
+    for idx in range(0, len(ids), MAX_SQL_VARS):
+        chunk = ids[idx:idx+MAX_SQL_VARS]
+        archived.extend(select(a.id for a in db.ParticipantArchive if a.id in chunk))
+
+    return archived
+
+def pruneParticipants(db, study, ids): #Tested
+    """ Deletes participants (and their Completions) of study whose id is not in ids, i.e. who are no longer listed by PS """
+
+    keep = set(ids)
+    stale = [id for id in select(p.id for p in db.Participant if p.study==study) if id not in keep]
+
+    for idx in range(0, len(stale), MAX_SQL_VARS):
+        chunk = stale[idx:idx+MAX_SQL_VARS]
+        db.Participant.select(lambda p: p.id in chunk).delete()
+
+    if len(stale)>0:
+        psylog.info('Participants pruned; study:{}, n:{}'.format(study.name, len(stale)))
+
+    return len(stale)
+
+@db_session
+def deletePastParticipant(db, archive=True): #Tested
+    """ Copies participants past their last timepoint (whenFinish < now) and their Completions to ParticipantArchive /
+        CompletionArchive (if archive), then deletes them with their Completions and Nudges; at most three set-based statements
+        in one transaction, whatever the number of participants. Returns the number of participants removed """
+
+    now = dt2ts(getUtcNow())
+    past = 'SELECT id FROM Participant WHERE whenFinishTs < $now'
+    db.flush()
+
+    if archive is True:
+        db.execute("""INSERT OR REPLACE INTO ParticipantArchive (id, study, whenStartTs, whenFinishTs, archivedTs)
+            SELECT id, study, whenStartTs, whenFinishTs, $now FROM Participant WHERE whenFinishTs < $now""")
+        db.execute("""INSERT OR REPLACE INTO CompletionArchive (participant, timepoint, completion, isComplete, lastNudgeSendTs,
+                whenStartTpTs, whenEndTpTs, whenEndNudgeTs, nudgesSent)
+            SELECT c.participant, c.timepoint, c.id, c.isComplete, c.lastNudgeSendTs, c.whenStartTpTs, c.whenEndTpTs,
+                c.whenEndNudgeTs, (SELECT count(*) FROM Nudge n WHERE n.completion = c.id AND n.sentTs IS NOT NULL)
+            FROM Completion c
+            WHERE c.participant IN ({})""".format(past))
+
+    # Completions and Nudges go with ON DELETE CASCADE (Pony connects with PRAGMA foreign_keys = ON)
+    n_deleted = db.execute('DELETE FROM Participant WHERE whenFinishTs < $now').rowcount
 
     commit()
+    db._get_cache().query_results.clear()
+
+    if n_deleted>0:
+        psylog.info('Past participants {}; n:{}'.format('archived' if archive else 'deleted', n_deleted))
+
+    return n_deleted
 
 
 """ Data acess and archieve """
-def getPsData(study, base_dir=base_dir): #Imp tested
-    """ Updates participant info from PS """
+def getPsData(study, base_dir=base_dir, full=None): #Imp tested
+    """ Updates participant info from PS; downloads only the changes since the last check, see getPsQuery """
+
+    checkTs = dt2ts(getUtcNow())
+    query = getPsQuery(study=study, checkTs=checkTs, full=full)
+    ps_data = fetchPsData(**query)
+    setLastPsCheck(study=study, checkTs=checkTs, isFull=query['since'] is None)
+    return ps_data
+
+def getPsQuery(study, checkTs, full=None): #Tested
+    """ Returns the plain arguments of fetchPsData. Downloads are deltas since the last check (less PS_DELTA_OVERLAP),
+        unless full is True, delta sync is disabled (PS_DELTA_PARAM is None) or the last full download is older than
+        PS_FULL_SYNC_INTERVAL; the periodic full download reconciles anything a delta may have missed """
 
-    response = requests.get('https://dashboard-api.psychedelicsurvey.com/v2/studies/{}/participants'.format(study.id),
-     headers={
-        'ClientSecret': ps_secret,
-        'ClientID': ps_key,
-         }
-    )
+    if full is None:
+        full = (config.PS_DELTA_PARAM is None) or isPsReconcileDue(study=study, checkTs=checkTs)
+
+    assert isinstance(full, bool)
+    since = None if full else ts2iso(study.lastPsCheckTs-config.PS_DELTA_OVERLAP)
+    return {'studyId': study.id, 'since': since}
+
+def isPsReconcileDue(study, checkTs): #Imp tested
+    """ True if the last full PS download is older than PS_FULL_SYNC_INTERVAL """
+    return checkTs-study.lastPsFullCheckTs >= config.PS_FULL_SYNC_INTERVAL
+
+def setLastPsCheck(study, checkTs, isFull): #Imp tested
+    """ Records a PS download started at checkTs """
+
+    study.lastPsCheckTs = checkTs
+    if isFull:
+        study.lastPsFullCheckTs = checkTs
+
+def fetchPsData(studyId, since=None): #Imp tested
+    """ Downloads participants of a study (created or changed after since, if given) from PS;
+        network only, safe to call from worker threads """
+
+    params = {} if since is None else {config.PS_DELTA_PARAM: since}
+    response = clients.psRequest('GET', 'studies/{}/participants'.format(studyId), params=params)
 
     assert response.status_code==200
-    study.lastPsCheck = getUtcNow().isoformat()
     return response.json()
 
 def getSgData(study, tp=None, getAll=False): #Imp tested
     """ Download SG data save """
 
+    checkTs = dt2ts(getUtcNow()) # taken before downloading, responses submitted meanwhile are in the next download
+    sg_data = fetchSgData(**getSgQuery(study=study, tp=tp, getAll=getAll))
+    setLastSgCheck(study=study, tp=tp, ts=checkTs)
+
+    #psylog.info('SG data downloaded, study:{}, tp{}:.'.format(study.name, tp.name))
+    return sg_data
+
+def getSgQuery(study, tp=None, getAll=False): #Imp tested
+    """ Returns the plain arguments of fetchSgData for a study (stack) or timepoint (indep) """
+
     if tp is None:
         assert study.type.type=='stack'
-        tp = study.timepoints.select().first() # for stack stuides all tps have same Id
+        tp = study.getFirstTp() # for stack stuides all tps have same Id
 
     if study.type.type=='indep':
         assert tp is not None
@@ -209,39 +418,81 @@ def getSgData(study, tp=None, getAll=False): #Imp tested
     assert isinstance(getAll, bool)
     assert isinstance(lastSgCheck, str)
 
-    client = SurveyGizmo(api_version='v5',
-                         response_type='json',
-                         api_token = sg_key,
-                         api_token_secret = sg_secret)
-
-    client.config.base_url = 'https://restapi.surveygizmo.eu/'
+    return {'surveyId': tp.surveyId, 'lastSgCheck': None if getAll else lastSgCheck}
 
-    # Download data
-    if getAll is True:
-        temp = client.api.surveyresponse.resultsperpage(value=100000).list(tp.surveyId)
+def setLastSgCheck(study, tp=None, ts=None): #Imp tested
+    """ Updates lastSgCheck of all tps of stack studies or of the given tp of indep studies """
 
-    if getAll is False:
-        temp = client.api.surveyresponse.filter(
-            field    = 'date_submitted',
-            operator = '>',
-            value    = lastSgCheck).resultsperpage(value=100000).list(tp.surveyId)
+    assert isinstance(ts, int)
 
-    sg_data = json.loads(temp)
-    assert sg_data['total_pages'] in [0,1]
-    assert sg_data['result_ok'] is True
-
-    # update lastSgCheck
-    utcNowStr=getUtcNow().isoformat()
     if study.type.type=='stack':
         for tp in study.timepoints:
-            tp.lastSgCheck = utcNowStr
+            tp.lastSgCheckTs = ts
 
     if study.type.type=='indep':
-        tp.lastSgCheck = utcNowStr
+        tp.lastSgCheckTs = ts
 
-    #psylog.info('SG data downloaded, study:{}, tp{}:.'.format(study.name, tp.name))
+def fetchSgData(surveyId, lastSgCheck=None): #Imp tested
+    """ Downloads SG responses into a single export-like dict; network only, safe to call from worker threads.
+        Holds the whole download in memory, syncs stream it instead (see controllers.updateSgData2Db) """
+
+    sg_data = {}
+    sg_data['data'] = list(iterSgResponses(surveyId=surveyId, lastSgCheck=lastSgCheck, meta=sg_data))
+    assert sg_data['result_ok'] is True
     return sg_data
 
+def iterSgResponses(surveyId, lastSgCheck=None, meta=None, page_size=None, max_workers=None): #Tested
+    """ Yields responses of an SG survey submitted after lastSgCheck (all if None). Pages after the first are downloaded
+        concurrently, at most max_workers at a time, and yielded as they arrive. Merged page metadata is stored in meta """
+
+    page_size = config.SG_PAGE_SIZE if page_size is None else page_size
+    max_workers = config.SG_MAX_CONCURRENT_PAGES if max_workers is None else max_workers
+    assert isinstance(page_size, int) and (page_size>0)
+    assert isinstance(max_workers, int) and (max_workers>0)
+
+    resource = clients.getSgClient().api.surveyresponse
+    if lastSgCheck is not None:
+        resource = resource.filter(field='date_submitted', operator='>', value=lastSgCheck)
+    resource = resource.resultsperpage(value=page_size)
+
+    def getPage(page): # runs in worker threads, must not touch DB entities
+        sg_page = clients.sgList(resource.page(value=page), surveyId)
+        assert sg_page['result_ok'] is True
+        return sg_page
+
+    first_page = getPage(1)
+    merged = {
+        'result_ok': True,
+        'total_count': first_page['total_count'],
+        'total_pages': first_page['total_pages'],
+        'page': 1,
+        'results_per_page': page_size,}
+
+    if meta is not None:
+        meta.update(merged)
+
+    n_responses = len(first_page['data'])
+    yield from first_page['data']
+    del first_page
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+        pending, next_page = set(), 2
+        while (len(pending)>0) or (next_page<=merged['total_pages']):
+
+            while (len(pending)<max_workers) and (next_page<=merged['total_pages']):
+                pending.add(executor.submit(getPage, next_page))
+                next_page += 1
+
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                sg_page = future.result()
+                n_responses += len(sg_page['data'])
+                yield from sg_page['data']
+
+    if not n_responses==merged['total_count']: # responses submitted while paging shift page boundaries
+        psylog.warning('SG survey {}: expected {} responses, got {}'.format(surveyId, merged['total_count'], n_responses))
+
 def getDataFilePath(study, tp=None, source=None, base_dir=base_dir): #Tested
     """ Return the intended filepath when data files are saved """
 
@@ -261,7 +512,7 @@ def getDataFilePath(study, tp=None, source=None, base_dir=base_dir): #Tested
             study.name,
             'sg',
             'stack',
-            study.timepoints.select().first().lastSgCheck[:-6],
+            study.getFirstTp().lastSgCheck[:-6],
             getUtcNow().isoformat()[:-6]
             ))
 
@@ -281,21 +532,71 @@ def saveData(data, filepath): #Imp tested
     with open(filepath, 'w+') as file:
         json.dump(data, file)
 
-def getResponseSguid(response): #Tested
-    """ Returns SGUID of a response. The SGUID can be recorded either as hidden or URL variable, code checks both """
+def iterSaveData(responses, filepath, meta=None): #Tested
+    """ Yields responses while saving them locally as an export-like JSON ({"data": [...], **meta}), so saving does
+        not hold the download in memory; meta is written once responses are exhausted """
+
+    with open(filepath, 'w+') as file:
+        file.write('{"data": [')
+        for idx, response in enumerate(responses):
+            if idx>0:
+                file.write(', ')
+            json.dump(response, file)
+            yield response
+
+        file.write(']')
+        for key, value in (meta or {}).items():
+            file.write(', {}: {}'.format(json.dumps(key), json.dumps(value)))
+        file.write('}')
+
+def diffPayload(db, study, entries, force=False, merge=False): #Tested
+    """ Returns the new / changed entries of a PS payload against the study's Digest ([] if identical, all if force) """
+
+    entries = list(entries)
+
+    payload = getDigest(entries)
+    digest = db.Digest.select(lambda d: d.study==study).first()
+    if (digest is not None) and (digest.payload==payload) and (not force):
+        return []
+
+    old = json.loads(digest.entries) if (digest is not None) and digest.entries else {}
+    new = dict(old) if merge else {}
+
+    changed = []
+    for entry in entries:
+        id, entryDigest = str(entry['id']), getDigest(entry)
+        new[id] = entryDigest
+        if force or (old.get(id)!=entryDigest):
+            changed.append(entry)
+
+    if digest is None:
+        digest = db.Digest(study=study, payload=payload, updatedTs=0)
+
+    digest.payload = payload
+    digest.entries = json.dumps(new, separators=(',', ':'))
+    digest.updatedTs = dt2ts(getUtcNow())
+
+    return changed
+
+def getDigest(data):
+    """ Digest of JSON serializable data, independent of key order """
+    return hashlib.sha1(json.dumps(data, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()[:16]
+
+def getResponseSguid(response, surveyId=None): #Tested
+    """ Returns SGUID of a response. The SGUID can be recorded either as hidden or URL variable, code checks both.
+        If surveyId is given, the QIDs of the hidden SGUID question are looked up in / stored to sguidQids """
 
     sguid_url    = None
     sguid_hidden = None
 
-    for key, value in response['survey_data'].items():
-        if value['question']=='Capture SGUID':
-            if value['shown'] is True:
-                sguid_hidden = value['answer']
+    for qid in getSguidQids(response, surveyId):
+        value = response['survey_data'][qid]
+        if value['shown'] is True:
+            sguid_hidden = value['answer']
 
-    try:
-        sguid_url = response['url_variables']['sguid']['value']
-    except:
-        pass
+    url_variables = response.get('url_variables')
+    if isinstance(url_variables, dict) and isinstance(url_variables.get('sguid'), dict): # empty url_variables is exported as []
+        sguid_url = url_variables['sguid'].get('value')
 
     if isinstance(sguid_url, str) and isinstance(sguid_hidden, str):
         assert(sguid_url==sguid_hidden)
@@ -307,6 +608,23 @@ def getResponseSguid(response): #Tested
     elif sguid_url is None and sguid_hidden is None:
         assert False
 
+def getSguidQids(response, surveyId=None): #Imp tested
+    """ Returns QIDs of the 'Capture SGUID' questions; survey_data is only scanned if the cached QIDs of surveyId are missing """
+
+    survey_data = response['survey_data']
+
+    qids = sguidQids.get(surveyId)
+    if (qids is not None) and all(qid in survey_data for qid in qids):
+        return qids
+
+    qids = tuple(key for key, value in survey_data.items() if value['question']=='Capture SGUID')
+    if surveyId is not None:
+        sguidQids[surveyId] = qids
+
+    return qids
+
+sguidQids = {} # surveyId -> QIDs of the hidden SGUID question
+
 
 """ Cron run check """
 def scheduleTester():
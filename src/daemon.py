@@ -0,0 +1,130 @@
+"""
+:Author: Balazs Szigeti <b.islander@protonmail.com>
+:Copyright: 2021, DrugNerdsLab
+:License: MIT
+
+Resident scheduler replacing the cron entry points: the database is opened (migrated, mapped) once and the HTTP
+pool of clients.py stays warm between runs. Runs of the same job never overlap; a run that is still going when
+the job is due again is skipped, different jobs run in parallel
+
+python run_daemon.py
+"""
+
+from .db import open_database, base_dir
+from .mylogger import psylog
+from . import config, clients, controllers
+import concurrent.futures
+import threading
+import signal
+import time
+import os
+
+
+class Job():
+    """ func(**kwargs) run every interval seconds; the lock keeps runs of the job from overlapping """
+
+    def __init__(self, name, func, interval, kwargs=None, delay=0, lock=None):
+
+        assert isinstance(interval, (int, float)) and (interval>0)
+
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.kwargs = {} if kwargs is None else kwargs
+        self.nextRun = time.monotonic()+delay
+        self.lock = threading.Lock() if lock is None else lock # shared by jobs which must not overlap each other
+        self.runs = 0
+        self.skipped = 0
+        self.failures = 0
+
+    def isDue(self, now):
+        return now >= self.nextRun
+
+    def run(self):
+        """ Runs the job unless a previous run is still going; returns False if skipped """
+
+        if not self.lock.acquire(blocking=False):
+            self.skipped += 1
+            psylog.warning('Job {} skipped, previous run still going'.format(self.name))
+            return False
+
+        try:
+            start = time.perf_counter()
+            self.func(**self.kwargs)
+            psylog.info('Job {} finished in {:.2f}s'.format(self.name, time.perf_counter()-start))
+        except Exception:
+            self.failures += 1
+            psylog.exception('Job {} failed'.format(self.name))
+        finally:
+            self.runs += 1
+            self.lock.release()
+
+        return True
+
+
+class Scheduler():
+    """ Runs due jobs on a thread pool until stop() is called """
+
+    def __init__(self, jobs, tick=1):
+
+        self.jobs = jobs
+        self.tick = tick
+        self.stopped = threading.Event()
+
+    def stop(self, *args):
+        self.stopped.set()
+
+    def run(self):
+
+        psylog.info('Scheduler started; jobs:{}'.format(', '.join(job.name for job in self.jobs)))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.jobs)) as executor:
+            while not self.stopped.is_set():
+
+                now = time.monotonic()
+                for job in self.jobs:
+                    if not job.isDue(now):
+                        continue
+
+                    job.nextRun = now+job.interval
+                    if job.lock.locked(): # previous run (or a job sharing the lock) still going, do not queue another one behind it
+                        job.skipped += 1
+                        psylog.warning('Job {} skipped, previous run still going'.format(job.name))
+                        continue
+
+                    executor.submit(job.run)
+
+                nextRun = min(job.nextRun for job in self.jobs)
+                self.stopped.wait(timeout=max(0, min(self.tick, nextRun-time.monotonic())))
+
+        psylog.info('Scheduler stopped')
+
+def getJobs(db, mock_db=False): #Imp tested
+    """ Reconciliation, PS sync, SG sync and nudging on the intervals of config.DAEMON_* ; payloads are not saved to data/.
+        Reconciliation runs on db, so the Timepoint hooks drop the cached schedules; it does not overlap the PS sync """
+
+    psJob = Job('updatePsData2Db', controllers.updatePsData2Db, config.DAEMON_PS_INTERVAL, kwargs={'db': db, 'save': False})
+
+    return [
+        Job('reconcileDatabase', controllers.reconcileDatabase, config.DAEMON_RECONCILE_INTERVAL,
+            kwargs={'db': db, 'mock_db': mock_db}, lock=psJob.lock),
+        psJob,
+        Job('updateSgData2Db', controllers.updateSgData2Db, config.DAEMON_SG_INTERVAL, kwargs={'db': db, 'save': False}),
+        Job('sendNudges', controllers.sendNudges, config.DAEMON_NUDGE_INTERVAL, kwargs={'db': db},
+            delay=config.DAEMON_NUDGE_DELAY),]
+
+def run(filepath=os.path.join(base_dir, 'psynudge_db.sqlite')): #Imp tested
+    """ Opens the database once and runs the jobs until SIGINT / SIGTERM """
+
+    db = open_database(filepath=filepath, create_db=False)
+    clients.getSession()
+
+    scheduler = Scheduler(getJobs(db))
+    signal.signal(signal.SIGTERM, scheduler.stop)
+    signal.signal(signal.SIGINT, scheduler.stop)
+
+    try:
+        scheduler.run()
+    finally:
+        clients.closeSession()
+        db.disconnect()
@@ -5,111 +5,384 @@ Define sqlite DB structure which represents teh studies and surveys
 :License: MIT
 """
 
-from pony.orm import *
-from .mydt import *
+from pony.orm import Database, PrimaryKey, Required, Optional, Set, LongStr, composite_index, db_session, flush
+from .mylogger import psylog
+from . import config
+from .mydt import getUtcNow, isWithinTimeWindow, iso2ts, ts2iso, ts2utcdt, dt2ts
 import datetime
+import sqlite3
 import os
 
 
 src_folder = os.path.dirname(os.path.abspath(__file__))
 base_dir   = os.path.abspath(os.path.join(src_folder, os.pardir))
 
-def open_database(filepath=os.path.join(base_dir, 'psynudge_db.sqlite'), create_db=False):
-    """ Returns existing database"""
+DEFAULT_TS = 1577836800 # 2020-01-01T00:00:00+00:00, default of all last check / nudge timestamps
+SCHEMA_VERSION = 7 # stored in PRAGMA user_version, see migrate_database
+MAX_SQL_VARS = 900 # max number of parameters in a single query, SQLite < 3.32 allows 999
+CATALOG = 'catalog' # shard of the catalog database, see get_shard_path
+
+def open_database(filepath=os.path.join(base_dir, 'psynudge_db.sqlite'), create_db=False, profile=None, shard=None):
+    """ Returns existing database; profile (name in config.SQLITE_PROFILES or dict of PRAGMAs, default
+        config.SQLITE_PROFILE) is applied on every connection.
+        shard: open a file of the sharded layout of filepath instead (see get_shard_path), a Study.id or CATALOG """
+
+    if shard is not None:
+        filepath = get_shard_path(filepath, shard)
+        if create_db:
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+
+    if os.path.isfile(filepath):
+        migrate_database(filepath)
 
     db = Database()
     define_db_entities(db)
+    set_profile(db, profile)
     db.bind(provider='sqlite', filename=filepath, create_db=create_db)
     db.generate_mapping(create_tables=True)
+
+    with db_session:
+        db.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+
     return db
 
+def get_shard_path(filepath, shard): #Tested
+    """ Sharded layout of filepath: one file per study with the full schema, holding that study only, and a catalog
+        with the skeleton of all studies, e.g. psynudge_db_shards/<Study.id>.sqlite, psynudge_db_shards/catalog.sqlite """
+
+    assert isinstance(shard, str) and (len(shard)>0) and (os.sep not in shard) and (not shard.startswith('.'))
+    return os.path.join(os.path.splitext(filepath)[0]+'_shards', '{}.sqlite'.format(shard))
+
+def query_shards(filepath, sql, params=None): #Tested
+    """ Global view over the study shards of filepath: runs sql on every shard listed in the catalog, attached to one
+        connection SQLITE_MAX_ATTACHED at a time, and returns all rows. {db} in sql is replaced by the schema of the
+        shard, e.g. 'SELECT study, count(*) FROM {db}.Participant GROUP BY study'; params are named (:name) """
+
+    catalog = sqlite3.connect(get_shard_path(filepath, CATALOG), timeout=30)
+    try:
+        studyIds = [row[0] for row in catalog.execute('SELECT id FROM Study ORDER BY id')]
+        paths = [path for path in (get_shard_path(filepath, studyId) for studyId in studyIds) if os.path.isfile(path)]
+
+        rows = []
+        for idx in range(0, len(paths), config.SQLITE_MAX_ATTACHED):
+            schemas = []
+            for path in paths[idx:idx+config.SQLITE_MAX_ATTACHED]:
+                schemas.append('shard{}'.format(len(schemas)))
+                catalog.execute('ATTACH DATABASE ? AS {}'.format(schemas[-1]), (path,))
+            try:
+                union = ' UNION ALL '.join('SELECT * FROM ({})'.format(sql.format(db=schema)) for schema in schemas)
+                rows.extend(catalog.execute(union, params or {}).fetchall())
+            finally:
+                for schema in schemas:
+                    catalog.execute('DETACH DATABASE {}'.format(schema))
+
+        return rows
+    finally:
+        catalog.close()
+
+def set_profile(db, profile=None): #Tested
+    """ Registers the PRAGMAs of profile to be run on each new connection of db """
+
+    profile = config.SQLITE_PROFILE if profile is None else profile
+    pragmas = config.SQLITE_PROFILES[profile] if isinstance(profile, str) else profile
+    assert isinstance(pragmas, dict)
+
+    @db.on_connect(provider='sqlite')
+    def apply_profile(db, connection):
+        cursor = connection.cursor()
+        for pragma, value in pragmas.items():
+            cursor.execute('PRAGMA {} = {}'.format(pragma, value))
+
+def migrate_database(filepath): #Tested
+    """ Migrates the schema of an existing sqlite file in place to SCHEMA_VERSION """
+
+    con = sqlite3.connect(filepath, isolation_level=None)
+    try:
+        version = con.execute('PRAGMA user_version').fetchone()[0]
+        hasTables = con.execute("SELECT count(*) FROM sqlite_master WHERE type='table' AND name='Study'").fetchone()[0]==1
+        if not hasTables: # new file, tables are created by Pony
+            return
+
+        con.execute('PRAGMA foreign_keys = OFF') # tables are recreated during migration, no-op within transaction
+        for from_version in range(version, SCHEMA_VERSION):
+            con.execute('BEGIN IMMEDIATE')
+            try:
+                migrations[from_version](con)
+                con.execute('PRAGMA user_version = {}'.format(from_version+1))
+                con.execute('COMMIT')
+            except:
+                con.execute('ROLLBACK')
+                raise
+            psylog.info('Migrated DB {} from schema version {} to {}'.format(filepath, from_version, from_version+1))
+    finally:
+        con.close()
+
+def bulk_insert(db, table, columns, rows, batch_size=1000):
+    """ Inserts rows (list of tuples ordered as columns) into table with one executemany per batch
+
+        Bypasses the ORM identity map, so it must be called within a db_session and the inserted
+        rows are only visible through subsequent queries, not through already loaded entities
+    """
+
+    if len(rows)==0:
+        return
+
+    db.flush() # pending ORM changes have to hit the DB before the raw inserts
+    sql = 'INSERT INTO "{}" ({}) VALUES ({})'.format(
+        table,
+        ', '.join('"{}"'.format(column) for column in columns),
+        ', '.join('?' for column in columns))
+
+    connection = db.get_connection()
+    for idx in range(0, len(rows), batch_size):
+        connection.executemany(sql, rows[idx:idx+batch_size])
+
+    # Pony does not know about the raw writes, cached query results of the session are stale now
+    db._get_cache().query_results.clear()
+
 # Skeleton Db only has the Study and Timpoint entitites setup without any actual user data from Alchemer/PS
 # To rebuild the database from scratch (including user data) use psynudge.controllers.build_database()
-def build_skeleton_database(filepath=os.path.join(base_dir, 'psynudge_db.sqlite'), create_db=True, mock_db=False):
+def build_skeleton_database(filepath=os.path.join(base_dir, 'psynudge_db.sqlite'), create_db=True, mock_db=False, profile=None):
     """ Deletes old database (if exists) and returns newly built sqlite database"""
 
-    if os.path.isfile(filepath):
-        os.remove(filepath)
+    for path in [filepath, filepath+'-wal', filepath+'-shm']: # WAL profiles keep the log next to the DB file
+        if os.path.isfile(path):
+            os.remove(path)
 
-    db = open_database(filepath=filepath, create_db=create_db)
+    db = open_database(filepath=filepath, create_db=create_db, profile=profile)
+    reconcile_skeleton(db, mock_db=mock_db)
+    return db
+
+def reconcile_skeleton(db, mock_db=False, studyIds=None): #Tested
+    """ Inserts / updates / deletes StudyTypes, Studies and Timepoints so that db matches get_skeleton(), without
+        touching anything else; Completion time windows of timepoints with changed offsets are recomputed.
+        studyIds: only these studies of the skeleton are kept (e.g. the study of a shard).
+        Returns {entity: {'inserted': n, 'updated': n, 'deleted': n}} """
+
+    counts = {name: {'inserted': 0, 'updated': 0, 'deleted': 0} for name in ['StudyType', 'Study', 'Timepoint']}
+    skeleton = get_skeleton(mock_db=mock_db)
+    if studyIds is not None:
+        skeleton = [study for study in skeleton if study['id'] in studyIds]
 
-    """ Define database entries for mock studies """
     with db_session:
 
-        """ define study types """
-        indep_type = db.StudyType(type='indep')
-        stack_type = db.StudyType(type='stack')
+        for type in dict.fromkeys(study['type'] for study in skeleton): # unique, in order of appearance
+            if db.StudyType.get(type=type) is None:
+                db.StudyType(type=type)
+                counts['StudyType']['inserted'] += 1
+
+        for study_def in skeleton:
+
+            study_def = dict(study_def)
+            tp_defs = study_def.pop('timepoints')
+
+            study = db.Study.get(id=study_def['id'])
+            if study is None:
+                study = db.Study(**study_def)
+                counts['Study']['inserted'] += 1
+            elif set_changed(study, study_def):
+                counts['Study']['updated'] += 1
+
+            for tp_def in tp_defs:
+                tp = db.Timepoint.get(study=study, name=tp_def['name'])
+                if tp is None:
+                    db.Timepoint(study=study, **tp_def)
+                    counts['Timepoint']['inserted'] += 1
+                elif set_changed(tp, tp_def):
+                    counts['Timepoint']['updated'] += 1
+                    flush()
+                    refresh_completion_windows(db, tp)
+
+            tp_names = [tp_def['name'] for tp_def in tp_defs]
+            for tp in study.timepoints.select(lambda tp: tp.name not in tp_names):
+                tp.delete()
+                counts['Timepoint']['deleted'] += 1
+
+        study_ids = [study_def['id'] for study_def in skeleton]
+        for study in db.Study.select(lambda s: s.id not in study_ids):
+            study.delete()
+            counts['Study']['deleted'] += 1
+
+    return counts
+
+def set_changed(entity, values):
+    """ Sets the attributes in values that differ from entity; returns True if any did """
+
+    def current(attr):
+        value = getattr(entity, attr)
+        return value.get_pk() if hasattr(value, 'get_pk') else value # references are compared by primary key
+
+    changed = {attr: value for attr, value in values.items() if current(attr)!=value}
+    if len(changed)>0:
+        entity.set(**changed)
+
+    return len(changed)>0
+
+def refresh_completion_windows(db, tp): #Imp tested
+    """ Set-based Completion.refreshWindow() for all completions of tp """
+
+    tpId = tp.id
+    toStart, toEnd, toNudge = tp.getWindowOffsets()
+    db.execute("""UPDATE Completion SET
+            whenStartTpTs = (SELECT p.whenStartTs FROM Participant p WHERE p.id = Completion.participant) + $toStart,
+            whenEndTpTs = (SELECT p.whenStartTs FROM Participant p WHERE p.id = Completion.participant) + $toEnd,
+            whenEndNudgeTs = (SELECT p.whenStartTs FROM Participant p WHERE p.id = Completion.participant) + $toNudge
+        WHERE timepoint = $tpId""")
+    db._get_cache().query_results.clear()
+
+def get_skeleton(mock_db=False):
+    """ Studies and their timepoints the database is built from """
 
-        """ indep_mock_study """
-        indep_mock_study = db.Study(
+    """ Define database entries for mock studies """
+    skeleton = [
+        dict(
             id='38130fdb-5c9e-11eb-ac63-0a280c4496dd',
             name='indep_study',
-            type=indep_type,
-        )
-        indep_tp1 = db.Timepoint(
-            psId=1,
-            study = indep_mock_study,
-            name = 'indep_tp1',
-            surveyId = 90288073,
-            firstQID = 2,
-            lastQID = 18,
-            td2start = datetime.timedelta(days=1),
-            td2end = datetime.timedelta(days=1),
-            td2nudge = datetime.timedelta(days=1)
-        )
-        indep_tp2 = db.Timepoint(
-            psId=6,
-            study = indep_mock_study,
-            name = 'indep_tp2',
-            surveyId = 90289410,
-            firstQID = 7,
-            lastQID = 19,
-            td2start = datetime.timedelta(days=6),
-            td2end = datetime.timedelta(days=1),
-            td2nudge = datetime.timedelta(days=2)
-        )
-        indep_mock_study.timepoints = [indep_tp1, indep_tp2]
-
-        """ stack_mock_study """
-        stack_mock_study = db.Study(
+            type='indep',
+            timepoints=[
+                dict(
+                    psId=1,
+                    name = 'indep_tp1',
+                    surveyId = 90288073,
+                    firstQID = 2,
+                    lastQID = 18,
+                    td2start = datetime.timedelta(days=1),
+                    td2end = datetime.timedelta(days=1),
+                    td2nudge = datetime.timedelta(days=1)),
+                dict(
+                    psId=6,
+                    name = 'indep_tp2',
+                    surveyId = 90289410,
+                    firstQID = 7,
+                    lastQID = 19,
+                    td2start = datetime.timedelta(days=6),
+                    td2end = datetime.timedelta(days=1),
+                    td2nudge = datetime.timedelta(days=2)),]),
+        dict(
             id='3f4241b2-5cbb-11eb-ac63-0a280c4496dd',
             name='stack_study',
             type='stack',
-        )
-        stack_tp1 = db.Timepoint(
-            study = stack_mock_study,
-            name = 'stack_tp1',
-            psId=1,
-            surveyId = 90286853,
-            firstQID = 2,
-            lastQID = 18,
-            startPageId = 1,
-            td2start = datetime.timedelta(days=1),
-            td2end = datetime.timedelta(days=1),
-            td2nudge =datetime.timedelta(days=1)
-        )
-        stack_tp2 = db.Timepoint(
-            study = stack_mock_study,
-            name = 'stack_tp2',
-            surveyId = 90286853,
-            psId=6,
-            firstQID = 7,
-            lastQID = 19,
-            startPageId = 5,
-            td2start = datetime.timedelta(days=6),
-            td2end = datetime.timedelta(days=1),
-            td2nudge = datetime.timedelta(days=2)
-        )
-        stack_mock_study.timepoints = [stack_tp1, stack_tp2]
+            timepoints=[
+                dict(
+                    name = 'stack_tp1',
+                    psId=1,
+                    surveyId = 90286853,
+                    firstQID = 2,
+                    lastQID = 18,
+                    startPageId = 1,
+                    td2start = datetime.timedelta(days=1),
+                    td2end = datetime.timedelta(days=1),
+                    td2nudge =datetime.timedelta(days=1)),
+                dict(
+                    name = 'stack_tp2',
+                    surveyId = 90286853,
+                    psId=6,
+                    firstQID = 7,
+                    lastQID = 19,
+                    startPageId = 5,
+                    td2start = datetime.timedelta(days=6),
+                    td2end = datetime.timedelta(days=1),
+                    td2nudge = datetime.timedelta(days=2)),]),]
 
     if mock_db is True:
-        return db
+        return skeleton
 
     """ Define database entries for active studies """
-    with db_session:
-        pass
+    skeleton += []
 
-    return db
+    return skeleton
+
+def iso_property(ts_attr):
+    """ Returns property which reads / writes the integer epoch attribute ts_attr as ISO string in UTC """
+
+    return property(
+        lambda self: ts2iso(getattr(self, ts_attr)),
+        lambda self, value: setattr(self, ts_attr, iso2ts(value)))
+
+class TpSchedule():
+    """ Static part of a Timepoint: survey, QID range and window offsets in seconds from the start of the participant """
+
+    __slots__ = ('id', 'psId', 'name', 'surveyId', 'startPageId', 'firstQID', 'lastQID', 'toStart', 'toEnd', 'toNudge')
+
+    def __init__(self, tp):
+        toStart, toEnd, toNudge = tp.getWindowOffsets()
+        for attr, value in [('id', tp.id), ('psId', tp.psId), ('name', tp.name), ('surveyId', tp.surveyId),
+                ('startPageId', tp.startPageId), ('firstQID', tp.firstQID), ('lastQID', tp.lastQID),
+                ('toStart', toStart), ('toEnd', toEnd), ('toNudge', toNudge)]:
+            object.__setattr__(self, attr, value)
+
+    def __setattr__(self, attr, value):
+        raise AttributeError('TpSchedule is immutable')
+
+    def __eq__(self, other):
+        return isinstance(other, TpSchedule) and all(getattr(self, attr)==getattr(other, attr) for attr in self.__slots__)
+
+    def __repr__(self):
+        return 'TpSchedule({})'.format(', '.join('{}={!r}'.format(attr, getattr(self, attr)) for attr in self.__slots__))
+
+
+class StudySchedule():
+    """ Timepoints of a study as TpSchedules, sorted by offset; see get_schedule """
+
+    __slots__ = ('studyId', 'tps', 'byId', 'furthestTp', 'furthestTd')
+
+    def __init__(self, studyId, tps):
+        tps = sorted((TpSchedule(tp) for tp in tps), key=lambda tp: tp.id)
+        furthestTp = max(tps, key=lambda tp: tp.toNudge) if len(tps)>0 else None # first of equals in id order
+
+        for attr, value in [
+                ('studyId', studyId),
+                ('tps', tuple(sorted(tps, key=lambda tp: (tp.toStart, tp.toEnd, tp.toNudge, tp.id)))),
+                ('byId', {tp.id: tp for tp in tps}),
+                ('furthestTp', furthestTp),
+                ('furthestTd', None if furthestTp is None else datetime.timedelta(seconds=furthestTp.toNudge))]:
+            object.__setattr__(self, attr, value)
+
+    def __setattr__(self, attr, value):
+        raise AttributeError('StudySchedule is immutable')
+
+schedules = {} # (Database.id, Study.id) -> StudySchedule, built from committed Timepoints only
+uncommitted = {} # id(session cache) -> (session cache, keys of schedules with uncommitted Timepoint changes)
+
+def get_schedule(study): #Tested
+    """ Returns the cached StudySchedule of study; not cached while the transaction has uncommitted Timepoint changes """
+
+    study._database_.flush() # pending Timepoint changes run the hooks, as querying the timepoints would
+    key = (study._database_.id, study.id)
+    schedule = schedules.get(key)
+    if schedule is not None:
+        return schedule
+
+    schedule = StudySchedule(study.id, study.timepoints.select())
+
+    for cacheId, (cache, keys) in list(uncommitted.items()): # committed or rolled back since
+        if not (cache.is_alive and cache.in_transaction):
+            uncommitted.pop(cacheId, None) # jobs of the daemon share the module
+
+    if key not in uncommitted.get(id(study._session_cache_), (None, ()))[1]:
+        schedules[key] = schedule
+
+    return schedule
+
+def refresh_schedules(db): #Tested
+    """ Drops the cached schedules of db which differ from its Timepoints, e.g. after reconcile_skeleton in another process """
+
+    current = {}
+    for tp in db.Timepoint.select().order_by(lambda tp: tp.id):
+        current.setdefault(tp.study.id, []).append(TpSchedule(tp))
+
+    for (dbId, studyId), schedule in list(schedules.items()):
+        if (dbId==db.id) and (sorted(schedule.tps, key=lambda tp: tp.id)!=current.get(studyId, [])):
+            schedules.pop((dbId, studyId), None)
+            psylog.info('Schedule of study {} changed in the DB, rebuilt on next use'.format(studyId))
+
+def invalidate_schedule(tp):
+    """ Drops the cached schedule of the study of tp, it is not cached again until the transaction of the change is over """
+
+    key = (tp._database_.id, tp.study.id)
+    schedules.pop(key, None)
+    cache = tp._session_cache_
+    uncommitted.setdefault(id(cache), (cache, set()))[1].add(key)
 
 def define_db_entities(db):
 
@@ -119,9 +392,14 @@ def define_db_entities(db):
         participants = Set('Participant')
         type = Required('StudyType')
         timepoints = Set('Timepoint')
-        lastPsCheck = Required(str, default='2020-01-01T00:00:00+00:00') # in UTC
+        digests = Set('Digest')
+        lastPsCheckTs = Required(int, default=DEFAULT_TS, index=True) # UTC epoch seconds, last PS download
+        lastPsFullCheckTs = Required(int, default=DEFAULT_TS) # UTC epoch seconds, last full (non-delta) PS download
         isActive    = Required(bool, default=True)
 
+        lastPsCheck = iso_property('lastPsCheckTs')
+        lastPsFullCheck = iso_property('lastPsFullCheckTs')
+
         def areTpsConsistent(self):
 
             if self.type=='stack':
@@ -153,25 +431,21 @@ def define_db_entities(db):
 
             return True
 
+        def getSchedule(self):
+            """ Returns the cached StudySchedule, see get_schedule """
+            return get_schedule(self)
+
         def getFurthestTp(self):
             """ Returns timepoint with largest timedelta from start """
-
-            furthestTp = self.timepoints.select().first()
-            furthestTpTd = furthestTp.td2start + furthestTp.td2end + furthestTp.td2nudge
-
-            for tp in self.timepoints:
-                Td = tp.td2start + tp.td2end + tp.td2nudge
-
-                if Td > furthestTpTd:
-                    furthestTp = tp
-                    furthestTpTd = tp.td2start + tp.td2end + tp.td2nudge
-
-            return furthestTp
+            return db.Timepoint[get_schedule(self).furthestTp.id]
 
         def getFurthestTd(self):
             """ Returns largest timedelta from start """
-            tp = self.getFurthestTp()
-            return tp.td2start + tp.td2end + tp.td2nudge
+            return get_schedule(self).furthestTd
+
+        def getFirstTp(self):
+            """ Returns the earliest timepoint, e.g. to read the SG check of stack studies, where all tps share the survey """
+            return db.Timepoint[get_schedule(self).tps[0].id]
 
 
     class StudyType(db.Entity):
@@ -185,7 +459,7 @@ def define_db_entities(db):
         name = Optional(str)
         study = Required(Study)
         completions = Set('Completion')
-        lastSgCheck = Required(str, default='2020-01-01T00:00:00+00:00') # in UTC
+        lastSgCheckTs = Required(int, default=DEFAULT_TS, index=True) # UTC epoch seconds
         surveyId = Required(int)
         startPageId = Optional(int)
         firstQID = Optional(int)
@@ -194,13 +468,39 @@ def define_db_entities(db):
         td2end = Required(datetime.timedelta)    #from start of TP to end of TP: user['date'] + td2start + td2end = end of TP
         td2nudge = Required(datetime.timedelta)  #from end of TP to the end of nudge window: user['date'] + td2start + td2end + td2nudge = end of nudge window
 
+        lastSgCheck = iso_property('lastSgCheckTs')
+
+        # Cached StudySchedule is dropped when the schedule changes, lastSgCheck updates keep it
+        def after_insert(self):
+            invalidate_schedule(self)
+
+        def before_update(self): # _dbvals_ still holds the values in the DB
+            if any(self._dbvals_.get(attr)!=getattr(self, attr.name) for attr in [Timepoint.study, Timepoint.psId,
+                    Timepoint.name, Timepoint.surveyId, Timepoint.startPageId, Timepoint.firstQID, Timepoint.lastQID,
+                    Timepoint.td2start, Timepoint.td2end, Timepoint.td2nudge]):
+                invalidate_schedule(self)
+
+        def before_delete(self):
+            invalidate_schedule(self)
+
+        def getWindowOffsets(self):
+            """ Returns (start of TP, end of TP, end of nudge window) in seconds from the start of the participant """
+
+            toStart = self.td2start
+            toEnd   = toStart + self.td2end
+            toNudge = toEnd + self.td2nudge
+            return tuple(int(round(td.total_seconds())) for td in [toStart, toEnd, toNudge])
+
 
     class Participant(db.Entity):
         id = PrimaryKey(str)
         study = Required(Study)
         completions = Set('Completion')
-        whenStart = Optional(str) # in UTC
-        whenFinish = Optional(str) # in UTC
+        whenStartTs = Optional(int, index=True) # UTC epoch seconds
+        whenFinishTs = Optional(int, index=True) # UTC epoch seconds
+
+        whenStart = iso_property('whenStartTs')
+        whenFinish = iso_property('whenFinishTs')
 
 
     class Completion(db.Entity):
@@ -208,26 +508,42 @@ def define_db_entities(db):
         participant = Required(Participant)
         timepoint = Required(Timepoint)
         isComplete = Required(bool, default=False) # is the timepoint completed
-        lastNudgeSend = Optional(str, default='2020-01-01T00:00:00+00:00') # in UTC
+        lastNudgeSendTs = Optional(int, default=DEFAULT_TS, index=True) # UTC epoch seconds
+
+        # Time window of the TP materialized from Participant.whenStartTs + Timepoint.td*, UTC epoch seconds
+        whenStartTpTs = Optional(int, index=True)   # start of TP
+        whenEndTpTs = Optional(int, index=True)     # end of TP, start of nudge window
+        whenEndNudgeTs = Optional(int, index=True)  # end of nudge window
+
+        nudges = Set('Nudge')
+
+        composite_index(participant, timepoint)
+
+        lastNudgeSend = iso_property('lastNudgeSendTs')
+
+        def refreshWindow(self): #Imp tested
+            """ Recomputes the materialized time window, has to be called when Participant.whenStartTs changes """
+
+            whenStartTs = self.participant.whenStartTs
+            toStart, toEnd, toNudge = self.timepoint.getWindowOffsets()
+
+            self.whenStartTpTs = whenStartTs + toStart
+            self.whenEndTpTs = whenStartTs + toEnd
+            self.whenEndNudgeTs = whenStartTs + toNudge
 
         def whenStartTp(self):
-            return (iso2utcdt(self.participant.whenStart) + self.timepoint.td2start).isoformat()
+            return ts2iso(self.whenStartTpTs)
 
         def whenEndTp(self):
-            return (iso2utcdt(self.participant.whenStart) + self.timepoint.td2start + self.timepoint.td2end).isoformat()
+            return ts2iso(self.whenEndTpTs)
 
         def whenEndNudge(self):
-            return (iso2utcdt(self.participant.whenStart) + self.timepoint.td2start + self.timepoint.td2end + self.td2nudge).isoformat()
+            return ts2iso(self.whenEndNudgeTs)
 
         def isAfterCompletion(self): # Tested
             """ Returns True if completion is expected, False if before / after time completion window """
 
-            now = getUtcNow()
-            expStartDtUtc = iso2utcdt(self.participant.whenStart) # start of the experiment
-            startDtUtc = expStartDtUtc + self.timepoint.td2start  # start of the timepoint
-            finishDtUtc = startDtUtc + self.timepoint.td2end      # end of the tmepoint
-
-            if finishDtUtc <= now:
+            if self.whenEndTpTs <= dt2ts(getUtcNow()):
                 return True
 
             return False
@@ -235,11 +551,8 @@ def define_db_entities(db):
         def isBeforeNudgeEnd(self): #Imp tested
             """ Checks if now is within nudge time window of user and tp """
 
-            tp = self.timepoint
-            dtStartUTC = iso2utcdt(self.participant.whenStart)
-
-            start = dtStartUTC + (tp.td2start + tp.td2end)
-            end   = dtStartUTC + (tp.td2start + tp.td2end + tp.td2nudge)
+            start = ts2utcdt(self.whenEndTpTs)
+            end   = ts2utcdt(self.whenEndNudgeTs)
 
             return isWithinTimeWindow(start, end)
 
@@ -247,7 +560,7 @@ def define_db_entities(db):
             """ Returns True if last nudge was sent > 23:50h ago, False otherwise """
 
             dtNow = getUtcNow()
-            dtlastNudgeSend = iso2utcdt(self.lastNudgeSend)
+            dtlastNudgeSend = ts2utcdt(self.lastNudgeSendTs)
             assert dtNow > dtlastNudgeSend
 
             if (dtNow - dtlastNudgeSend) > datetime.timedelta(days=0.985): # 0.985 instead of 1 for error tolerance ~23:38
@@ -277,3 +590,199 @@ def define_db_entities(db):
                 return False
 
             return True
+
+
+    class Nudge(db.Entity):
+        """ Nudge outbox: rows are queued by core.queueNudges and delivered by dispatch.drainOutbox """
+        id = PrimaryKey(int, auto=True)
+        completion = Required(Completion)
+        queuedTs = Required(int)                # UTC epoch seconds
+        claimedTs = Optional(int)               # set while a dispatcher is sending the row, expires after NUDGE_CLAIM_LEASE
+        sentTs = Optional(int, index=True)      # None while pending
+        attempts = Required(int, default=0)     # failed sends
+        lastError = Optional(str)
+
+
+    class Digest(db.Entity):
+        """ Digest of the last processed PS payload of a study, see core.diffPayload """
+        id = PrimaryKey(int, auto=True)
+        study = Required(Study)
+        payload = Required(str)         # digest of the whole payload
+        entries = Optional(LongStr)     # JSON {entry id: entry digest}
+        updatedTs = Required(int)       # UTC epoch seconds
+
+
+    class ParticipantArchive(db.Entity):
+        """ Finished participants moved out of Participant by core.deletePastParticipant, kept for reporting """
+        id = PrimaryKey(str)
+        study = Required(str, index=True)   # Study.id, no reference so studies can be removed from the skeleton
+        whenStartTs = Optional(int)         # UTC epoch seconds
+        whenFinishTs = Optional(int)        # UTC epoch seconds
+        archivedTs = Required(int)          # UTC epoch seconds
+
+        whenStart = iso_property('whenStartTs')
+        whenFinish = iso_property('whenFinishTs')
+
+
+    class CompletionArchive(db.Entity):
+        """ Completions of archived participants, one per participant and timepoint, see ParticipantArchive """
+        participant = Required(str)         # ParticipantArchive.id
+        timepoint = Required(int)           # Timepoint.id
+        completion = Required(int)          # Completion.id
+        isComplete = Required(bool)
+        lastNudgeSendTs = Optional(int)     # UTC epoch seconds
+        whenStartTpTs = Optional(int)       # UTC epoch seconds
+        whenEndTpTs = Optional(int)         # UTC epoch seconds
+        whenEndNudgeTs = Optional(int)      # UTC epoch seconds
+        nudgesSent = Required(int, default=0)
+        PrimaryKey(participant, timepoint)
+
+
+""" Schema migrations, migrations[i] migrates from schema version i to i+1 """
+def _rebuild_table(con, table, ddl, columns, exprs, indexes):
+    """ Recreates table with ddl (SQLite can not alter column types) and copies over the rows,
+        exprs are SQL expressions over the old table which give the values of the new columns """
+
+    con.execute(ddl.format(table='{}_new'.format(table)))
+    con.execute('INSERT INTO "{table}_new" ({columns}) SELECT {exprs} FROM "{table}"'.format(
+        table = table,
+        columns = ', '.join('"{}"'.format(column) for column in columns),
+        exprs = ', '.join(exprs)))
+    con.execute('DROP TABLE "{}"'.format(table))
+    con.execute('ALTER TABLE "{table}_new" RENAME TO "{table}"'.format(table=table))
+
+    for column in indexes:
+        con.execute('CREATE INDEX "idx_{}__{}" ON "{}" ("{}")'.format(table.lower(), column.lower(), table, column))
+
+def _migrate_iso2ts(con):
+    """ v0 -> v1: ISO string timestamps are replaced by indexed integer UTC epoch seconds """
+
+    con.create_function('iso2ts', 1, iso2ts)
+
+    _rebuild_table(con, 'Study',
+        ddl = """CREATE TABLE "{table}" (
+            "id" TEXT NOT NULL PRIMARY KEY,
+            "name" TEXT NOT NULL,
+            "type" TEXT NOT NULL REFERENCES "StudyType" ("type") ON DELETE CASCADE,
+            "lastPsCheckTs" INTEGER NOT NULL,
+            "isActive" BOOLEAN NOT NULL)""",
+        columns = ['id', 'name', 'type', 'lastPsCheckTs', 'isActive'],
+        exprs = ['"id"', '"name"', '"type"', 'iso2ts("lastPsCheck")', '"isActive"'],
+        indexes = ['type', 'lastPsCheckTs'])
+
+    _rebuild_table(con, 'Timepoint',
+        ddl = """CREATE TABLE "{table}" (
+            "id" INTEGER PRIMARY KEY AUTOINCREMENT,
+            "psId" INTEGER NOT NULL,
+            "name" TEXT NOT NULL,
+            "study" TEXT NOT NULL REFERENCES "Study" ("id") ON DELETE CASCADE,
+            "lastSgCheckTs" INTEGER NOT NULL,
+            "surveyId" INTEGER NOT NULL,
+            "startPageId" INTEGER,
+            "firstQID" INTEGER,
+            "lastQID" INTEGER,
+            "td2start" INTERVAL NOT NULL,
+            "td2end" INTERVAL NOT NULL,
+            "td2nudge" INTERVAL NOT NULL)""",
+        columns = ['id', 'psId', 'name', 'study', 'lastSgCheckTs', 'surveyId', 'startPageId', 'firstQID', 'lastQID', 'td2start', 'td2end', 'td2nudge'],
+        exprs = ['"id"', '"psId"', '"name"', '"study"', 'iso2ts("lastSgCheck")', '"surveyId"', '"startPageId"', '"firstQID"', '"lastQID"', '"td2start"', '"td2end"', '"td2nudge"'],
+        indexes = ['study', 'lastSgCheckTs'])
+
+    _rebuild_table(con, 'Participant',
+        ddl = """CREATE TABLE "{table}" (
+            "id" TEXT NOT NULL PRIMARY KEY,
+            "study" TEXT NOT NULL REFERENCES "Study" ("id") ON DELETE CASCADE,
+            "whenStartTs" INTEGER,
+            "whenFinishTs" INTEGER)""",
+        columns = ['id', 'study', 'whenStartTs', 'whenFinishTs'],
+        exprs = ['"id"', '"study"', 'iso2ts("whenStart")', 'iso2ts("whenFinish")'],
+        indexes = ['study', 'whenStartTs', 'whenFinishTs'])
+
+    _rebuild_table(con, 'Completion',
+        ddl = """CREATE TABLE "{table}" (
+            "id" INTEGER PRIMARY KEY AUTOINCREMENT,
+            "participant" TEXT NOT NULL REFERENCES "Participant" ("id") ON DELETE CASCADE,
+            "timepoint" INTEGER NOT NULL REFERENCES "Timepoint" ("id") ON DELETE CASCADE,
+            "isComplete" BOOLEAN NOT NULL,
+            "lastNudgeSendTs" INTEGER)""",
+        columns = ['id', 'participant', 'timepoint', 'isComplete', 'lastNudgeSendTs'],
+        exprs = ['"id"', '"participant"', '"timepoint"', '"isComplete"', 'iso2ts("lastNudgeSend")'],
+        indexes = ['participant', 'timepoint', 'lastNudgeSendTs'])
+
+def _migrate_completion_window(con):
+    """ v1 -> v2: materialized time window columns on Completion """
+
+    offsets = {
+        'whenStartTpTs': 'tp.td2start',
+        'whenEndTpTs': 'tp.td2start + tp.td2end',
+        'whenEndNudgeTs': 'tp.td2start + tp.td2end + tp.td2nudge'}
+
+    for column, offset in offsets.items():
+        con.execute('ALTER TABLE "Completion" ADD COLUMN "{}" INTEGER'.format(column))
+        con.execute("""UPDATE "Completion" SET "{column}" = (
+            SELECT p."whenStartTs" + CAST(ROUND(({offset}) * 86400) AS INTEGER) -- timedeltas are stored as days
+            FROM "Participant" p, "Timepoint" tp
+            WHERE p."id" = "Completion"."participant" AND tp."id" = "Completion"."timepoint")""".format(column=column, offset=offset))
+        con.execute('CREATE INDEX "idx_completion__{}" ON "Completion" ("{}")'.format(column.lower(), column))
+
+def _migrate_completion_lookup_index(con):
+    """ v2 -> v3: composite (participant, timepoint) index for resolving SGUIDs to Completions """
+
+    con.execute('CREATE INDEX "idx_completion__participant_timepoint" ON "Completion" ("participant", "timepoint")')
+    con.execute('DROP INDEX IF EXISTS "idx_completion__participant"') # prefix of the composite index
+
+def _migrate_study_full_check(con):
+    """ v3 -> v4: Study.lastPsFullCheckTs for PS delta sync; existing studies get a full download on the next run """
+
+    con.execute('ALTER TABLE "Study" ADD COLUMN "lastPsFullCheckTs" INTEGER NOT NULL DEFAULT {}'.format(DEFAULT_TS))
+
+def _migrate_drop_sg_digests(con):
+    """ v4 -> v5: SG payloads are no longer digested (see core.diffPayload), their per-response digests are dropped """
+
+    if con.execute("SELECT count(*) FROM sqlite_master WHERE type='table' AND name='Digest'").fetchone()[0]==1:
+        con.execute("DELETE FROM \"Digest\" WHERE \"source\" = 'sg'")
+
+def _migrate_completion_archive_key(con):
+    """ v5 -> v6: CompletionArchive is keyed on (participant, timepoint) instead of Completion.id; participants
+        re-inserted by full PS downloads were archived again under new ids, the first archived row is kept """
+
+    if con.execute("SELECT count(*) FROM sqlite_master WHERE type='table' AND name='CompletionArchive'").fetchone()[0]==0:
+        return
+
+    con.execute("""CREATE TABLE "CompletionArchive_new" (
+        "participant" TEXT NOT NULL,
+        "timepoint" INTEGER NOT NULL,
+        "completion" INTEGER NOT NULL,
+        "isComplete" BOOLEAN NOT NULL,
+        "lastNudgeSendTs" INTEGER,
+        "whenStartTpTs" INTEGER,
+        "whenEndTpTs" INTEGER,
+        "whenEndNudgeTs" INTEGER,
+        "nudgesSent" INTEGER NOT NULL,
+        PRIMARY KEY ("participant", "timepoint"))""")
+    con.execute("""INSERT INTO "CompletionArchive_new" SELECT "participant", "timepoint", "id", "isComplete", "lastNudgeSendTs",
+            "whenStartTpTs", "whenEndTpTs", "whenEndNudgeTs", "nudgesSent"
+        FROM "CompletionArchive"
+        WHERE "id" IN (SELECT min("id") FROM "CompletionArchive" GROUP BY "participant", "timepoint")""")
+    con.execute('DROP TABLE "CompletionArchive"')
+    con.execute('ALTER TABLE "CompletionArchive_new" RENAME TO "CompletionArchive"')
+
+def _migrate_digest_ps_only(con):
+    """ v6 -> v7: Digest only holds PS payloads since v5, its source / timepoint columns are dropped """
+
+    if con.execute("SELECT count(*) FROM sqlite_master WHERE type='table' AND name='Digest'").fetchone()[0]==0:
+        return
+
+    _rebuild_table(con, 'Digest',
+        ddl = """CREATE TABLE "{table}" (
+            "id" INTEGER PRIMARY KEY AUTOINCREMENT,
+            "study" TEXT NOT NULL REFERENCES "Study" ("id") ON DELETE CASCADE,
+            "payload" TEXT NOT NULL,
+            "entries" TEXT,
+            "updatedTs" INTEGER NOT NULL)""",
+        columns = ['id', 'study', 'payload', 'entries', 'updatedTs'],
+        exprs = ['"id"', '"study"', '"payload"', '"entries"', '"updatedTs"'],
+        indexes = ['study'])
+
+migrations = [_migrate_iso2ts, _migrate_completion_window, _migrate_completion_lookup_index, _migrate_study_full_check,
+    _migrate_drop_sg_digests, _migrate_completion_archive_key, _migrate_digest_ps_only]
@@ -0,0 +1,186 @@
+"""
+:Author: Balazs Szigeti <b.islander@protonmail.com>
+:Copyright: 2021, DrugNerdsLab
+:License: MIT
+
+Delivery of nudges to the PS send endpoint: participant lists are split into batches, empty batches are skipped,
+batches are sent in parallel under a per-study rate limit and every batch is reported instead of aborting the run
+"""
+
+from pony.orm import db_session, commit
+from .mydt import getUtcNow, dt2ts
+from .mylogger import psylog
+from .db import MAX_SQL_VARS
+from . import config, clients
+import concurrent.futures
+import collections
+import threading
+import time
+
+NudgeBatch = collections.namedtuple('NudgeBatch', ['studyId', 'psId', 'participants'])
+BatchResult = collections.namedtuple('BatchResult', ['batch', 'ok', 'status', 'latency', 'error'])
+
+
+class RateLimiter():
+    """ Spaces out calls so at most rate of them start per second; rate None / 0 means no limit """
+
+    def __init__(self, rate=None):
+        self.interval = 1/rate if rate else 0
+        self.next = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next)
+            self.next = start + self.interval
+        time.sleep(start-now)
+
+def makeBatches(nudges, batch_size=None): #Tested
+    """ Turns (studyId, psId, participant ids) triples into NudgeBatches of at most batch_size participants;
+        timepoints without participants produce no batch """
+
+    batch_size = config.NUDGE_BATCH_SIZE if batch_size is None else batch_size
+    assert isinstance(batch_size, int) and (batch_size>0)
+
+    batches = []
+    for studyId, psId, participants in nudges:
+        for idx in range(0, len(participants), batch_size):
+            batches.append(NudgeBatch(studyId, psId, list(participants[idx:idx+batch_size])))
+
+    return batches
+
+def sendBatch(batch, limiter=None): #Tested
+    """ POSTs one batch to PS; failures are returned as BatchResult, not raised """
+
+    import requests # lazy, see clients
+
+    if limiter is not None:
+        limiter.wait()
+
+    start = time.perf_counter()
+    try:
+        response = clients.psRequest('POST', 'studies/{}/timepoints/{}/send'.format(batch.studyId, batch.psId),
+            json={
+                "subject" : "Reminder to complete missed survey",
+                "participants" : batch.participants,
+                },
+            )
+        status, error = response.status_code, None if response.status_code==200 else response.text[:200]
+    except requests.exceptions.RequestException as exc:
+        status, error = None, repr(exc)
+
+    result = BatchResult(batch=batch, ok=(status==200), status=status, latency=time.perf_counter()-start, error=error)
+
+    if result.ok:
+        psylog.info('Nudge batch sent; study:{}, tp:{}, n:{}, latency:{:.3f}s'.format(
+            batch.studyId, batch.psId, len(batch.participants), result.latency))
+    else:
+        psylog.error('Nudge batch failed; study:{}, tp:{}, n:{}, status:{}, latency:{:.3f}s, error:{}'.format(
+            batch.studyId, batch.psId, len(batch.participants), status, result.latency, error))
+
+    return result
+
+def dispatch(nudges, batch_size=None, max_workers=None, rate=None): #Tested
+    """ Sends (studyId, psId, participant ids) nudges in batches, in parallel (max_workers), at most rate batches
+        per second per study (0: no limit). Returns BatchResults in batch order """
+
+    max_workers = config.NUDGE_MAX_WORKERS if max_workers is None else max_workers
+    rate = config.NUDGE_RATE_PER_STUDY if rate is None else rate
+    assert isinstance(max_workers, int) and (max_workers>0)
+
+    batches = makeBatches(nudges, batch_size=batch_size)
+    if len(batches)==0:
+        return []
+
+    limiters = {studyId: RateLimiter(rate) for studyId in set(batch.studyId for batch in batches)}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(batches))) as executor:
+        results = list(executor.map(lambda batch: sendBatch(batch, limiters[batch.studyId]), batches))
+
+    n_failed = sum(1 for result in results if not result.ok)
+    psylog.info('Nudge dispatch finished; batches:{}, failed:{}, participants:{}'.format(
+        len(results), n_failed, sum(len(result.batch.participants) for result in results)))
+
+    return results
+
+@db_session
+def drainOutbox(db, limit=None, lease=None): #Tested
+    """ Delivers pending rows of the Nudge outbox (see core.queueNudges):
+        1. claims up to limit pending rows in one transaction, so concurrent drains do not send the same row
+        2. sends them with dispatch(), outside of any transaction
+        3. marks sent rows and updates Completion.lastNudgeSendTs in one transaction; failed rows are released for retry
+        A crash between 2. and 3. leaves the rows claimed; they are sent again once the claim lease expired """
+
+    limit = config.NUDGE_DRAIN_LIMIT if limit is None else limit
+    lease = config.NUDGE_CLAIM_LEASE if lease is None else lease
+
+    claimed = claimNudges(db, limit=limit, lease=lease)
+    if len(claimed)==0:
+        return []
+
+    # (studyId, psId) -> participant ids, in queue order
+    nudges, keys = collections.OrderedDict(), {}
+    for nudgeId, completionId, participantId, studyId, psId in claimed:
+        nudges.setdefault((studyId, psId), []).append(participantId)
+        psylog.info('Nudge is called; study:{}, tp:{}, Id:{}'.format(studyId, psId, participantId))
+        keys[(studyId, psId, participantId)] = (nudgeId, completionId)
+
+    results = dispatch([(studyId, psId, participants) for (studyId, psId), participants in nudges.items()])
+
+    sent, failed = [], []
+    for result in results:
+        batchKeys = [keys[(result.batch.studyId, result.batch.psId, participantId)] for participantId in result.batch.participants]
+        if result.ok:
+            sent.extend(batchKeys)
+        else:
+            failed.extend((nudgeId, result.error or str(result.status)) for nudgeId, completionId in batchKeys)
+
+    now = dt2ts(getUtcNow())
+    for chunk in chunks(sent):
+        nudgeIds = ','.join(str(int(nudgeId)) for nudgeId, completionId in chunk)
+        completionIds = ','.join(str(int(completionId)) for nudgeId, completionId in chunk)
+        db.execute('UPDATE Nudge SET sentTs = $now, claimedTs = NULL WHERE id IN ({})'.format(nudgeIds))
+        db.execute('UPDATE Completion SET lastNudgeSendTs = $now WHERE id IN ({})'.format(completionIds))
+
+    for nudgeId, error in failed:
+        db.execute('UPDATE Nudge SET attempts = attempts + 1, lastError = $error, claimedTs = NULL WHERE id = $nudgeId')
+
+    commit()
+    db._get_cache().query_results.clear()
+
+    psylog.info('Outbox drained; sent:{}, failed:{}'.format(len(sent), len(failed)))
+    return results
+
+def claimNudges(db, limit, lease): #Imp tested
+    """ Claims pending Nudges that are still due and returns them as (nudgeId, completionId, participantId, studyId, psId);
+        pending Nudges whose completion was completed or whose nudge window closed meanwhile are dropped """
+
+    now = dt2ts(getUtcNow())
+    leaseLimit = now - lease
+    maxAttempts = config.NUDGE_MAX_ATTEMPTS
+
+    db.get_connection() # BEGIN IMMEDIATE: claims of concurrent drains are serialized
+
+    db.execute("""DELETE FROM Nudge
+        WHERE sentTs IS NULL
+            AND completion IN (SELECT id FROM Completion WHERE isComplete = 1 OR whenEndNudgeTs < $now)""")
+
+    rows = db.execute("""SELECT n.id, n.completion, c.participant, tp.study, tp.psId
+        FROM Nudge n
+            JOIN Completion c ON c.id = n.completion
+            JOIN Timepoint tp ON tp.id = c.timepoint
+        WHERE n.sentTs IS NULL
+            AND (n.claimedTs IS NULL OR n.claimedTs < $leaseLimit)
+            AND n.attempts < $maxAttempts
+        ORDER BY n.id
+        LIMIT $limit""").fetchall()
+
+    for chunk in chunks(rows):
+        db.execute('UPDATE Nudge SET claimedTs = $now WHERE id IN ({})'.format(','.join(str(int(row[0])) for row in chunk)))
+
+    commit()
+    return rows
+
+def chunks(items, size=MAX_SQL_VARS):
+    for idx in range(0, len(items), size):
+        yield items[idx:idx+size]
@@ -0,0 +1,119 @@
+"""
+:Author: Balazs Szigeti <b.islander@protonmail.com>
+:Copyright: 2021, DrugNerdsLab
+:License: MIT
+
+Incremental parser for large JSON exports, e.g. the Alchemer surveyresponse list:
+{"result_ok": true, "total_count": ..., "data": [{response}, {response}, ...]}
+Items of the array are decoded one at a time, so peak memory is set by the largest single item, not the export
+"""
+
+import codecs
+import json
+
+CHUNK_SIZE = 2**16
+_decoder = json.JSONDecoder()
+_whitespace = ' \t\n\r'
+
+
+class JsonStream():
+    """ Buffer over a text/binary file object or an iterable of str/bytes chunks (e.g. requests' iter_content) """
+
+    def __init__(self, source, chunk_size=CHUNK_SIZE):
+
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.chunk_size = chunk_size
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+
+        if hasattr(source, 'read'):
+            self.chunks = iter(lambda: source.read(chunk_size), source.read(0))
+        else:
+            self.chunks = iter(source)
+
+    def fill(self):
+        """ Appends next chunk to buffer, returns False at end of stream """
+
+        if self.eof:
+            return False
+
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            chunk, self.eof = self.utf8.decode(b'', final=True), True
+        elif isinstance(chunk, bytes):
+            chunk = self.utf8.decode(chunk)
+
+        if self.pos > self.chunk_size: # drop consumed part, amortized over chunks
+            self.buf, self.pos = self.buf[self.pos:], 0
+
+        self.buf += chunk
+        return True
+
+    def peek(self):
+        """ Returns next non-whitespace character without consuming it, '' at end of stream """
+
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _whitespace:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, chars):
+        """ Consumes and returns next character, which must be one of chars """
+
+        char = self.peek()
+        if (char=='') or (char not in chars):
+            raise ValueError('Expected one of {} at offset {}, got {}'.format(list(chars), self.pos, repr(char)))
+        self.pos += 1
+        return char
+
+    def decode(self):
+        """ Decodes next JSON value. A value is only accepted once a character follows it or the stream ended,
+            so numbers / literals split across chunks are not truncated """
+
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+                if (end < len(self.buf)) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+
+def iterJsonArray(source, key='data', meta=None, chunk_size=CHUNK_SIZE): #Tested
+    """ Yields items of the array stored under key of the top-level JSON object in source.
+        Other top-level values are decoded in full and stored in meta (if a dict is given) """
+
+    stream = JsonStream(source, chunk_size=chunk_size)
+    stream.expect('{')
+    if stream.peek()=='}':
+        return
+
+    while True:
+        name = stream.decode()
+        assert isinstance(name, str)
+        stream.expect(':')
+
+        if (name==key) and (stream.peek()=='['):
+            stream.expect('[')
+            if stream.peek()==']':
+                stream.expect(']')
+            else:
+                while True:
+                    yield stream.decode()
+                    if stream.expect(',]')==']':
+                        break
+        else:
+            value = stream.decode()
+            if meta is not None:
+                meta[name] = value
+
+        if stream.expect(',}')=='}':
+            return
@@ -5,22 +5,45 @@
 """
 
 import dateutil.parser
+import functools
 import datetime
 import pytz
 
+
+PARSE_CACHE_SIZE = 8192 # number of date strings memoized by iso2utcdt
+
 """ Datetime manipulations """
+def parseDt(dstr): #Tested
+    """ Parses date string with datetime.fromisoformat, dateutil is only used for inputs fromisoformat can not handle
+
+        Fast path covers the formats seen from PS / Alchemer:
+            2020-01-10T00:00:00+00:00, 2020-01-10T00:00:00Z, 2020-11-06 10:58:09 GMT
+    """
+
+    isoDstr = dstr
+    if dstr.endswith(' GMT'):
+        isoDstr = dstr[:-4] + '+00:00'
+    elif dstr.endswith('Z'):
+        isoDstr = dstr[:-1] + '+00:00'
+
+    try:
+        return datetime.datetime.fromisoformat(isoDstr)
+    except (ValueError, AttributeError): # AttributeError: fromisoformat is missing before python 3.7
+        return dateutil.parser.parse(dstr)
+
 def iso2dt(dstr): #Tested
     """ Converts ISO date string to datetime.datetime obj """
 
     assert isinstance(dstr, str)
-    dt_loc = dateutil.parser.parse(dstr)
+    dt_loc = parseDt(dstr)
     return dt_loc
 
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
 def iso2utcdt(dstr): #Tested
-    """ Converts ISO date string to datetime.datetime obj in UTC tz """
+    """ Converts ISO date string to datetime.datetime obj in UTC tz; memoized, as the same strings are parsed repeatedly """
 
     assert isinstance(dstr, str)
-    dt_loc = dateutil.parser.parse(dstr)
+    dt_loc = parseDt(dstr)
     dt_utc = dt_loc.astimezone(pytz.timezone('UTC'))
 
     return dt_utc
@@ -30,6 +53,32 @@ def dt2utcdt(dt): #Wrapper
     assert isinstance(dt, datetime.datetime)
     return dt.astimezone(pytz.timezone('UTC'))
 
+def iso2ts(dstr): #Tested
+    """ Converts ISO date string to UTC epoch seconds, empty string / None is returned as None """
+
+    if not dstr:
+        return None
+    return int(iso2utcdt(dstr).timestamp())
+
+def ts2utcdt(ts): #Tested
+    """ Converts UTC epoch seconds to datetime.datetime obj in UTC tz """
+
+    assert isinstance(ts, int)
+    return datetime.datetime.fromtimestamp(ts, pytz.timezone('UTC'))
+
+def ts2iso(ts): #Tested
+    """ Converts UTC epoch seconds to ISO date string in UTC, None is returned as None """
+
+    if ts is None:
+        return None
+    return ts2utcdt(ts).isoformat()
+
+def dt2ts(dt): #Wrapper
+    """ Wrapper to convert timezone aware datetime.datetime obj to UTC epoch seconds """
+    assert isinstance(dt, datetime.datetime)
+    assert dt.tzinfo is not None
+    return int(dt.timestamp())
+
 def getUtcNow(): #Wrapper
     """ Wrapper to get current datetime """
     return datetime.datetime.utcnow().replace(microsecond=0).astimezone(pytz.timezone('UTC'))
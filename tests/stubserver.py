@@ -0,0 +1,222 @@
+"""
+:Author: Balazs Szigeti <b.islander@protonmail.com>
+:Copyright: 2021, DrugNerdsLab
+:License: MIT
+
+Local stand-in of the PS dashboard and Alchemer (SurveyGizmo) v5 APIs for tests and benchmarks/bench_load.py,
+served from a background thread. Latency, error rate and data volume (see makePsParticipants / makeSgResponses)
+are configurable
+
+with StubServer(sg_responses={surveyId: [response, ...]}, ps_participants={studyId: [entry, ...]}) as server:
+    config.SG_BASE_URL = server.url
+    config.PS_BASE_URL = server.url+'v2/'
+"""
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import dateutil.parser
+import urllib.parse
+import socketserver
+import functools
+import threading
+import datetime
+import random
+import time
+import json
+import math
+import re
+
+sg_path = re.compile(r'^/v5/survey/(\d+)/surveyresponse/?(\.json)?$')
+ps_participants_path = re.compile(r'^/v2/studies/([^/]+)/participants$')
+ps_send_path = re.compile(r'^/v2/studies/([^/]+)/timepoints/([^/]+)/send$')
+
+
+@functools.lru_cache(maxsize=None)
+def parseDate(dstr):
+    return dateutil.parser.parse(dstr)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer): # http.server.ThreadingHTTPServer is py3.7+
+    daemon_threads = True
+
+
+class StubServer():
+
+    def __init__(self, sg_responses=None, ps_participants=None, latency=0, error_rate=0, error_status=503, seed=None):
+
+        self.sg_responses = {} if sg_responses is None else sg_responses
+        self.ps_participants = {} if ps_participants is None else ps_participants
+        self.latency = latency  # seconds added to every request
+        self.errors = []        # status codes returned (in order) instead of the next responses
+        self.error_rate = error_rate      # fraction of the other requests answered with error_status
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.n_errors = 0       # error responses served
+
+        self.lock = threading.Lock()
+        self.requests = []      # (method, path, query, body) of every request
+        self.sent = []          # (studyId, tpId, payload) of every nudge send
+        self.connections = set()# client addresses, one per TCP connection
+        self.active = 0         # requests being served now
+        self.max_active = 0     # most requests served at once
+        self.filtered = {}      # (surveyId, filter, n responses) -> filtered responses, pages of a list share it
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), self.getHandler())
+        self.url = 'http://127.0.0.1:{}/'.format(self.httpd.server_address[1])
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def getHandler(self):
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1' # keep-alive
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self.handleAny('GET')
+
+            def do_POST(self):
+                self.handleAny('POST')
+
+            def handleAny(self, method):
+
+                url = urllib.parse.urlsplit(self.path)
+                query = dict(urllib.parse.parse_qsl(url.query))
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length).decode('utf-8')) if length>0 else None
+
+                with server.lock:
+                    server.requests.append((method, url.path, query, body))
+                    server.connections.add(self.client_address)
+                    server.active += 1
+                    server.max_active = max(server.max_active, server.active)
+                    error = server.errors.pop(0) if len(server.errors)>0 else None
+                    if (error is None) and (server.error_rate>0) and (server.random.random()<server.error_rate):
+                        error = server.error_status
+                    if error is not None:
+                        server.n_errors += 1
+
+                try:
+                    time.sleep(server.latency)
+                    if error is None:
+                        status, payload = server.route(method, url.path, query, body)
+                    else:
+                        status, payload = error, {'result_ok': False, 'message': 'Injected error'}
+                    self.sendJson(status, payload)
+                finally:
+                    with server.lock:
+                        server.active -= 1
+
+            def sendJson(self, status, payload):
+                body = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+    def route(self, method, path, query, body):
+        """ Returns (status, payload) of a request """
+
+        match = sg_path.match(path)
+        if (method=='GET') and (match is not None):
+            return 200, self.getSgPage(int(match.group(1)), query)
+
+        match = ps_participants_path.match(path)
+        if (method=='GET') and (match is not None):
+            return 200, self.getPsParticipants(match.group(1), query)
+
+        match = ps_send_path.match(path)
+        if (method=='POST') and (match is not None):
+            with self.lock:
+                self.sent.append((match.group(1), match.group(2), body))
+            return 200, {'sent': len(body['participants'])}
+
+        return 404, {'result_ok': False, 'message': 'Not found'}
+
+    def getPsParticipants(self, studyId, query):
+        """ Participant list; with the updatedSince parameter only entries with a later 'updatedAt' are returned """
+
+        entries = self.ps_participants.get(studyId, [])
+        if 'updatedSince' in query:
+            since = parseDate(query['updatedSince'])
+            entries = [entry for entry in entries if parseDate(entry['updatedAt']) > since]
+
+        return entries
+
+    def getSgPage(self, surveyId, query):
+        """ Mimics SG v5 surveyresponse list: 1-indexed pages and the date_submitted '>' filter """
+
+        responses = self.sg_responses.get(surveyId, [])
+        for key, field in query.items():
+            if key.startswith('filter[field]') and field=='date_submitted':
+                idx = key[len('filter[field]'):]
+                assert query['filter[operator]'+idx]=='>'
+                cache_key = (surveyId, query['filter[value]'+idx], len(responses))
+                if cache_key not in self.filtered:
+                    after = parseDate(query['filter[value]'+idx])
+                    self.filtered[cache_key] = [response for response in responses if parseDate(response['date_submitted']) > after]
+                responses = self.filtered[cache_key]
+
+        page_size = int(query.get('resultsperpage', 50))
+        page = int(query.get('page', 1))
+
+        return {
+            'result_ok': True,
+            'total_count': len(responses),
+            'page': page,
+            'total_pages': math.ceil(len(responses)/page_size),
+            'results_per_page': page_size,
+            'data': responses[(page-1)*page_size:page*page_size],}
+
+
+def makePsParticipants(n, start, days=14, prefix='', seed=None):
+    """ n PS participant entries with start dates spread over days before start (datetime, UTC) """
+
+    rnd = random.Random(seed)
+    entries = []
+    for idx in range(n):
+        date = (start - datetime.timedelta(seconds=rnd.randrange(days*24*3600))).isoformat()
+        entries.append({'id': '{}{:07d}'.format(prefix, idx), 'date': date, 'updatedAt': date})
+
+    return entries
+
+def makeSgResponses(ids, qids, submitted, complete_rate=0.5, n_questions=20, seed=None):
+    """ One SG response per participant id in ids; the (firstQID, lastQID) pairs of qids are answered with
+        complete_rate probability each. submitted is the date_submitted of all responses (datetime, UTC) """
+
+    rnd = random.Random(seed)
+    responses = []
+    for idx, id in enumerate(ids):
+
+        answered = set(['1'])
+        for firstQID, lastQID in qids:
+            if rnd.random()<complete_rate:
+                answered.update([str(firstQID), str(lastQID)])
+
+        survey_data = {str(qid): {'id': qid, 'type': 'RADIO', 'question': 'Question {}'.format(qid), 'shown': True}
+                       for qid in range(1, n_questions+1)}
+        for qid in answered:
+            survey_data[qid]['answer'] = 'Answer'
+
+        responses.append({
+            'id': str(idx),
+            'status': 'Complete',
+            'date_submitted': submitted.strftime('%Y-%m-%d %H:%M:%S GMT'),
+            'url_variables': {'sguid': {'key': 'sguid', 'value': id, 'type': 'url'}},
+            'survey_data': survey_data})
+
+    return responses
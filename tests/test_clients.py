@@ -0,0 +1,108 @@
+"""
+:Author: Balazs Szigeti <b.islander@protonmail.com>
+:Copyright: 2021, DrugNerdsLab
+:License: MIT
+
+python -m pytest psynudge/tests/
+"""
+
+from unittest import mock
+import stubserver
+import requests
+import datetime
+import pytz
+import psynudge
+import unittest
+import time
+
+
+class ClientTests(unittest.TestCase):
+    """ Tests for the shared HTTP layer, against the local stub server """
+
+    def setUp(self):
+        psynudge.clients.closeSession()
+        self.patches = [
+            mock.patch.object(psynudge.src.config, 'HTTP_BACKOFF', 0),
+            mock.patch('psynudge.src.tokens.sg_key', 'key'),
+            mock.patch('psynudge.src.tokens.sg_secret', 'secret'),]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        psynudge.clients.closeSession() # retry policy is read when the session is built
+
+    def test_keepAlive(self):
+
+        with stubserver.StubServer(ps_participants={'7': [{'id': '001'}]}) as server, \
+             mock.patch.object(psynudge.src.config, 'PS_BASE_URL', server.url+'v2/'):
+
+            self.assertIs(psynudge.clients.getSession(), psynudge.clients.getSession())
+            for idx in range(3):
+                response = psynudge.clients.psRequest('GET', 'studies/7/participants')
+                self.assertEqual(response.json(), [{'id': '001'}])
+
+            self.assertEqual(len(server.connections), 1)
+
+    def test_retry(self):
+
+        with stubserver.StubServer(sg_responses={666: [{'id': '1'}]}) as server, \
+             mock.patch.object(psynudge.src.config, 'SG_BASE_URL', server.url), \
+             mock.patch.object(psynudge.src.config, 'PS_BASE_URL', server.url+'v2/'):
+
+            # GETs are retried on 429 / 5xx
+            server.errors = [503, 429, 502]
+            resource = psynudge.clients.getSgClient().api.surveyresponse.page(value=1)
+            self.assertEqual(psynudge.clients.sgList(resource, 666)['data'], [{'id': '1'}])
+            self.assertEqual(len(server.requests), 4)
+
+            # POSTs are only retried on 429, a 5xx may have been processed
+            server.requests.clear()
+            server.errors = [429, 500]
+            response = psynudge.clients.psRequest('POST', 'studies/7/timepoints/1/send', json={'participants': ['001']})
+            self.assertEqual(response.status_code, 500)
+            self.assertEqual(len(server.requests), 2)
+            self.assertEqual(server.sent, [])
+
+            # Retries are bounded
+            server.requests.clear()
+            server.errors = [503]*(psynudge.src.config.HTTP_RETRIES+1)
+            response = psynudge.clients.psRequest('GET', 'studies/7/participants')
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(len(server.requests), psynudge.src.config.HTTP_RETRIES+1)
+
+    def test_timeout(self):
+
+        with stubserver.StubServer(latency=0.5) as server, \
+             mock.patch.object(psynudge.src.config, 'PS_BASE_URL', server.url+'v2/'), \
+             mock.patch.object(psynudge.src.config, 'HTTP_READ_TIMEOUT', 0.1), \
+             mock.patch.object(psynudge.src.config, 'HTTP_RETRIES', 0):
+
+            with self.assertRaises(requests.exceptions.RequestException):
+                psynudge.clients.psRequest('GET', 'studies/7/participants')
+
+    def test_timeout_post(self):
+        """ A POST that timed out may have been processed by PS, it is not sent again """
+
+        with stubserver.StubServer(latency=0.3) as server, \
+             mock.patch.object(psynudge.src.config, 'PS_BASE_URL', server.url+'v2/'), \
+             mock.patch.object(psynudge.src.config, 'HTTP_READ_TIMEOUT', 0.1), \
+             mock.patch.multiple('psynudge.src.tokens', ps_key='key', ps_secret='secret'):
+
+            result = psynudge.dispatch.sendBatch(psynudge.dispatch.NudgeBatch('7', 1, ['001']))
+            self.assertFalse(result.ok)
+            time.sleep(0.5) # let the stub finish the request
+            self.assertEqual(len(server.sent), 1)
+
+    def test_errorRate(self):
+
+        entries = stubserver.makePsParticipants(5, start=datetime.datetime(2021, 1, 10, tzinfo=pytz.UTC), seed=0)
+        with stubserver.StubServer(ps_participants={'7': entries}, error_rate=0.3, seed=0) as server, \
+             mock.patch.object(psynudge.src.config, 'PS_BASE_URL', server.url+'v2/'):
+
+            # Random 503s are absorbed by the retry policy
+            for idx in range(10):
+                self.assertEqual(psynudge.clients.psRequest('GET', 'studies/7/participants').json(), entries)
+            self.assertGreater(server.n_errors, 0)
+            self.assertEqual(len(server.requests), 10+server.n_errors)
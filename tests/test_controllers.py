@@ -46,16 +46,16 @@ class IntegrationTests(unittest.TestCase):
         self.assertEqual(db.Completion.select(lambda c: c.isComplete is True and c.timepoint==stack_tp2).count(), 1)
 
     @db_session
-    @mock.patch.object(db.Completion, 'isNudge')
+    @mock.patch('psynudge.src.controllers.getNudgeIds')
     def test_sendNudges(self, mock, db=db):
 
         db.Study.select(lambda s: s.name=='indep_study').first().delete()
         stack_study = db.Study.select(lambda s: s.name=='stack_study').first()
 
-        mock.return_value = False
+        mock.return_value = []
         nudge_ids = psynudge.controllers.sendNudges(db=db, isTest=True)
         self.assertEqual([(stack_study, 1, []) , (stack_study, 6, [])], nudge_ids)
 
-        mock.return_value = True
+        mock.return_value = ['004', '005', 'bLZBHf69wmDVSbXh']
         nudge_ids = psynudge.controllers.sendNudges(db=db, isTest=True)
         self.assertEqual([(stack_study, 1, ['004', '005', 'bLZBHf69wmDVSbXh']) , (stack_study, 6, ['004', '005', 'bLZBHf69wmDVSbXh'])], nudge_ids)
@@ -6,9 +6,11 @@
 python -m pytest psynudge/tests/
 """
 
-from pony.orm import db_session
+from pony.orm import db_session, rollback
 from unittest import mock
 import dateutil.parser
+import datetime
+import stubserver
 import psynudge
 import unittest
 import pytz
@@ -95,6 +97,48 @@ class CoreTests(unittest.TestCase):
         with self.assertRaises(AssertionError):
             psynudge.core.getResponseSguid(response)
 
+    def test_getResponseSguid_cache(self):
+
+        psynudge.core.sguidQids.clear()
+        response = {
+         'url_variables': [],
+         'survey_data': {
+             '71': {'id': 71, 'type': 'RADIO', 'question': 'AAAA', 'shown': True},
+             '72': {'id': 72, 'type': 'HIDDEN', 'question': 'Capture SGUID', 'answer': 'Qwwm5fd6fdlllll6', 'shown': True}}}
+
+        self.assertEqual(psynudge.core.getResponseSguid(response, surveyId=666), 'Qwwm5fd6fdlllll6')
+        self.assertEqual(psynudge.core.sguidQids[666], ('72',))
+
+        # Cached QID is looked up directly, the question text is not checked again
+        response['survey_data']['72']['question'] = 'renamed'
+        self.assertEqual(psynudge.core.getResponseSguid(response, surveyId=666), 'Qwwm5fd6fdlllll6')
+
+        # Cached QID missing from response, survey_data is rescanned
+        response['survey_data'] = {
+             '73': {'id': 73, 'type': 'HIDDEN', 'question': 'Capture SGUID', 'answer': 'aaaaaaaaaaaaaaaaa', 'shown': True}}
+        self.assertEqual(psynudge.core.getResponseSguid(response, surveyId=666), 'aaaaaaaaaaaaaaaaa')
+        self.assertEqual(psynudge.core.sguidQids[666], ('73',))
+
+        psynudge.core.sguidQids.clear()
+
+    @db_session
+    def test_getCompletionEvaluator(self):
+
+        stack_study = db.Study.select(lambda s: s.name=='stack_study').first()
+        tps = stack_study.timepoints.select()[:]
+        evaluator = psynudge.core.getCompletionEvaluator(tps=tps)
+
+        fixture_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'stack.json')
+        with open(fixture_path, 'r') as j:
+            responses = json.loads(j.read())['data']
+
+        for response in responses:
+            self.assertEqual(
+                evaluator(response),
+                [psynudge.core.assessIsComplete(response=response, tp=tp) for tp in tps])
+
+        self.assertEqual(evaluator({'survey_data': {}}), [False]*len(tps))
+
     @db_session
     @mock.patch('psynudge.src.core.getUtcNow')
     def test_getDataFileName(self, mockNow):
@@ -184,3 +228,60 @@ class CoreTests(unittest.TestCase):
     @classmethod
     def tearDownClass(self, db=db):
         del db
+
+
+class SgPagingTests(unittest.TestCase):
+    """ getSgData / iterSgResponses against a local stub of the SG v5 API """
+
+    def getResponses(self, n):
+        return [{'id': str(idx), 'date_submitted': '2021-01-{:02d} 10:00:00 GMT'.format(1+idx%28), 'survey_data': {}} for idx in range(n)]
+
+    def test_iterSgResponses(self):
+
+        responses = self.getResponses(23)
+        with stubserver.StubServer(sg_responses={666: responses}, latency=0.05) as server, \
+             mock.patch.object(psynudge.src.config, 'SG_BASE_URL', server.url), \
+             mock.patch('psynudge.src.tokens.sg_key', 'key'), \
+             mock.patch('psynudge.src.tokens.sg_secret', 'secret'):
+
+            meta = {}
+            result = list(psynudge.core.iterSgResponses(surveyId=666, meta=meta, page_size=5, max_workers=2))
+
+            self.assertEqual(sorted(result, key=lambda r: int(r['id'])), responses)
+            self.assertEqual(meta, {'result_ok': True, 'total_count': 23, 'total_pages': 5, 'page': 1, 'results_per_page': 5})
+            self.assertEqual(sorted(int(query['page']) for method, path, query, body in server.requests), [1, 2, 3, 4, 5])
+            self.assertTrue(all(query['resultsperpage']=='5' for method, path, query, body in server.requests))
+            self.assertEqual(server.max_active, 2)
+
+            # Filtered download, single page
+            server.requests.clear()
+            result = list(psynudge.core.iterSgResponses(surveyId=666, lastSgCheck='2021-01-20T00:00:00+00:00', page_size=100))
+            self.assertEqual(result, [response for response in responses if response['date_submitted']>'2021-01-20'])
+            self.assertEqual(len(server.requests), 1)
+
+            # Empty survey
+            meta = {}
+            self.assertEqual(list(psynudge.core.iterSgResponses(surveyId=777, meta=meta)), [])
+            self.assertEqual(meta['total_pages'], 0)
+
+    @db_session
+    @mock.patch('psynudge.src.core.getUtcNow')
+    def test_getSgData_paged(self, mockNow):
+
+        mockNow.return_value = datetime.datetime(2021, 2, 1, tzinfo=pytz.UTC)
+        study = db.Study.select(lambda s: s.name=='stack_study').first()
+        tp = study.timepoints.select().first()
+
+        responses = self.getResponses(12)
+        with stubserver.StubServer(sg_responses={tp.surveyId: responses}) as server, \
+             mock.patch.object(psynudge.src.config, 'SG_BASE_URL', server.url), \
+             mock.patch.object(psynudge.src.config, 'SG_PAGE_SIZE', 5), \
+             mock.patch('psynudge.src.tokens.sg_key', 'key'), \
+             mock.patch('psynudge.src.tokens.sg_secret', 'secret'):
+            sg_data = psynudge.core.getSgData(study=study, getAll=True)
+
+        self.assertEqual(len(sg_data['data']), 12)
+        self.assertEqual(sg_data['total_pages'], 3)
+        for tp in study.timepoints:
+            self.assertEqual(tp.lastSgCheck, '2021-02-01T00:00:00+00:00')
+        rollback()
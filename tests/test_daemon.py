@@ -0,0 +1,94 @@
+"""
+:Author: Balazs Szigeti <b.islander@protonmail.com>
+:Copyright: 2021, DrugNerdsLab
+:License: MIT
+
+python -m pytest psynudge/tests/
+"""
+
+from pony.orm import db_session
+from unittest import mock
+import stubserver
+import threading
+import psynudge
+import datetime
+import tempfile
+import unittest
+import pytz
+import time
+import os
+
+
+class DaemonTests(unittest.TestCase):
+    """ Tests for the resident job scheduler """
+
+    def runFor(self, jobs, seconds):
+
+        scheduler = psynudge.daemon.Scheduler(jobs, tick=0.01)
+        thread = threading.Thread(target=scheduler.run)
+        thread.start()
+        time.sleep(seconds)
+        scheduler.stop()
+        thread.join(timeout=5)
+        self.assertFalse(thread.is_alive())
+
+    def test_scheduler(self):
+
+        lock, active, max_active = threading.Lock(), [0], [0]
+        def slow():
+            with lock:
+                active[0] += 1
+                max_active[0] = max(max_active[0], active[0])
+            time.sleep(0.25)
+            with lock:
+                active[0] -= 1
+
+        def failing():
+            raise ValueError('failing job')
+
+        slowJob = psynudge.daemon.Job('slow', slow, interval=0.05)
+        fastJob = psynudge.daemon.Job('fast', lambda: None, interval=0.05)
+        failingJob = psynudge.daemon.Job('failing', failing, interval=0.05)
+        delayedJob = psynudge.daemon.Job('delayed', lambda: None, interval=0.05, delay=10)
+        self.runFor([slowJob, fastJob, failingJob, delayedJob], 0.6)
+
+        # Runs of a job never overlap, overdue runs are skipped
+        self.assertEqual(max_active[0], 1)
+        self.assertIn(slowJob.runs, [2, 3])
+        self.assertGreater(slowJob.skipped, 0)
+
+        # Other jobs are not held up by a slow or failing job
+        self.assertGreater(fastJob.runs, 5)
+        self.assertGreater(failingJob.failures, 5)
+        self.assertEqual(failingJob.failures, failingJob.runs)
+        self.assertEqual(delayedJob.runs, 0)
+
+    def test_getJobs(self):
+        """ The daemon jobs sync and nudge against the PS / SG stub without writing data files """
+
+        now = datetime.datetime.now(pytz.UTC)
+        ps_participants = {study['id']: stubserver.makePsParticipants(5, start=now, days=3, prefix=study['name'], seed=0)
+                           for study in psynudge.db.get_skeleton(mock_db=True)}
+
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+             stubserver.StubServer(ps_participants=ps_participants) as server, \
+             mock.patch.object(psynudge.src.config, 'PS_BASE_URL', server.url+'v2/'), \
+             mock.patch.object(psynudge.src.config, 'SG_BASE_URL', server.url), \
+             mock.patch.object(psynudge.src.config, 'NUDGE_RATE_PER_STUDY', None), \
+             mock.patch.multiple('psynudge.src.tokens', sg_key='key', sg_secret='secret', ps_key='key', ps_secret='secret'), \
+             mock.patch('psynudge.src.controllers.saveData') as mockSave, \
+             mock.patch('psynudge.src.controllers.iterSaveData') as mockIterSave:
+
+            db = psynudge.db.build_skeleton_database(filepath=os.path.join(tmp_dir, 'test.sqlite'), create_db=True, mock_db=True)
+            jobs = psynudge.daemon.getJobs(db, mock_db=True)
+            self.assertEqual([job.name for job in jobs], ['reconcileDatabase', 'updatePsData2Db', 'updateSgData2Db', 'sendNudges'])
+            self.assertIs(jobs[0].lock, jobs[1].lock)
+            for job in jobs:
+                job.run()
+                self.assertEqual((job.runs, job.failures), (1, 0), job.name)
+
+            with db_session:
+                self.assertEqual(db.Participant.select().count(), 5*len(ps_participants))
+            db.disconnect()
+
+        self.assertFalse(mockSave.called or mockIterSave.called)
@@ -6,13 +6,19 @@
 python -m pytest psynudge/tests/
 """
 
-from pony.orm import db_session
+from pony.orm import db_session, commit, rollback
 from unittest import mock
 import dateutil.parser
+import stubserver
+import datetime
 import psynudge
+import threading
+import tempfile
 import unittest
+import sqlite3
 import pytz
 import json
+import time
 import os
 
 
@@ -165,6 +171,291 @@ class DatabaseTests(unittest.TestCase):
         self.assertEqual(db.Participant.select(lambda p: p.id=="011").first().whenStart, '2020-01-22T05:00:00+00:00')
         self.assertEqual(comp.whenStartTp(), '2020-01-23T05:00:00+00:00')
 
+
+        # Participant 011 listed under another study
+        stack_study = db.Study.select(lambda study: study.name=='stack_study').first()
+        psynudge.core.updateParticipant(db=db, ps_data=mock_ps2, study=stack_study)
+
+        self.assertEqual(db.Participant.select().count(), 11)
+        self.assertEqual(db.Participant.select(lambda p: p.id=="011").first().study, stack_study)
+        self.assertEqual(db.Completion.select(lambda c: c.participant.id=="011").count(), stack_study.timepoints.count())
+
+        db.rollback()
+
+    def test_updateParticipant_queryCount(self, db=db):
+        """ number of queries issued by updateParticipant must not depend on the payload size """
+
+        query_counts = []
+        for n_entries in [10, 500]:
+            with db_session:
+                study = db.Study.select(lambda study: study.name=='indep_study').first()
+                mock_ps = [{"date":"2020-01-10T00:00:00+00:00", "id":"{:04d}".format(idx)} for idx in range(n_entries)]
+
+                db.merge_local_stats()
+                psynudge.core.updateParticipant(db=db, ps_data=mock_ps, study=study)
+                query_counts.append(db.local_stats[None].db_count)
+
+                self.assertEqual(db.Participant.select().count(), n_entries)
+                self.assertEqual(db.Completion.select().count(), n_entries*2)
+
+                # Resending the same payload does not add / recreate anyone
+                psynudge.core.updateParticipant(db=db, ps_data=mock_ps+mock_ps[:5], study=study)
+                self.assertEqual(db.Participant.select().count(), n_entries)
+                self.assertEqual(db.Completion.select().count(), n_entries*2)
+
+                db.rollback()
+
+        self.assertEqual(query_counts[0], query_counts[1])
+
+    @db_session
+    def test_updatePsData2Db_concurrent(self, db=db):
+        """ PS downloads of all active studies overlap, DB updates are applied in study order """
+
+        lock, active, max_active = threading.Lock(), [0], [0]
+        def fetchPsData(studyId, since=None):
+            with lock:
+                active[0] += 1
+                max_active[0] = max(max_active[0], active[0])
+            time.sleep(0.1)
+            with lock:
+                active[0] -= 1
+            return [{"date":"2020-01-10T00:00:00+00:00", "id":"{}_{:03d}".format(studyId, idx)} for idx in range(3)]
+
+        with mock.patch('psynudge.src.controllers.fetchPsData', side_effect=fetchPsData):
+            psynudge.controllers.updatePsData2Db(db=db, save=False, delete_past=False)
+
+        self.assertEqual(max_active[0], db.Study.select(lambda s: s.isActive is True).count())
+        for study in db.Study.select(lambda s: s.isActive is True):
+            self.assertEqual(study.participants.count(), 3)
+        self.assertEqual(len(list(psynudge.controllers.mapConcurrently(fetchPsData, []))), 0)
+
+        db.rollback()
+
+    def test_updatePsData2Db_deletePast(self):
+        """ Past participants of all studies are archived within the sync of the studies, with the default delete_past """
+
+        test_db = psynudge.db.build_skeleton_database(filepath=':memory:', create_db=True, mock_db=True)
+        def fetchPsData(studyId, since=None):
+            return [{"date":date, "id":"{}_{}".format(studyId, idx)} for idx, date in enumerate(["2020-01-10T00:00:00+00:00", "2100-01-10T00:00:00+00:00"])]
+
+        with mock.patch('psynudge.src.controllers.fetchPsData', side_effect=fetchPsData):
+            psynudge.controllers.updatePsData2Db(db=test_db, save=False)
+
+        with db_session:
+            n_studies = test_db.Study.select(lambda s: s.isActive is True).count()
+            self.assertEqual(test_db.Participant.select().count(), n_studies)
+            self.assertEqual(test_db.ParticipantArchive.select().count(), n_studies)
+            self.assertEqual(test_db.Study.select(lambda s: s.lastPsCheckTs==psynudge.db.DEFAULT_TS).count(), 0)
+
+    def test_streamConcurrently(self):
+        """ Items are handed over in input order, calls run at most buffer items ahead of the consumer """
+
+        produced = []
+        def produce(start, n):
+            for idx in range(start, start+n):
+                produced.append(idx)
+                yield idx
+
+        consumed, ahead = [], []
+        for items in psynudge.controllers.streamConcurrently(produce, [{'start': 0, 'n': 50}, {'start': 50, 'n': 50}], max_workers=2, buffer=5):
+            for idx in items:
+                time.sleep(0.001)
+                consumed.append(idx)
+                ahead.append(len(produced)-len(consumed))
+
+        self.assertEqual(consumed, list(range(100)))
+        self.assertLessEqual(max(ahead), 2*(5+1)) # a full queue and an item waiting to be put, per call
+
+        def fail():
+            yield 1
+            raise ValueError('download failed')
+        with self.assertRaises(ValueError):
+            for items in psynudge.controllers.streamConcurrently(fail, [{}]):
+                list(items)
+
+    @db_session
+    def test_updateSgData2Db_streamed(self, db=db):
+        """ SG responses are processed as pages arrive; lastSgCheck is the time before the download """
+
+        study = db.Study.select(lambda s: s.name=='stack_study').first()
+        for other in db.Study.select(lambda s: s.id!=study.id):
+            other.isActive = False
+        tps = study.timepoints.select()[:]
+        ids = ['s{:03d}'.format(idx) for idx in range(12)]
+        psynudge.core.updateParticipant(db=db, study=study, ps_data=[{"date":"2021-01-01T00:00:00+00:00", "id":id} for id in ids])
+        responses = stubserver.makeSgResponses(ids, [(tp.firstQID, tp.lastQID) for tp in tps],
+            datetime.datetime(2021, 1, 2, tzinfo=pytz.UTC), complete_rate=1)
+
+        checked = []
+        def getUtcNow():
+            checked.append(len(server.requests))
+            return datetime.datetime(2021, 2, 1, tzinfo=pytz.UTC)
+
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+             stubserver.StubServer(sg_responses={tps[0].surveyId: responses}) as server, \
+             mock.patch.object(psynudge.src.config, 'SG_BASE_URL', server.url), \
+             mock.patch.object(psynudge.src.config, 'SG_PAGE_SIZE', 5), \
+             mock.patch.object(psynudge.src.config, 'SYNC_STREAM_BUFFER', 3), \
+             mock.patch('psynudge.src.tokens.sg_key', 'key'), \
+             mock.patch('psynudge.src.tokens.sg_secret', 'secret'), \
+             mock.patch('psynudge.src.controllers.getUtcNow', side_effect=getUtcNow), \
+             mock.patch('psynudge.src.controllers.getDataFilePath', return_value=os.path.join(tmp_dir, 'sg.json')), \
+             mock.patch.dict(psynudge.core.sguidQids, clear=True): # QIDs cached for the fixture survey by other tests
+
+            psynudge.controllers.updateSgData2Db(db=db, save=True, getAll=True)
+            with open(os.path.join(tmp_dir, 'sg.json')) as file:
+                saved = json.load(file)
+
+        self.assertEqual(checked, [0])
+        self.assertEqual(len(server.requests), 3)
+        for tp in tps:
+            self.assertEqual(tp.lastSgCheck, '2021-02-01T00:00:00+00:00')
+        self.assertEqual(db.Completion.select(lambda c: c.isComplete is True).count(), len(ids)*len(tps))
+        self.assertEqual(len(saved['data']), len(ids))
+        self.assertEqual(saved['total_count'], len(ids))
+
+        db.rollback()
+
+    def test_updateSgData2Db_boundedCache(self):
+        """ SGUID batches are committed in their own db_session, the ORM cache does not grow with the survey """
+
+        test_db = psynudge.db.build_skeleton_database(filepath=':memory:', create_db=True, mock_db=True)
+        ids = ['{:05d}'.format(idx) for idx in range(3*psynudge.db.MAX_SQL_VARS+10)]
+        with db_session:
+            study = test_db.Study.select(lambda s: s.name=='indep_study').first()
+            for other in test_db.Study.select(lambda s: s.id!=study.id):
+                other.isActive = False
+            tps = study.timepoints.select()[:]
+            sg_responses = {tp.surveyId: stubserver.makeSgResponses(ids, [(tp.firstQID, tp.lastQID)],
+                datetime.datetime(2021, 1, 2, tzinfo=pytz.UTC), complete_rate=1) for tp in tps}
+            psynudge.core.updateParticipant(db=test_db, study=study, ps_data=[{"date":"2021-01-01T00:00:00+00:00", "id":id} for id in ids])
+
+        cached = []
+        getCompletionMap = psynudge.core.getCompletionMap
+        def countCached(db, sguids, tps):
+            completions = getCompletionMap(db, sguids, tps)
+            cached.append(len(db._get_cache().objects))
+            return completions
+
+        with stubserver.StubServer(sg_responses=sg_responses) as server, \
+             mock.patch.object(psynudge.src.config, 'SG_BASE_URL', server.url), \
+             mock.patch('psynudge.src.tokens.sg_key', 'key'), \
+             mock.patch('psynudge.src.tokens.sg_secret', 'secret'), \
+             mock.patch('psynudge.src.controllers.getUtcNow', return_value=datetime.datetime(2021, 2, 1, tzinfo=pytz.UTC)), \
+             mock.patch('psynudge.src.core.getCompletionMap', side_effect=countCached), \
+             mock.patch.dict(psynudge.core.sguidQids, clear=True):
+            psynudge.controllers.updateSgData2Db(db=test_db, save=False, getAll=True)
+
+        self.assertEqual(len(cached), 2*4) # 4 batches per survey
+        self.assertLess(max(cached), 2*psynudge.db.MAX_SQL_VARS+10) # the Completions and Participants of one batch
+
+        with db_session:
+            self.assertEqual(test_db.Completion.select(lambda c: c.isComplete is True).count(), len(ids)*len(tps))
+            for tp in test_db.Timepoint.select(lambda tp: tp.study.id==study.id):
+                self.assertEqual(tp.lastSgCheck, '2021-02-01T00:00:00+00:00')
+
+    @db_session
+    def test_updatePsData2Db_delta(self, db=db):
+        """ PS downloads are deltas since the last check, with a full download every PS_FULL_SYNC_INTERVAL """
+
+        studyId = '38130fdb-5c9e-11eb-ac63-0a280c4496dd'
+        entries = [{"date":"2021-01-01T00:00:00+00:00", "id":"{:03d}".format(idx), "updatedAt":"2021-01-01T00:00:00+00:00"} for idx in range(3)]
+        for study in db.Study.select(lambda s: s.id!=studyId):
+            study.isActive = False
+
+        def updateAt(dt):
+            with mock.patch('psynudge.src.controllers.getUtcNow', return_value=dt):
+                psynudge.controllers.updatePsData2Db(db=db, save=False, delete_past=False)
+            return [query for method, path, query, body in server.requests if method=='GET']
+
+        with stubserver.StubServer(ps_participants={studyId: entries}) as server, \
+             mock.patch.object(psynudge.src.config, 'PS_BASE_URL', server.url+'v2/'):
+
+            # First run is a full download
+            self.assertEqual(updateAt(datetime.datetime(2021, 1, 2, 0, tzinfo=pytz.UTC)), [{}])
+            self.assertEqual(db.Participant.select().count(), 3)
+            self.assertEqual(db.Study[studyId].lastPsFullCheck, '2021-01-02T00:00:00+00:00')
+
+            # Later runs only download what changed since the last check
+            server.requests.clear()
+            entries.append({"date":"2021-01-02T00:00:00+00:00", "id":"003", "updatedAt":"2021-01-02T00:30:00+00:00"})
+            self.assertEqual(updateAt(datetime.datetime(2021, 1, 2, 1, tzinfo=pytz.UTC)), [{'updatedSince': '2021-01-01T23:55:00+00:00'}])
+            self.assertEqual(db.Participant.select().count(), 4)
+            self.assertEqual(db.Study[studyId].lastPsCheck, '2021-01-02T01:00:00+00:00')
+            self.assertEqual(db.Study[studyId].lastPsFullCheck, '2021-01-02T00:00:00+00:00')
+
+            # Full reconciliation once PS_FULL_SYNC_INTERVAL passed
+            server.requests.clear()
+            self.assertEqual(updateAt(datetime.datetime(2021, 1, 3, 0, tzinfo=pytz.UTC)), [{}])
+            self.assertEqual(db.Study[studyId].lastPsFullCheck, '2021-01-03T00:00:00+00:00')
+
+        db.rollback()
+
+    @db_session
+    def test_diffPayload(self, db=db):
+
+        study = db.Study.select(lambda study: study.name=='stack_study').first()
+        entries = [{"date":"2020-01-10T00:00:00+00:00", "id":"{:03d}".format(idx)} for idx in range(3)]
+
+        self.assertEqual(psynudge.core.diffPayload(db, study, entries), entries)
+        self.assertEqual(psynudge.core.diffPayload(db, study, entries), [])
+        self.assertEqual(psynudge.core.diffPayload(db, study, [dict(reversed(list(entry.items()))) for entry in entries]), [])
+        self.assertEqual(psynudge.core.diffPayload(db, study, entries, force=True), entries)
+
+        # Entry level diff
+        entries[1] = {"date":"2020-02-10T00:00:00+00:00", "id":"001"}
+        entries.append({"date":"2020-01-10T00:00:00+00:00", "id":"003"})
+        self.assertEqual(psynudge.core.diffPayload(db, study, entries), [entries[1], entries[3]])
+
+        # Delta payloads are merged into the stored digests
+        self.assertEqual(psynudge.core.diffPayload(db, study, entries[:1], merge=True), [])
+        self.assertEqual(psynudge.core.diffPayload(db, study, entries[3:], merge=True), [])
+
+        # One digest per study
+        self.assertEqual(db.Digest.select().count(), 1)
+
+        # Unchanged payload is not processed again
+        with mock.patch('psynudge.src.controllers.fetchPsData', return_value=entries), \
+             mock.patch('psynudge.src.controllers.updateParticipant') as mockUpdate, \
+             mock.patch.object(psynudge.src.config, 'PS_DELTA_PARAM', None):
+            for study in db.Study.select():
+                study.lastPsFullCheckTs = psynudge.mydt.dt2ts(psynudge.mydt.getUtcNow())
+            psynudge.controllers.updatePsData2Db(db=db, save=False, delete_past=False)
+            self.assertEqual(mockUpdate.call_count, 1) # indep_study is new, stack_study is unchanged
+
+        db.rollback()
+
+    @db_session
+    def test_completionWindow(self, db=db):
+
+        study = db.Study.select(lambda study: study.name=='indep_study').first()
+        tp2 = db.Timepoint.select(lambda tp: tp.name=='indep_tp2').first()
+        psynudge.core.updateParticipant(db=db, study=study,
+            ps_data=[{"date":"2020-01-10T00:00:00-05:00", "id":"011"}])
+
+        # indep_tp2: td2start=6d, td2end=1d, td2nudge=2d
+        comp = db.Completion.select(lambda c: c.timepoint==tp2 and c.participant.id=="011").first()
+        self.assertEqual(comp.whenStartTp(), '2020-01-16T05:00:00+00:00')
+        self.assertEqual(comp.whenEndTp(), '2020-01-17T05:00:00+00:00')
+        self.assertEqual(comp.whenEndNudge(), '2020-01-19T05:00:00+00:00')
+        comp.isComplete = True
+        comp.lastNudgeSend = '2020-01-17T06:00:00+00:00'
+
+        # Start date moved: window is refreshed, completion state is reset
+        psynudge.core.updateParticipant(db=db, study=study,
+            ps_data=[{"date":"2020-02-10T00:00:00-05:00", "id":"011"}])
+        self.assertEqual(db.Completion.select().count(), 2)
+        comp = db.Completion.select(lambda c: c.timepoint==tp2 and c.participant.id=="011").first()
+        self.assertEqual(comp.whenStartTp(), '2020-02-16T05:00:00+00:00')
+        self.assertEqual(comp.whenEndTp(), '2020-02-17T05:00:00+00:00')
+        self.assertEqual(comp.whenEndNudge(), '2020-02-19T05:00:00+00:00')
+        self.assertFalse(comp.isComplete)
+        self.assertEqual(comp.lastNudgeSend, '2020-01-01T00:00:00+00:00')
+
+        # Nudge candidates are found with an index range scan
+        plan = db.execute('EXPLAIN QUERY PLAN SELECT id FROM Completion WHERE whenEndNudgeTs >= 1581000000 AND whenEndTpTs <= 1581000000').fetchall()
+        self.assertTrue(any('USING INDEX' in str(row) for row in plan))
+
         db.rollback()
 
     @db_session
@@ -192,12 +483,32 @@ class DatabaseTests(unittest.TestCase):
         self.assertEqual(db.Completion.select().count(), db.Participant.select().count()*2)
 
         # All participants are past case
+        db.Completion.select().first().lastNudgeSendTs = 1579392000
         mock.return_value = dateutil.parser.parse("2020-01-31T22:22:22+00:00").astimezone(pytz.timezone('UTC'))
-        psynudge.core.deletePastParticipant(db=db)
+        self.assertEqual(psynudge.core.deletePastParticipant(db=db), 2)
         self.assertEqual(db.Participant.select().count(), 0)
         self.assertEqual(db.Completion.select().count(), db.Participant.select().count()*2)
 
-        db.rollback()
+        # Deleted participants are kept in the archive
+        self.assertEqual(db.ParticipantArchive.select().count(), 10)
+        self.assertEqual(db.CompletionArchive.select().count(), 20)
+        self.assertEqual(db.CompletionArchive.select(lambda c: c.lastNudgeSendTs==1579392000).count(), 1)
+        self.assertEqual(psynudge.core.deletePastParticipant(db=db), 0)
+
+        # PS keeps listing finished participants, full syncs do not bring them back nor archive them again
+        for idx in range(3):
+            psynudge.core.updateParticipant(
+                db = db,
+                ps_file_path = os.path.join(test_dir, 'fixtures', 'ps_data.json'),
+                study = db.Study.select(lambda study: study.name=='indep_study').first())
+            self.assertEqual(db.Participant.select().count(), 0)
+            self.assertEqual(psynudge.core.deletePastParticipant(db=db), 0)
+        self.assertEqual(db.CompletionArchive.select().count(), 20)
+
+        # deletePastParticipant commits, the archive would keep the fixture participants out of the other tests
+        db.ParticipantArchive.select().delete(bulk=True)
+        db.CompletionArchive.select().delete(bulk=True)
+        commit()
 
     @db_session
     def test_updateIsCompleteIndep(self, db=db):
@@ -252,6 +563,40 @@ class DatabaseTests(unittest.TestCase):
 
         db.rollback()
 
+    def test_updateIsComplete_queryCount(self, db=db):
+        """ SGUIDs are resolved to Completions in chunks, not with one query per response """
+
+        def getResponse(sguid, isComplete):
+            survey_data = {
+                '2': {'id': 2, 'question': 'Which case?', 'answer': 'B', 'shown': True},
+                '18': {'id': 18, 'question': 'Do you love science?', 'shown': True}}
+            if isComplete:
+                survey_data['18']['answer'] = 'Yes'
+            return {'url_variables': {'sguid': {'key': 'sguid', 'value': sguid, 'type': 'url'}}, 'survey_data': survey_data}
+
+        query_counts = []
+        for n_responses in [10, 2*psynudge.db.MAX_SQL_VARS+10]:
+            with db_session:
+                study = db.Study.select(lambda study: study.name=='indep_study').first()
+                tp1 = db.Timepoint.select(lambda tp: tp.name=='indep_tp1').first()
+                ids = ['{:05d}'.format(idx) for idx in range(n_responses)]
+                psynudge.core.updateParticipant(db=db, study=study, ps_data=[{"date":"2020-01-10T00:00:00Z", "id":id} for id in ids])
+                alchemy_data = {'data': [getResponse(id, isComplete=(idx%3==0)) for idx, id in enumerate(ids)] + [getResponse('unknown', True)]}
+
+                db.merge_local_stats()
+                psynudge.core.updateIsCompleteIndep(db=db, tp=tp1, alchemy_data=alchemy_data)
+                db.flush()
+                query_counts.append(db.local_stats[None].db_count)
+
+                self.assertEqual(db.Completion.select(lambda c: c.isComplete is True).count(), len(range(0, n_responses, 3)))
+                self.assertTrue(db.Completion.select(lambda c: c.participant.id=='00003' and c.timepoint==tp1).first().isComplete)
+                self.assertFalse(db.Completion.select(lambda c: c.participant.id=='00004' and c.timepoint==tp1).first().isComplete)
+                db.rollback()
+
+        # one select per MAX_SQL_VARS responses, plus the UPDATEs of the changed rows
+        self.assertEqual(query_counts[0], 1 + len(range(0, 10, 3)))
+        self.assertEqual(query_counts[1], 3 + len(range(0, 2*psynudge.db.MAX_SQL_VARS+10, 3)))
+
     @db_session
     def test_updateIsCompleteStack(self, db=db):
 
@@ -442,3 +787,327 @@ class DatabaseTests(unittest.TestCase):
         self.assertTrue(completion.isNudgeTimely())
 
         db.rollback()
+
+    @db_session
+    @mock.patch('psynudge.src.mydt.getUtcNow')
+    @mock.patch('psynudge.src.db.getUtcNow')
+    @mock.patch('psynudge.src.core.getUtcNow')
+    def test_getNudgeIds(self, mockCore, mockDb, mockMydt):
+        """ SQL side nudge selection has to agree with Completion.isNudge() """
+
+        psynudge.core.updateParticipant(
+            db = db,
+            ps_file_path = os.path.join(test_dir, 'fixtures', 'ps_data.json'),
+            study = db.Study.select(lambda study: study.name=='indep_study').first())
+        tp1 = db.Timepoint.select(lambda tp: tp.name=='indep_tp1').first()
+        tp2 = db.Timepoint.select(lambda tp: tp.name=='indep_tp2').first()
+
+        db.Completion.select(lambda c: c.participant.id=='002' and c.timepoint==tp1).first().isComplete = True
+        db.Completion.select(lambda c: c.participant.id=='003' and c.timepoint==tp1).first().lastNudgeSend = '2020-01-11T12:00:00+00:00'
+
+        for now in ["2020-01-11T23:00:00Z", "2020-01-12T02:30:00Z", "2020-01-13T03:30:00Z", "2020-01-13T04:30:00Z",
+                    "2020-01-17T00:00:00Z", "2020-01-18T12:00:00Z", "2020-01-19T05:00:00Z"]:
+            mockCore.return_value = dateutil.parser.parse(now).astimezone(pytz.timezone('UTC'))
+            mockDb.return_value = mockCore.return_value
+            mockMydt.return_value = mockCore.return_value
+
+            for tp in [tp1, tp2]:
+                expected = sorted([c.participant.id for c in tp.completions if c.isNudge()])
+                self.assertEqual(psynudge.core.getNudgeIds(db=db, tp=tp), expected)
+
+        mockCore.return_value = dateutil.parser.parse("2020-01-12T02:30:00Z").astimezone(pytz.timezone('UTC'))
+        self.assertEqual(psynudge.core.getNudgeIds(db=db, tp=tp1), ['004', '005', '006', '007', '008', '009', '010'])
+
+        db.rollback()
+
+class ReconcileTests(unittest.TestCase):
+
+    def test_reconcile_skeleton(self):
+        """ Existing DB is brought in line with the skeleton, participant data and nudge history are kept """
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = psynudge.db.build_skeleton_database(filepath=os.path.join(tmp_dir, 'test.sqlite'), create_db=True, mock_db=True)
+            with db_session:
+                study = db.Study.select(lambda s: s.name=='indep_study').first()
+                psynudge.core.updateParticipant(db=db, study=study, ps_data=[
+                    {"date":"2021-01-01T00:00:00+00:00", "id":"001"},
+                    {"date":"2021-01-01T00:00:00+00:00", "id":"002"}])
+                for completion in db.Completion.select():
+                    completion.lastNudgeSendTs = 1609459200
+
+            # Skeleton unchanged, nothing to do
+            self.assertEqual(psynudge.db.reconcile_skeleton(db, mock_db=True), {
+                name: {'inserted': 0, 'updated': 0, 'deleted': 0} for name in ['StudyType', 'Study', 'Timepoint']})
+
+            # Changed offsets, a removed study
+            skeleton = psynudge.db.get_skeleton(mock_db=True)[:1]
+            skeleton[0]['timepoints'][0]['td2end'] = datetime.timedelta(days=2)
+            with mock.patch('psynudge.src.db.get_skeleton', return_value=skeleton):
+                counts = psynudge.db.reconcile_skeleton(db, mock_db=True)
+
+            self.assertEqual(counts['Study'], {'inserted': 0, 'updated': 0, 'deleted': 1})
+            self.assertEqual(counts['Timepoint'], {'inserted': 0, 'updated': 1, 'deleted': 0})
+            with db_session:
+                self.assertEqual(db.Study.select().count(), 1)
+                completion = db.Completion.select(lambda c: c.participant.id=='001' and c.timepoint.name=='indep_tp1').first()
+                self.assertEqual(psynudge.mydt.ts2iso(completion.whenEndTpTs), '2021-01-04T00:00:00+00:00')
+                self.assertEqual(db.Completion.select(lambda c: c.lastNudgeSendTs==1609459200).count(), 4)
+
+                # Participants no longer listed by PS
+                study = db.Study.select().first()
+                self.assertEqual(psynudge.core.pruneParticipants(db=db, study=study, ids=['001', '003']), 1)
+                self.assertEqual([p.id for p in db.Participant.select()], ['001'])
+                self.assertEqual(db.Completion.select().count(), 2)
+
+            db.disconnect()
+
+
+class ScheduleTests(unittest.TestCase):
+
+    def test_get_schedule(self):
+        """ Schedule is built once, sorted by offset and rebuilt only when timepoint offsets change """
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = psynudge.db.build_skeleton_database(filepath=os.path.join(tmp_dir, 'test.sqlite'), create_db=True, mock_db=True)
+            with db_session:
+                study = db.Study.select(lambda s: s.name=='indep_study').first()
+                schedule = study.getSchedule()
+                self.assertIs(study.getSchedule(), schedule)
+                self.assertEqual([tp.name for tp in schedule.tps], ['indep_tp1', 'indep_tp2'])
+                self.assertEqual(schedule.furthestTd, datetime.timedelta(days=9))
+                self.assertEqual(study.getFurthestTp().name, 'indep_tp2')
+                self.assertEqual(study.getFirstTp().name, 'indep_tp1')
+                with self.assertRaises(AttributeError):
+                    schedule.tps[0].toStart = 0
+
+                # SG checks leave the schedule alone
+                for tp in study.timepoints:
+                    tp.lastSgCheckTs = 1609459200
+                commit()
+                self.assertIs(study.getSchedule(), schedule)
+
+            skeleton = psynudge.db.get_skeleton(mock_db=True)
+            skeleton[0]['timepoints'][1]['td2end'] = datetime.timedelta(days=2)
+            with mock.patch('psynudge.src.db.get_skeleton', return_value=skeleton):
+                psynudge.db.reconcile_skeleton(db, mock_db=True)
+
+            with db_session:
+                study = db.Study.select(lambda s: s.name=='indep_study').first()
+                self.assertIsNot(study.getSchedule(), schedule)
+                self.assertEqual(study.getFurthestTd(), datetime.timedelta(days=10))
+
+            # Schedules of uncommitted timepoints are not cached, a rollback leaves nothing behind
+            with db_session:
+                study = db.Study.select(lambda s: s.name=='indep_study').first()
+                db.Timepoint(study=study, name='phantom', psId=9, surveyId=1, firstQID=1, lastQID=2,
+                    td2start=datetime.timedelta(days=30), td2end=datetime.timedelta(days=1), td2nudge=datetime.timedelta(days=1))
+                self.assertEqual(study.getFurthestTd(), datetime.timedelta(days=32))
+                rollback()
+
+            with db_session:
+                study = db.Study.select(lambda s: s.name=='indep_study').first()
+                self.assertEqual(study.getFurthestTd(), datetime.timedelta(days=10))
+                self.assertIs(study.getSchedule(), study.getSchedule())
+                psynudge.core.updateParticipant(db=db, study=study, ps_data=[{"date":"2021-01-01T00:00:00+00:00", "id":"001"}])
+                self.assertEqual(db.Completion.select().count(), 2)
+
+            # Timepoints reconciled by another process, e.g. run_rebuild_database.py next to the daemon
+            other = psynudge.db.open_database(filepath=os.path.join(tmp_dir, 'test.sqlite'))
+            skeleton = psynudge.db.get_skeleton(mock_db=True)
+            skeleton[0]['timepoints'] = skeleton[0]['timepoints'][:1]
+            with mock.patch('psynudge.src.db.get_skeleton', return_value=skeleton):
+                psynudge.db.reconcile_skeleton(other, mock_db=True)
+            other.disconnect()
+
+            fetchPsData = lambda studyId, since=None: [{"date":"2021-01-01T00:00:00+00:00", "id":"{}_002".format(studyId)}]
+            with mock.patch('psynudge.src.controllers.fetchPsData', side_effect=fetchPsData):
+                psynudge.controllers.updatePsData2Db(db=db, save=False, delete_past=False)
+
+            with db_session:
+                study = db.Study.select(lambda s: s.name=='indep_study').first()
+                self.assertEqual(len(study.getSchedule().tps), 1)
+                self.assertEqual(db.Completion.select(lambda c: c.participant.id==study.id+'_002').count(), 1)
+
+            db.disconnect()
+
+class ShardTests(unittest.TestCase):
+
+    def test_runShards(self):
+        """ One file per study, processed in worker processes, queried together through the catalog """
+
+        indepId, stackId = '38130fdb-5c9e-11eb-ac63-0a280c4496dd', '3f4241b2-5cbb-11eb-ac63-0a280c4496dd'
+        ps_participants = {
+            indepId: [{"date":"2021-01-01T00:00:00+00:00", "updatedAt":"2021-01-01T00:00:00+00:00", "id":"i{:03d}".format(idx)} for idx in range(3)],
+            stackId: [{"date":"2021-01-01T00:00:00+00:00", "updatedAt":"2021-01-01T00:00:00+00:00", "id":"s{:03d}".format(idx)} for idx in range(5)],}
+        jobs = [('updatePsData2Db', {'save': False, 'delete_past': False})]
+
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+             stubserver.StubServer(ps_participants=ps_participants) as server, \
+             mock.patch.object(psynudge.src.config, 'PS_BASE_URL', server.url+'v2/'), \
+             mock.patch.object(psynudge.src.config, 'SG_BASE_URL', server.url), \
+             mock.patch.multiple('psynudge.src.tokens', sg_key='key', sg_secret='secret', ps_key='key', ps_secret='secret'):
+
+            filepath = os.path.join(tmp_dir, 'psynudge_db.sqlite')
+            self.assertEqual(psynudge.db.get_shard_path(filepath, indepId), os.path.join(tmp_dir, 'psynudge_db_shards', indepId+'.sqlite'))
+
+            errors = psynudge.controllers.runShards(filepath=filepath, jobs=jobs, max_workers=2, mock_db=True)
+            self.assertEqual(errors, {indepId: None, stackId: None})
+            self.assertFalse(os.path.isfile(filepath))
+
+            # Each shard only holds its own study
+            for studyId in [indepId, stackId]:
+                db = psynudge.db.open_database(filepath=filepath, shard=studyId)
+                with db_session:
+                    self.assertEqual(db.Study.select().count(), 1)
+                    self.assertEqual(db.Participant.select(lambda p: p.study.id!=studyId).count(), 0)
+                db.disconnect()
+
+            # Global view
+            self.assertEqual(
+                sorted(psynudge.db.query_shards(filepath, 'SELECT study, count(*) FROM {db}.Participant GROUP BY study')),
+                [(indepId, 3), (stackId, 5)])
+            self.assertEqual(
+                psynudge.db.query_shards(filepath, 'SELECT id FROM {db}.Participant WHERE id = :id', {'id': 's001'}),
+                [('s001',)])
+
+            # Default jobs of run_shards.py: PS / SG sync without saving payloads, nudging
+            self.assertEqual(psynudge.controllers.runShards(filepath=filepath, max_workers=2, mock_db=True), {indepId: None, stackId: None})
+
+            # A failing shard does not stop the others
+            server.errors = [404]
+            errors = psynudge.controllers.runShards(filepath=filepath, jobs=jobs, max_workers=2, mock_db=True)
+            self.assertEqual(sorted(error is None for error in errors.values()), [False, True])
+
+class ProfileTests(unittest.TestCase):
+
+    def test_profile(self):
+        """ PRAGMAs of the profile are set on every connection, including those of worker threads """
+
+        def getPragmas(db):
+            with db_session:
+                return [db.execute('PRAGMA {}'.format(pragma)).fetchone()[0] for pragma in ['journal_mode', 'synchronous', 'busy_timeout', 'temp_store']]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            db = psynudge.db.build_skeleton_database(filepath=os.path.join(tmp_dir, 'wal.sqlite'), mock_db=True, profile='wal')
+            self.assertEqual(getPragmas(db), ['wal', 1, 30000, 2])
+
+            pragmas = []
+            thread = threading.Thread(target=lambda: pragmas.append(getPragmas(db)))
+            thread.start()
+            thread.join()
+            self.assertEqual(pragmas, [['wal', 1, 30000, 2]])
+            db.disconnect()
+
+            db = psynudge.db.build_skeleton_database(filepath=os.path.join(tmp_dir, 'default.sqlite'), mock_db=True, profile='default')
+            self.assertEqual(getPragmas(db), ['delete', 2, 5000, 0]) # sqlite3 module sets a 5s busy timeout
+            db.disconnect()
+
+class MigrationTests(unittest.TestCase):
+
+    def test_migrate_iso2ts(self):
+        """ v0 DBs stored timestamps as ISO strings """
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filepath = os.path.join(tmp_dir, 'v0.sqlite')
+
+            con = sqlite3.connect(filepath)
+            con.executescript("""
+                CREATE TABLE "StudyType" ("type" TEXT NOT NULL PRIMARY KEY);
+                CREATE TABLE "Study" ("id" TEXT NOT NULL PRIMARY KEY, "name" TEXT NOT NULL, "type" TEXT NOT NULL REFERENCES "StudyType" ("type") ON DELETE CASCADE, "lastPsCheck" TEXT NOT NULL, "isActive" BOOLEAN NOT NULL);
+                CREATE INDEX "idx_study__type" ON "Study" ("type");
+                CREATE TABLE "Participant" ("id" TEXT NOT NULL PRIMARY KEY, "study" TEXT NOT NULL REFERENCES "Study" ("id") ON DELETE CASCADE, "whenStart" TEXT NOT NULL, "whenFinish" TEXT NOT NULL);
+                CREATE INDEX "idx_participant__study" ON "Participant" ("study");
+                CREATE TABLE "Timepoint" ("id" INTEGER PRIMARY KEY AUTOINCREMENT, "psId" INTEGER NOT NULL, "name" TEXT NOT NULL, "study" TEXT NOT NULL REFERENCES "Study" ("id") ON DELETE CASCADE, "lastSgCheck" TEXT NOT NULL, "surveyId" INTEGER NOT NULL, "startPageId" INTEGER, "firstQID" INTEGER, "lastQID" INTEGER, "td2start" INTERVAL NOT NULL, "td2end" INTERVAL NOT NULL, "td2nudge" INTERVAL NOT NULL);
+                CREATE INDEX "idx_timepoint__study" ON "Timepoint" ("study");
+                CREATE TABLE "Completion" ("id" INTEGER PRIMARY KEY AUTOINCREMENT, "participant" TEXT NOT NULL REFERENCES "Participant" ("id") ON DELETE CASCADE, "timepoint" INTEGER NOT NULL REFERENCES "Timepoint" ("id") ON DELETE CASCADE, "isComplete" BOOLEAN NOT NULL, "lastNudgeSend" TEXT NOT NULL);
+                CREATE INDEX "idx_completion__participant" ON "Completion" ("participant");
+                CREATE INDEX "idx_completion__timepoint" ON "Completion" ("timepoint");
+
+                INSERT INTO "StudyType" VALUES ('indep');
+                INSERT INTO "Study" VALUES ('s1', 'indep_study', 'indep', '2021-02-01T10:00:00+00:00', 1);
+                INSERT INTO "Timepoint" VALUES (1, 1, 'tp1', 's1', '2021-02-02T10:00:00+00:00', 90288073, NULL, 2, 18, 1, 1, 1);
+                INSERT INTO "Participant" VALUES ('001', 's1', '2020-01-10T04:00:00+00:00', '2020-01-13T04:00:00+00:00');
+                INSERT INTO "Completion" VALUES (7, '001', 1, 1, '2020-01-12T05:00:00+00:00');
+            """)
+            con.commit()
+            con.close()
+
+            test_db = psynudge.db.open_database(filepath=filepath)
+
+            with db_session:
+                study = test_db.Study['s1']
+                self.assertEqual(study.lastPsCheckTs, 1612173600)
+                self.assertEqual(study.lastPsCheck, '2021-02-01T10:00:00+00:00')
+                self.assertEqual(study.lastPsFullCheckTs, psynudge.db.DEFAULT_TS)
+                self.assertEqual(test_db.Timepoint[1].lastSgCheck, '2021-02-02T10:00:00+00:00')
+
+                participant = test_db.Participant['001']
+                self.assertEqual(participant.whenStart, '2020-01-10T04:00:00+00:00')
+                self.assertEqual(participant.whenFinish, '2020-01-13T04:00:00+00:00')
+                self.assertEqual(test_db.Participant.select(lambda p: p.whenFinishTs < 1578888000).count(), 0)
+                self.assertEqual(test_db.Participant.select(lambda p: p.whenFinishTs <= 1578888000).count(), 1)
+
+                completion = test_db.Completion[7]
+                self.assertTrue(completion.isComplete)
+                self.assertEqual(completion.lastNudgeSend, '2020-01-12T05:00:00+00:00')
+                self.assertEqual(completion.whenStartTp(), '2020-01-11T04:00:00+00:00')
+                self.assertEqual(completion.whenEndTp(), '2020-01-12T04:00:00+00:00')
+                self.assertEqual(completion.whenEndNudge(), '2020-01-13T04:00:00+00:00')
+
+                # New rows still get their ids after the recreated AUTOINCREMENT tables
+                test_db.Completion(participant=participant, timepoint=test_db.Timepoint[1])
+                commit()
+
+            test_db.disconnect()
+
+            con = sqlite3.connect(filepath)
+            self.assertEqual(con.execute('PRAGMA user_version').fetchone()[0], psynudge.db.SCHEMA_VERSION)
+            self.assertEqual(con.execute('SELECT max(id) FROM Completion').fetchone()[0], 8)
+            con.close()
+
+    def test_migrate_drop_sg_digests(self):
+        """ v4 DBs kept per response digests of SG payloads """
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filepath = os.path.join(tmp_dir, 'v4.sqlite')
+            psynudge.db.build_skeleton_database(filepath=filepath, create_db=True, mock_db=True).disconnect()
+
+            con = sqlite3.connect(filepath)
+            con.executescript("""
+                DROP TABLE "Digest";
+                CREATE TABLE "Digest" ("id" INTEGER PRIMARY KEY AUTOINCREMENT, "study" TEXT NOT NULL REFERENCES "Study" ("id") ON DELETE CASCADE, "source" TEXT NOT NULL, "timepoint" INTEGER REFERENCES "Timepoint" ("id") ON DELETE SET NULL, "payload" TEXT NOT NULL, "entries" TEXT, "updatedTs" INTEGER NOT NULL);
+                INSERT INTO "Digest" SELECT 1, id, 'ps', NULL, 'a', '{}', 0 FROM Study LIMIT 1;
+                INSERT INTO "Digest" SELECT 2, id, 'sg', NULL, 'b', '{}', 0 FROM Study LIMIT 1;
+                INSERT INTO "Digest" SELECT 3, study, 'sg', id, 'c', '{}', 0 FROM Timepoint LIMIT 1;
+                PRAGMA user_version = 4;
+            """)
+            con.close()
+
+            test_db = psynudge.db.open_database(filepath=filepath)
+            with db_session:
+                self.assertEqual([digest.payload for digest in test_db.Digest.select()], ['a'])
+            test_db.disconnect()
+
+    def test_migrate_completion_archive_key(self):
+        """ v5 DBs keyed CompletionArchive on Completion.id, re-archived participants were duplicated """
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filepath = os.path.join(tmp_dir, 'v5.sqlite')
+            psynudge.db.build_skeleton_database(filepath=filepath, create_db=True, mock_db=True).disconnect()
+
+            con = sqlite3.connect(filepath)
+            con.executescript("""
+                DROP TABLE "CompletionArchive";
+                CREATE TABLE "CompletionArchive" ("id" INTEGER NOT NULL PRIMARY KEY, "participant" TEXT NOT NULL, "timepoint" INTEGER NOT NULL, "isComplete" BOOLEAN NOT NULL, "lastNudgeSendTs" INTEGER, "whenStartTpTs" INTEGER, "whenEndTpTs" INTEGER, "whenEndNudgeTs" INTEGER, "nudgesSent" INTEGER NOT NULL);
+                INSERT INTO "CompletionArchive" VALUES (3, '001', 1, 1, 1579392000, 0, 0, 0, 1);
+                INSERT INTO "CompletionArchive" VALUES (4, '001', 2, 0, NULL, 0, 0, 0, 0);
+                INSERT INTO "CompletionArchive" VALUES (9, '001', 1, 0, NULL, 0, 0, 0, 0);
+                PRAGMA user_version = 5;
+            """)
+            con.close()
+
+            test_db = psynudge.db.open_database(filepath=filepath)
+            with db_session:
+                self.assertEqual(sorted((c.timepoint, c.completion, c.nudgesSent) for c in test_db.CompletionArchive.select()), [(1, 3, 1), (2, 4, 0)])
+            test_db.disconnect()
@@ -0,0 +1,154 @@
+"""
+:Author: Balazs Szigeti <b.islander@protonmail.com>
+:Copyright: 2021, DrugNerdsLab
+:License: MIT
+
+python -m pytest psynudge/tests/
+"""
+
+from pony.orm import db_session
+from unittest import mock
+import datetime
+import pytz
+import stubserver
+import psynudge
+import unittest
+import time
+
+
+class DispatchTests(unittest.TestCase):
+    """ Tests for nudge batching / dispatch, against the local stub server """
+
+    def setUp(self):
+        psynudge.clients.closeSession()
+
+    def tearDown(self):
+        psynudge.clients.closeSession()
+
+    def test_makeBatches(self):
+
+        nudges = [(1, 10, []), (1, 11, ['a', 'b', 'c', 'd', 'e']), (2, 20, ['f'])]
+        self.assertEqual(psynudge.dispatch.makeBatches(nudges, batch_size=2), [
+            psynudge.dispatch.NudgeBatch(1, 11, ['a', 'b']),
+            psynudge.dispatch.NudgeBatch(1, 11, ['c', 'd']),
+            psynudge.dispatch.NudgeBatch(1, 11, ['e']),
+            psynudge.dispatch.NudgeBatch(2, 20, ['f'])])
+        self.assertEqual(psynudge.dispatch.makeBatches([(1, 10, [])]), [])
+
+    def test_dispatch(self):
+
+        nudges = [(1, 10, []), (1, 11, ['a', 'b', 'c']), (2, 20, ['d']), (3, 30, ['e'])]
+        with stubserver.StubServer(latency=0.1) as server, \
+             mock.patch.object(psynudge.src.config, 'PS_BASE_URL', server.url+'v2/'), \
+             mock.patch.object(psynudge.src.config, 'HTTP_RETRIES', 0):
+
+            server.errors = [500] # first batch to arrive fails, the rest is still sent
+            results = psynudge.dispatch.dispatch(nudges, batch_size=2, max_workers=4, rate=0)
+
+            self.assertEqual([result.batch.participants for result in results], [['a', 'b'], ['c'], ['d'], ['e']])
+            self.assertEqual(sum(1 for result in results if not result.ok), 1)
+            self.assertEqual([result.status for result in results if not result.ok], [500])
+            self.assertTrue(all(result.latency>=0.1 for result in results))
+            self.assertEqual(len(server.sent), 3)
+            self.assertEqual(server.max_active, 4) # no empty batch POST, all batches in flight at once
+
+            # Nothing to send, no request
+            server.requests.clear()
+            self.assertEqual(psynudge.dispatch.dispatch([(1, 10, []), (2, 20, [])]), [])
+            self.assertEqual(server.requests, [])
+
+    def test_rateLimit(self):
+
+        nudges = [(1, 11, ['a', 'b', 'c', 'd']), (2, 20, ['e'])]
+        with stubserver.StubServer() as server, \
+             mock.patch.object(psynudge.src.config, 'PS_BASE_URL', server.url+'v2/'):
+
+            start = time.perf_counter()
+            results = psynudge.dispatch.dispatch(nudges, batch_size=1, max_workers=5, rate=10)
+            elapsed = time.perf_counter()-start
+
+        self.assertTrue(all(result.ok for result in results))
+        self.assertGreaterEqual(elapsed, 0.3) # 4 batches of study 1 start 0.1s apart
+        self.assertLess(elapsed, 1)
+
+
+class OutboxTests(unittest.TestCase):
+    """ Tests for queueing nudges to / draining the Nudge outbox """
+
+    def setUp(self):
+        psynudge.clients.closeSession()
+        self.db = psynudge.db.build_skeleton_database(filepath=':memory:', create_db=True, mock_db=True)
+        with db_session:
+            study = self.db.Study.select(lambda s: s.name=='indep_study').first()
+            psynudge.core.updateParticipant(db=self.db, study=study, ps_data=[
+                {"date":"2021-01-01T00:00:00+00:00", "id":"001"},
+                {"date":"2021-01-01T00:00:00+00:00", "id":"002"},
+                {"date":"2021-01-01T00:00:00+00:00", "id":"003"}])
+            self.db.Completion.select(lambda c: c.participant.id=='003').first().isComplete = True
+
+    def tearDown(self):
+        psynudge.clients.closeSession()
+
+    def setNow(self, dt):
+        for target in ['psynudge.src.core.getUtcNow', 'psynudge.src.dispatch.getUtcNow']:
+            patch = mock.patch(target, return_value=dt)
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_outbox(self):
+
+        db = self.db
+        self.setNow(datetime.datetime(2021, 1, 3, 12, tzinfo=pytz.UTC)) # nudge window of indep_tp1
+
+        # Queueing is idempotent while nudges are pending
+        self.assertEqual(psynudge.core.queueNudges(db), 2)
+        self.assertEqual(psynudge.core.queueNudges(db), 0)
+
+        with stubserver.StubServer() as server, \
+             mock.patch.object(psynudge.src.config, 'PS_BASE_URL', server.url+'v2/'), \
+             mock.patch.object(psynudge.src.config, 'HTTP_RETRIES', 0):
+
+            # Failed send: rows stay pending, nothing is marked as nudged
+            server.errors = [500]
+            results = psynudge.dispatch.drainOutbox(db)
+            self.assertEqual([result.ok for result in results], [False])
+            with db_session:
+                self.assertEqual(db.Nudge.select(lambda n: n.sentTs is None and n.attempts==1).count(), 2)
+                self.assertEqual(db.Completion.select(lambda c: c.lastNudgeSendTs!=psynudge.db.DEFAULT_TS).count(), 0)
+
+            # Retry succeeds: rows are marked as sent together with Completion.lastNudgeSend
+            results = psynudge.dispatch.drainOutbox(db)
+            self.assertEqual([result.ok for result in results], [True])
+            self.assertEqual(server.sent, [('38130fdb-5c9e-11eb-ac63-0a280c4496dd', '1', {
+                'subject': 'Reminder to complete missed survey', 'participants': ['001', '002']})])
+            with db_session:
+                self.assertEqual(db.Nudge.select(lambda n: n.sentTs is None).count(), 0)
+                self.assertEqual(
+                    sorted(c.participant.id for c in db.Completion.select() if c.lastNudgeSend=='2021-01-03T12:00:00+00:00'),
+                    ['001', '002'])
+
+            # Nothing pending, nothing sent; sent nudges are not timely for another day
+            server.requests.clear()
+            self.assertEqual(psynudge.dispatch.drainOutbox(db), [])
+            self.assertEqual(psynudge.core.queueNudges(db), 0)
+            self.assertEqual(server.requests, [])
+
+    def test_outbox_claims(self):
+
+        db = self.db
+        self.setNow(datetime.datetime(2021, 1, 3, 12, tzinfo=pytz.UTC))
+        psynudge.core.queueNudges(db)
+
+        # Claimed rows are skipped by other drains until the lease expires
+        with db_session:
+            claimed = psynudge.dispatch.claimNudges(db, limit=10, lease=3600)
+            self.assertEqual(len(claimed), 2)
+            self.assertEqual(psynudge.dispatch.claimNudges(db, limit=10, lease=3600), [])
+            self.assertEqual(len(psynudge.dispatch.claimNudges(db, limit=10, lease=-1)), 2)
+
+        # Nudges completed meanwhile are dropped from the outbox
+        with db_session:
+            db.Completion.select(lambda c: c.participant.id=='001').first().isComplete = True
+        with db_session:
+            self.assertEqual([row[2] for row in psynudge.dispatch.claimNudges(db, limit=10, lease=-1)], ['002'])
+            self.assertEqual(db.Nudge.select().count(), 1)
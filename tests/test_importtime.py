@@ -0,0 +1,37 @@
+"""
+:Author: Balazs Szigeti <b.islander@protonmail.com>
+:Copyright: 2021, DrugNerdsLab
+:License: MIT
+
+python -m pytest psynudge/tests/
+"""
+
+import subprocess
+import unittest
+import sys
+import os
+
+root_dir = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+IMPORT_BUDGET_MS = 500 # cumulative import time of an entry point module; ~100ms on the server, see benchmarks/bench_importtime.py
+
+
+class ImportTimeTests(unittest.TestCase):
+    """ Entry point modules load fast and leave HTTP / SG libraries to first use """
+
+    def importtime(self, module):
+        """ Returns (cumulative import ms of module, heavy modules loaded) in a fresh interpreter """
+
+        code = 'import sys, {}; print(",".join(m for m in ["requests", "urllib3", "surveygizmo", "src.tokens"] if m in sys.modules))'.format(module)
+        out = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=root_dir, check=True,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+        line = [line for line in out.stderr.splitlines() if line.split('|')[-1].strip()==module][0]
+        return int(line.split('|')[1])/1000, [name for name in out.stdout.strip().split(',') if name]
+
+    def test_importtime(self):
+
+        for module in ['src.controllers', 'src.daemon', 'src.dispatch']:
+            ms, loaded = min((self.importtime(module) for idx in range(3)), key=lambda run: run[0])
+            self.assertEqual(loaded, [], module)
+            self.assertLess(ms, IMPORT_BUDGET_MS, module)
@@ -0,0 +1,53 @@
+"""
+:Author: Balazs Szigeti <b.islander@protonmail.com>
+:Copyright: 2021, DrugNerdsLab
+:License: MIT
+
+python -m pytest psynudge/tests/
+"""
+
+import psynudge
+import unittest
+import json
+import io
+import os
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+class JsonStreamTests(unittest.TestCase):
+    """ Tests for incremental JSON parsing """
+
+    def test_iterJsonArray_fixtures(self):
+
+        for fixture in ['indep_tp1.json', 'indep_tp2.json', 'stack.json']:
+            with open(os.path.join(test_dir, 'fixtures', fixture), 'r') as j:
+                expected = json.loads(j.read())
+
+            for chunk_size in [1, 7, 4096]: # tiny chunks split every token across reads
+                meta = {}
+                with open(os.path.join(test_dir, 'fixtures', fixture), 'r') as j:
+                    responses = list(psynudge.jsonstream.iterJsonArray(j, key='data', meta=meta, chunk_size=chunk_size))
+
+                self.assertEqual(responses, expected['data'])
+                self.assertEqual(meta, {key: value for key, value in expected.items() if key!='data'})
+
+    def test_iterJsonArray_chunks(self):
+
+        payload = {'total_count': 1234567, 'data': [{'id': 1, 'answer': 'árvíztűrő'}, {'id': 2, 'answer': None}], 'result_ok': True}
+        raw = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+
+        meta = {}
+        chunks = [raw[idx:idx+3] for idx in range(0, len(raw), 3)] # bytes chunks split multibyte characters / numbers
+        self.assertEqual(list(psynudge.jsonstream.iterJsonArray(chunks, meta=meta)), payload['data'])
+        self.assertEqual(meta, {'total_count': 1234567, 'result_ok': True})
+
+        self.assertEqual(list(psynudge.jsonstream.iterJsonArray(io.BytesIO(raw), chunk_size=5)), payload['data'])
+        self.assertEqual(list(psynudge.jsonstream.iterJsonArray(io.StringIO('{"data": []}'))), [])
+        self.assertEqual(list(psynudge.jsonstream.iterJsonArray(io.StringIO('{}'))), [])
+
+        with self.assertRaises(ValueError):
+            list(psynudge.jsonstream.iterJsonArray(io.StringIO('{"data": [{"id": 1}, {"id": 2')))
+
+        with self.assertRaises(ValueError):
+            list(psynudge.jsonstream.iterJsonArray(io.StringIO('[{"id": 1}]')))
@@ -52,6 +52,51 @@ class DatetimeTests(unittest.TestCase):
         dt_utc = psynudge.mydt.iso2utcdt('2020-01-10T00:00:00-03:00')
         self.assertEqual(dt_utc, dateutil.parser.parse('2020-01-10T00:00:00-03:00').astimezone(pytz.timezone('UTC')))
 
+    def test_parseDt(self):
+
+        # Fast path formats have to give the same result as dateutil
+        for dstr in ['2020-11-06 10:58:09 GMT', '2020-01-10T00:00:00Z', '2020-01-10T00:00:00+00:00',
+                     '2020-01-10T00:00:00-03:00', '2020-01-10T00:00:00.250+05:30', '2021-01-24T23:00:00']:
+            self.assertEqual(psynudge.mydt.parseDt(dstr), dateutil.parser.parse(dstr))
+
+        # Odd inputs fall back to dateutil
+        self.assertEqual(
+            psynudge.mydt.parseDt('January 10, 2020 02:00 UTC').astimezone(pytz.timezone('UTC')),
+            dateutil.parser.parse('2020-01-10T02:00:00Z'))
+
+        with self.assertRaises(ValueError):
+            psynudge.mydt.parseDt('not a date')
+
+    def test_iso2utcdt_cached(self):
+
+        dt_utc = psynudge.mydt.iso2utcdt('2020-11-06 10:58:09 GMT')
+        self.assertEqual(dt_utc, dateutil.parser.parse('2020-11-06T10:58:09Z'))
+        self.assertEqual(dt_utc.tzname(), 'UTC')
+        self.assertTrue(isinstance(dt_utc.tzinfo, type(pytz.UTC)))
+        self.assertIs(psynudge.mydt.iso2utcdt('2020-11-06 10:58:09 GMT'), dt_utc)
+
+        with self.assertRaises(AssertionError):
+            psynudge.mydt.iso2utcdt(1578614400)
+
+    def test_iso2ts(self):
+
+        self.assertEqual(psynudge.mydt.iso2ts('1970-01-01T00:00:00Z'), 0)
+        self.assertEqual(psynudge.mydt.iso2ts('2020-01-10T00:00:00+00:00'), 1578614400)
+        self.assertEqual(psynudge.mydt.iso2ts('2020-01-10T02:00:00+02:00'), 1578614400)
+        self.assertEqual(psynudge.mydt.iso2ts('2020-01-09T21:00:00-03:00'), 1578614400)
+        self.assertIsNone(psynudge.mydt.iso2ts(''))
+        self.assertIsNone(psynudge.mydt.iso2ts(None))
+
+    def test_ts2iso(self):
+
+        self.assertEqual(psynudge.mydt.ts2iso(1578614400), '2020-01-10T00:00:00+00:00')
+        self.assertEqual(psynudge.mydt.ts2utcdt(1578614400), self.dtStartUTC)
+        self.assertEqual(psynudge.mydt.dt2ts(self.dtStartUTC), 1578614400)
+        self.assertIsNone(psynudge.mydt.ts2iso(None))
+
+        for dstr in ['2020-01-10T00:00:00+00:00', '2021-06-30T23:59:59+00:00']:
+            self.assertEqual(psynudge.mydt.ts2iso(psynudge.mydt.iso2ts(dstr)), dstr)
+
     @mock.patch('psynudge.src.mydt.getUtcNow')
     def test_isWithinTimeWindow(self, mock):
 